@@ -1,4 +1,4 @@
-from database import upsert
+from database.cli import main
 
-#if __name__ == '__main__':
-#    upsert.run()
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,283 @@
+##
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+
+from database.cli import configure_logging
+from database.database_functions import (
+    build_frame,
+    bulk_upsert,
+    filter_deleted,
+    request_to_database,
+    transform,
+)
+from database.id_cache import id_cache
+from database.models import (
+    create_tables,
+    mySQL_connect,
+    session_factory,
+)
+from database.planner import SlicePlanner
+from database.synthetic import (
+    Account,
+    generate_account,
+    generate_adsets,
+    generate_campaigns,
+    generate_insights,
+)
+from database.tables import INSIGHTS_TABLES, TABLES
+from sqlalchemy import DateTime, create_engine, event
+from sqlalchemy.dialects.sqlite import DATETIME
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# OFFLINE BENCHMARKS
+#++++++++++++++++++++++++++++++++++++++++
+# Times each stage of a sync (plan, build_frame,
+# filter_deleted, transform, bulk_upsert, request_to_database) on
+# synthetic payloads against a local database stand-in.
+# usage: python -m database.benchmark --ads 500 --days 7
+
+RESULTS_PATH = 'database/logs/benchmarks.jsonl'
+# a stage is flagged when its rows/sec falls this far below the
+# median of earlier runs with the same parameters
+REGRESSION_TOLERANCE = 0.2
+
+class StringDateTime(DATETIME):
+    """sqlite DATETIME that also takes the ISO strings the upserts
+    send to MySQL
+    """
+    def bind_processor(self, dialect):
+        process = super().bind_processor(dialect)
+        def bind(value):
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value[:19])
+            return process(value)
+        return bind
+
+def standin_engine(url='sqlite://'):
+    """In-memory sqlite engine with the model's tables, standing in
+    for MySQL. Only method='merge' works against it.
+    """
+    engine = create_engine(url)
+
+    @event.listens_for(engine, 'connect')
+    def add_collation(dbapi_connection, connection_record):
+        # used by the region column
+        dbapi_connection.create_collation(
+            'utf8_general_ci', lambda a, b: (a > b) - (a < b))
+
+    # per engine, so the sqlite dialect class is left as it is
+    engine.dialect.colspecs = dict(engine.dialect.colspecs)
+    engine.dialect.colspecs[DateTime] = StringDateTime
+    create_tables(engine)
+    return engine
+
+def measure(fn, rows, trace_memory=True):
+    """Run fn and return (result, stats) with seconds, rows/sec and
+    the peak memory (MB) allocated while it ran.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    stats = {'seconds': round(seconds, 4),
+             'rows': rows,
+             'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+             'peak_mb': None if peak is None else round(peak, 2)}
+    return result, stats
+
+def load_dimensions(engine, account):
+    """Sync the synthetic account, campaigns and adsets so the
+    insights rows pass filter_deleted.
+    """
+    id_cache.invalidate()
+    request_to_database(generate_account(account), 'accounts', engine)
+    request_to_database(generate_campaigns(account), 'campaigns', engine)
+    request_to_database(generate_adsets(account), 'adsets', engine)
+
+def run(engine, args):
+    """Run every stage for each table of args.tables.
+    returns: dictionary of stage name -> stats
+    """
+    results = {}
+    account = Account(campaigns=args.campaigns,
+                      adsets_per_campaign=args.adsets,
+                      ads_per_adset=max(1, args.ads // (args.campaigns * args.adsets)),
+                      seed=args.seed)
+    load_dimensions(engine, account)
+    trace = not args.no_memory
+
+    # the date ranges of a year for every insights table (the
+    # default size; the planner's history is written with MySQL only)
+    planner = SlicePlanner(engine)
+    _, results['plan'] = measure(
+        lambda: [planner.plan(f'act_{account.account_id}', table,
+                              '2019-01-01', '2019-12-31')
+                 for table in INSIGHTS_TABLES],
+        rows=len(INSIGHTS_TABLES), trace_memory=trace)
+
+    Session = session_factory(engine)
+    for table in args.tables:
+        records = list(generate_insights(account, table, days=args.days,
+                                         cardinality=args.cardinality,
+                                         density=args.density))
+        rows = len(records)
+        df, results[f'{table}.build_frame'] = measure(
+            lambda: build_frame(records, table, compact=args.compact),
+            rows, trace)
+        session = Session()
+        df, results[f'{table}.filter_deleted'] = measure(
+            lambda: filter_deleted(df, session), rows, trace)
+        df, results[f'{table}.transform'] = measure(
+            lambda: transform(df, compact=args.compact), rows, trace)
+        model = TABLES[table].model
+        id_cols = TABLES[table].id_cols
+        # first pass inserts, second pass updates the same rows
+        for stage in ['insert', 'update']:
+            _, results[f'{table}.bulk_upsert.{stage}'] = measure(
+                lambda: bulk_upsert(session, model, table, df.copy(), id_cols,
+                                    method=args.method,
+                                    load_threshold=args.load_threshold,
+                                    detect_changes=args.detect_changes),
+                rows, trace)
+        session.close()
+        _, results[f'{table}.request_to_database'] = measure(
+            lambda: request_to_database(records, table, engine,
+                                        method=args.method,
+                                        chunksize=args.chunksize,
+                                        load_threshold=args.load_threshold,
+                                        compact=args.compact,
+                                        detect_changes=args.detect_changes),
+            rows, trace)
+    return results
+
+def previous_runs(path, params):
+    """Results of earlier runs in path made with the same params"""
+    if not os.path.exists(path):
+        return []
+    runs = []
+    with open(path) as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get('params') == params:
+                runs.append(run)
+    return runs
+
+def regressions(results, runs, tolerance=REGRESSION_TOLERANCE):
+    """Stages whose rows/sec is more than tolerance below the median
+    of the same stage in runs.
+    returns: dictionary of stage -> (rows/sec, median rows/sec)
+    """
+    flagged = {}
+    for stage, stats in results.items():
+        history = [run['stages'][stage]['rows_per_sec'] for run in runs
+                   if run['stages'].get(stage, {}).get('rows_per_sec')]
+        if not history or not stats['rows_per_sec']:
+            continue
+        median = statistics.median(history)
+        if stats['rows_per_sec'] < median * (1 - tolerance):
+            flagged[stage] = (stats['rows_per_sec'], median)
+    return flagged
+
+def report(results, flagged):
+    """Print one line per stage"""
+    print(f"{'stage':<48}{'seconds':>10}{'rows/sec':>14}{'peak MB':>10}")
+    for stage, stats in results.items():
+        peak = '-' if stats['peak_mb'] is None else f"{stats['peak_mb']:.1f}"
+        line = (f"{stage:<48}{stats['seconds']:>10.3f}"
+                f"{stats['rows_per_sec'] or 0:>14.0f}{peak:>10}")
+        if stage in flagged:
+            line += f"  REGRESSION (median {flagged[stage][1]:.0f} rows/sec)"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sync stages '
+                                     'on synthetic insights payloads')
+    parser.add_argument('--ads', type=int, default=240,
+                        help='number of ads in the synthetic account')
+    parser.add_argument('--campaigns', type=int, default=5)
+    parser.add_argument('--adsets', type=int, default=4,
+                        help='adsets per campaign')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--cardinality', type=int, default=10,
+                        help='breakdown values per ad and day '
+                        '(age/gender, region)')
+    parser.add_argument('--density', type=float, default=0.3,
+                        help='probability of each action type in a row')
+    parser.add_argument('--tables', nargs='*', default=INSIGHTS_TABLES,
+                        choices=INSIGHTS_TABLES)
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--credentials',
+                        help='db secrets json; benchmark against this MySQL '
+                        'server instead of the sqlite stand-in')
+    parser.add_argument('--db', help='MySQL database to use with '
+                        '--credentials (its tables are written to)')
+    parser.add_argument('--method', default='merge',
+                        choices=['merge', 'native'],
+                        help="upsert method ('native' needs MySQL)")
+    parser.add_argument('--load-threshold', type=int, default=None)
+    parser.add_argument('--compact', action='store_true',
+                        help='build memory compact frames')
+    parser.add_argument('--detect-changes', action='store_true',
+                        help='skip rows whose content hash did not change')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace memory (tracing slows every stage)')
+    parser.add_argument('--results', default=RESULTS_PATH,
+                        help='json-lines file the results are appended to')
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    # the per batch info messages would swamp the report
+    logging.getLogger('database').setLevel(logging.WARNING)
+
+    if args.credentials:
+        if not args.db:
+            parser.error('--credentials requires --db')
+        engine = mySQL_connect(args.credentials, port='3306', db=args.db)
+        create_tables(engine)
+        backend = 'mysql'
+    else:
+        if args.method != 'merge':
+            parser.error('the sqlite stand-in only supports --method merge')
+        engine = standin_engine()
+        backend = 'sqlite'
+
+    params = {k: v for k, v in vars(args).items()
+              if k not in ['credentials', 'db', 'results']}
+    params['tables'] = list(params['tables'])
+    params['backend'] = backend
+
+    results = run(engine, args)
+    runs = previous_runs(args.results, params)
+    flagged = regressions(results, runs)
+    report(results, flagged)
+
+    os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps({'run_at': datetime.now().isoformat(),
+                            'params': params,
+                            'stages': results,
+                            'regressions': sorted(flagged)}) + '\n')
+    return 1 if flagged else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
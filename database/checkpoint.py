@@ -0,0 +1,132 @@
+##
+import glob
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+from database.sync_state import day_range
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# RUN CHECKPOINTS
+#++++++++++++++++++++++++++++++++++++++++
+
+CHECKPOINT_DIR = 'database/logs/checkpoints'
+
+def new_run_id():
+    return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+class Checkpoint:
+    """Log of the units of a run that completed: (account, table) for
+    the dimension tables and (account, table, time range) for the
+    insights tables. Every unit is appended to
+    <directory>/<run_id>.jsonl as soon as it is loaded, so a run that
+    is restarted with the same run id skips everything that was done.
+    Insights ranges are tracked per day, so a resumed run can cut the
+    days that are left into different ranges.
+    """
+    def __init__(self, run_id=None, directory=CHECKPOINT_DIR):
+        self.run_id = run_id or new_run_id()
+        self.path = os.path.join(directory, self.run_id + '.jsonl')
+        self.tables = set() # (account, table)
+        self.days = {} # (account, table) -> set of datetimes
+        self.finished = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            self._read()
+            logger.info(f'resuming run {self.run_id}: '
+                        f'{len(self.tables)} tables and '
+                        f'{sum(len(d) for d in self.days.values())} '
+                        f'table days already done')
+
+    def _read(self):
+        with open(self.path, 'rb+') as f:
+            # end a line cut off by a crash before appending to it
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    unit = json.loads(line)
+                except ValueError:
+                    continue # a line cut off by a crash
+                if unit.get('finished'):
+                    self.finished = True
+                elif unit.get('since'):
+                    self._add_days(unit)
+                else:
+                    self.tables.add((unit['account'], unit['table']))
+
+    def _add_days(self, unit):
+        key = (unit['account'], unit['table'])
+        self.days.setdefault(key, set()).update(
+            day_range(unit['since'], unit['until']))
+
+    def _append(self, unit):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(unit) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def is_done(self, account, table):
+        """True if the dimension table was synced for account"""
+        return (account, table) in self.tables
+
+    def mark_done(self, account, table, time_range=None, rows=None):
+        """Record a completed unit"""
+        unit = {'account': account, 'table': table,
+                'completed_at': datetime.now().isoformat()}
+        if time_range is not None:
+            unit.update(since=time_range['since'], until=time_range['until'])
+        if rows is not None:
+            unit['rows'] = rows
+        self._append(unit)
+        with self._lock:
+            if time_range is None:
+                self.tables.add((account, table))
+            else:
+                self._add_days(unit)
+
+    def pending_spans(self, account, table, start, end):
+        """Contiguous (since, until) spans of the days from start to
+        end that are not done for account and table
+        """
+        done = self.days.get((account, table), set())
+        spans = []
+        for day in day_range(start, end):
+            if day in done:
+                continue
+            if spans and spans[-1][1] == day - timedelta(days=1):
+                spans[-1][1] = day
+            else:
+                spans.append([day, day])
+        return [(since.strftime("%Y-%m-%d"), until.strftime("%Y-%m-%d"))
+                for since, until in spans]
+
+    def finish(self):
+        """Mark the run complete; --resume skips finished runs"""
+        self._append({'finished': True,
+                      'completed_at': datetime.now().isoformat()})
+        self.finished = True
+
+    @staticmethod
+    def latest_unfinished(directory=CHECKPOINT_DIR):
+        """run id of the most recent run that did not finish, or None"""
+        paths = sorted(glob.glob(os.path.join(directory, '*.jsonl')),
+                       key=os.path.getmtime, reverse=True)
+        for path in paths:
+            run_id = os.path.basename(path)[:-len('.jsonl')]
+            with open(path) as f:
+                if not any('"finished": true' in line for line in f):
+                    return run_id
+        return None
@@ -0,0 +1,223 @@
+##
+import argparse
+import logging
+import logging.config
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# COMMAND LINE
+#++++++++++++++++++++++++++++++++++++++++
+# usage: python -m database <command> [options]
+#   sync      sync accounts (the default command)
+#   backfill  re-pull the insights tables for a date range
+#   plan      show the date ranges a sync would request
+#   replay    load the landing zone again without api calls
+# Only argparse is imported up front; each command imports what it
+# needs (pandas, the SDK, SQLAlchemy) when it runs.
+
+COMMANDS = ['sync', 'backfill', 'plan', 'replay']
+LOGGING_CONFIG = 'database/config.yaml'
+
+def configure_logging(path=LOGGING_CONFIG):
+    """Configure logging from the yaml file at path"""
+    import yaml
+    with open(path, 'r') as f:
+        config = yaml.safe_load(f.read())
+    logging.config.dictConfig(config)
+
+def _date(value):
+    return date.fromisoformat(value).strftime("%Y-%m-%d")
+
+def add_run_arguments(parser):
+    parser.add_argument('clients', nargs='*', help='ad account ids (act_<ID>)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of accounts synced at the same time')
+    parser.add_argument('--table-workers', type=int, default=3,
+                        help='number of tables of an account synced at the same time')
+    parser.add_argument('--run-id', default=None,
+                        help='checkpoint id of this run; an existing run id resumes that run')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the most recent run that did not finish')
+    parser.add_argument('--land', action='store_true',
+                        help='also write every downloaded page to the landing zone')
+    parser.add_argument('--landing-dir', default=None,
+                        help='directory of the landing zone')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve prometheus metrics on this port while syncing')
+    parser.add_argument('--metrics-file', default=None,
+                        help='write prometheus metrics to this file when done')
+    add_profile_argument(parser)
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every stage; written to '
+                        'database/logs/profiles/<run id>')
+
+def build_parser():
+    tables_help = ('tables to sync (all by default); tables they depend on '
+                   'are not synced unless listed')
+    parser = argparse.ArgumentParser(prog='python -m database',
+                                     description='Sync Facebook ad accounts to MySQL')
+    commands = parser.add_subparsers(dest='command')
+
+    sync = commands.add_parser('sync', help='sync accounts')
+    add_run_arguments(sync)
+    sync.add_argument('--full-refresh', action='store_true',
+                      help='re-pull the whole lookback window, including settled days')
+    sync.add_argument('--tables', nargs='*', default=None, help=tables_help)
+
+    backfill = commands.add_parser('backfill', help='re-pull the insights '
+                                   'tables of accounts for a date range')
+    add_run_arguments(backfill)
+    backfill.add_argument('--since', type=_date, required=True,
+                          help='first day (YYYY-MM-DD)')
+    backfill.add_argument('--until', type=_date,
+                          default=(date.today() - timedelta(days=1)).strftime("%Y-%m-%d"),
+                          help='last day (YYYY-MM-DD); yesterday by default')
+    backfill.add_argument('--tables', nargs='*', default=None,
+                          help='insights tables to backfill (all by default)')
+
+    plan = commands.add_parser('plan', help='show the date ranges a sync '
+                               'would request, without requesting them')
+    plan.add_argument('clients', nargs='+', help='ad account ids (act_<ID>)')
+    plan.add_argument('--tables', nargs='*', default=None,
+                      help='insights tables (all by default)')
+    plan.add_argument('--full-refresh', action='store_true')
+    plan.add_argument('--run-id', default=None,
+                      help='leave out the days this run already loaded')
+
+    replay = commands.add_parser('replay', help='load the landing zone '
+                                 'again without api calls')
+    replay.add_argument('clients', nargs='*', help='ad account ids '
+                        '(all landed accounts if none are given)')
+    replay.add_argument('--workers', type=int, default=1)
+    replay.add_argument('--landing-dir', default=None)
+    replay.add_argument('--tables', nargs='*', default=None, help=tables_help)
+    add_profile_argument(replay)
+    return parser
+
+def start_metrics(args):
+    from database import metrics
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        logger.info(f'serving metrics on port {args.metrics_port}')
+
+def write_metrics(args):
+    from database import metrics
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+
+@contextmanager
+def profiling(args, name):
+    """Profile the block with --profile (see profiling.py)"""
+    if not args.profile:
+        yield
+        return
+    from database.profiling import PROFILE_DIR, Profiler
+    profiler = Profiler(os.path.join(PROFILE_DIR, name))
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+
+def landing_zone(args):
+    from database.landing import LANDING_DIR, LandingZone
+    return LandingZone(args.landing_dir or LANDING_DIR)
+
+def check_tables(tables, valid, kind='known tables'):
+    """Exit with the valid names if tables has a name not in valid"""
+    unknown = [t for t in tables or [] if t not in valid]
+    if unknown:
+        raise SystemExit(f'not {kind}: {", ".join(unknown)} '
+                         f'(choose from {", ".join(valid)})')
+
+def sync(args, window=None):
+    """sync and backfill"""
+    from database.checkpoint import Checkpoint
+    from database.tables import TABLES
+    from database.throttle import Throttler
+    from database.upsert import SyncRun, authenticate, connect, pool_size
+
+    check_tables(args.tables, list(TABLES))
+
+    # completed units are logged so a failed or killed run can be resumed
+    run_id = args.run_id
+    if run_id is None and args.resume:
+        run_id = Checkpoint.latest_unfinished()
+    checkpoint = Checkpoint(run_id)
+    logger.info(f'run id: {checkpoint.run_id}')
+    start_metrics(args)
+
+    # every api call waits only as long as the reported usage requires
+    throttler = Throttler()
+    authenticate(throttler)
+    engine = connect(pool_size=pool_size(args.workers, args.table_workers))
+    run = SyncRun(engine, checkpoint=checkpoint, throttler=throttler,
+                  landing=landing_zone(args), land=args.land,
+                  table_workers=args.table_workers, tables=args.tables,
+                  full_refresh=getattr(args, 'full_refresh', False),
+                  window=window)
+    with profiling(args, checkpoint.run_id):
+        not_synced = run.run(args.clients, workers=args.workers)
+    write_metrics(args)
+    return 1 if not_synced else 0
+
+def backfill(args):
+    from database.tables import INSIGHTS_TABLES
+    tables = args.tables or INSIGHTS_TABLES
+    check_tables(tables, INSIGHTS_TABLES, 'insights tables')
+    args.tables = tables
+    return sync(args, window=(args.since, args.until))
+
+def plan(args):
+    from database.checkpoint import Checkpoint
+    from database.tables import INSIGHTS_TABLES
+    from database.upsert import SyncRun, connect
+
+    tables = args.tables or INSIGHTS_TABLES
+    check_tables(tables, INSIGHTS_TABLES, 'insights tables')
+    checkpoint = Checkpoint(args.run_id) if args.run_id else None
+    # only reads; nothing is created or altered
+    run = SyncRun(connect(migrate=False), checkpoint=checkpoint,
+                  full_refresh=args.full_refresh)
+    for account in args.clients:
+        for table in tables:
+            time_ranges = run.plan_time_ranges(account, table)
+            for time_range in time_ranges:
+                print(f"{account}\t{table}\t{time_range['since']}\t{time_range['until']}")
+            if not time_ranges:
+                print(f"{account}\t{table}\tup to date")
+    return 0
+
+def replay(args):
+    from database.tables import TABLES
+    from database.upsert import SyncRun, connect, pool_size
+
+    check_tables(args.tables, list(TABLES))
+    landing = landing_zone(args)
+    clients = args.clients or landing.accounts()
+    run = SyncRun(connect(pool_size=pool_size(args.workers)), landing=landing,
+                  tables=args.tables)
+    with profiling(args, 'replay-' + datetime.now().strftime("%Y%m%d-%H%M%S")):
+        not_synced = run.run(clients, workers=args.workers, replay=True)
+    return 1 if not_synced else 0
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # python -m database act_<ID> ... is a sync
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['sync'] + argv
+    args = build_parser().parse_args(argv)
+    configure_logging()
+    command = {'sync': sync, 'backfill': backfill,
+               'plan': plan, 'replay': replay}[args.command]
+    return command(args)
@@ -1,42 +1,39 @@
+import contextlib
+import csv
+import functools
+import itertools
 import json
 import logging
+import os
+import numpy as np
 import pandas as pd
-import time
-import yaml
-from database.models import (
-    mySQL_connect,
-    AccountsTable,
-    CampaignsTable,
-    AdSetsTable,
-    AdsInsightsTable,
-    AdsInsightsAgeGenderTable,
-    AdsInsightsRegionTable,
-)
+import queue
+import tempfile
+import threading
+from database import metrics
+from database.id_cache import ID_COLUMNS, id_cache
+from database.report_jobs import ReportJobManager
+from database.pipeline import PIPELINE_DEPTH, run_pipeline
+from database.spill import Spill
+from database.models import session_factory
+from database.tables import TABLES
 from facebook_business.adobjects.adaccount import AdAccount
-from facebook_business.adobjects.adsinsights import AdsInsights
-from facebook_business.adobjects.adreportrun import AdReportRun
-from facebook_business.adobjects.campaign import Campaign
-from facebook_business.adobjects.adset import AdSet
 from facebook_business.api import FacebookAdsApi
+from facebook_business.session import FacebookSession
+from sqlalchemy import select, text, tuple_
 from sqlalchemy.dialects.mysql import insert
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import DBAPIError
 
 ##
-#++++++++++++++++++++
-# LOGGER
-#++++++++++++++++++++
-##
-with open('database/config.yaml', 'r') as f:
-    config = yaml.safe_load(f.read())
-    logging.config.dictConfig(config)
-
 logger = logging.getLogger(__name__)
 ##
 
-def facebookconnect(secrets_path):
-    """Connect to Facebook Marketing API.
-    secrets_path: absolute path to client secrets;
-    stored in json format.
+# large batches are written here before LOAD DATA LOCAL INFILE
+STAGING_DIR = 'database/staging'
+
+def read_client_secrets(secrets_path):
+    """Return (app id, app secret, access token) from the client
+    secrets json file.
     """
     with open(secrets_path) as authentication_file:
             authentication_result = json.load(authentication_file)
@@ -44,14 +41,158 @@ def facebookconnect(secrets_path):
     my_app_id = authentication_result['my_app_id']
     my_app_secret = authentication_result['my_app_secret']
     my_access_token = authentication_result['my_access_token']
+    return my_app_id, my_app_secret, my_access_token
+
+def facebookconnect(secrets_path):
+    """Connect to Facebook Marketing API.
+    secrets_path: absolute path to client secrets;
+    stored in json format.
+    --> returns the default api
+    """
+    my_app_id, my_app_secret, my_access_token = read_client_secrets(secrets_path)
     # AUTHENTICATE FACEBOOK API CALL WITH APP/USER CREDENTIALS
-    FacebookAdsApi.init(my_app_id, my_app_secret, my_access_token)
+    return FacebookAdsApi.init(my_app_id, my_app_secret, my_access_token)
+
+def facebook_session(secrets_path):
+    """Create an api with its own http session, separate from the
+    default api, e.g. one per worker thread.
+    secrets_path: absolute path to client secrets;
+    stored in json format.
+    """
+    my_app_id, my_app_secret, my_access_token = read_client_secrets(secrets_path)
+    session = FacebookSession(my_app_id, my_app_secret, my_access_token)
+    return FacebookAdsApi(session)
 
 #++++++++++++++++++++
 # MYSQL FUNCTION
 #++++++++++++++++++++
 # NEED TO INCLUDE BOTH TABLE NAME AND CLASS
-def bulk_upsert(session, table, table_name,  df, id_cols):
+def bulk_upsert(session, table, table_name,  df, id_cols, method='merge',
+                chunksize=1000, load_threshold=None, detect_changes=False):
+    """Upsert a dataframe into table and return a dictionary with the
+    number of rows inserted and updated ('upserted' for the chunked
+    statements of method='native', see native_upsert).
+    --------------------------------------------------------------------
+    table: a mapped class (i.e. database table)
+    table_name: the table name associated with table
+    df: dataframe to be converted to a list of dictionaries
+    id_col: a list of the primary keys in the table
+    method: 'merge' reads back the existing primary keys of the account
+            and splits df into bulk updates and bulk inserts;
+            'native' lets the server resolve duplicates with chunked
+            INSERT ... ON DUPLICATE KEY UPDATE statements
+    chunksize: number of rows per statement when method='native'
+    load_threshold: with method='native', dataframes of at least this
+                    many rows are bulk loaded from a staging file
+                    instead (see staged_upsert)
+    detect_changes: for tables with a row_hash column, compare the
+                    hash of every row with the stored one and write
+                    only new and changed rows; the counts then also
+                    include the rows left 'unchanged'
+    """
+    if detect_changes and 'row_hash' in table.__table__.columns:
+        return changed_upsert(session, table, table_name, df, id_cols,
+                              method=method, chunksize=chunksize,
+                              load_threshold=load_threshold)
+    if method == 'native':
+        if load_threshold is not None and len(df.index) >= load_threshold:
+            counts = staged_upsert(session, table, table_name, df)
+        else:
+            counts = native_upsert(session, table, table_name, df,
+                                   chunksize=chunksize)
+    else:
+        counts = merge_upsert(session, table, table_name, df, id_cols)
+    for result, n in counts.items():
+        metrics.count(result, n, table=table_name)
+    return counts
+
+def row_hashes(df, columns):
+    """Hash of the values of columns for every row of df as 16 hex
+    characters. Integers are hashed as int64 and categoricals hash
+    like their values, so compact and regular frames agree.
+    """
+    values = df[columns].copy()
+    for col in columns:
+        if pd.api.types.is_integer_dtype(values[col]):
+            values[col] = values[col].astype('int64')
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    return hashes.map('{:016x}'.format)
+
+def _normalize_keys(df, id_cols):
+    """Key columns in comparable types: ints as int64, dates as
+    YYYY-MM-DD strings and anything else as str.
+    """
+    for col in id_cols:
+        if col == 'date_start':
+            df[col] = pd.to_datetime(df[col].astype(object)).dt.strftime('%Y-%m-%d')
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype('int64')
+        else:
+            df[col] = df[col].astype(str)
+    return df
+
+def read_row_hashes(session, table, df, id_cols):
+    """Stored keys and row_hash of the rows of table that df may
+    update: those of its account and, for insights, its date range.
+    """
+    columns = table.__table__.columns
+    query = select([columns[c] for c in id_cols] + [columns['row_hash']])
+    query = query.where(columns['account_id'] == int(df['account_id'].iloc[0]))
+    if 'date_start' in id_cols:
+        dates = pd.to_datetime(df['date_start'].astype(object))
+        query = query.where(columns['date_start'].between(
+            dates.min().to_pydatetime(), dates.max().to_pydatetime()))
+    rows = session.execute(query).fetchall()
+    stored = pd.DataFrame([tuple(row) for row in rows],
+                          columns=id_cols + ['row_hash'])
+    return _normalize_keys(stored, id_cols)
+
+def changed_upsert(session, table, table_name, df, id_cols,
+                   method='merge', chunksize=1000, load_threshold=None):
+    """Upsert only the rows of df that are new or whose content
+    changed, judged by row_hash (see row_hashes) against the hashes
+    stored for the batch's account and dates. Rows written get their
+    new row_hash.
+    returns: dictionary of rows inserted, updated and unchanged
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    if df.empty:
+        return counts
+    value_columns = [c.name for c in table.__table__.columns
+                     if c.name in df and not c.primary_key
+                     and c.name != 'row_hash']
+    df = df.assign(row_hash=row_hashes(df, value_columns).values)
+
+    with metrics.stage('db_read', table=table_name):
+        stored = read_row_hashes(session, table, df, id_cols)
+    with metrics.stage('merge', table=table_name):
+        keys = _normalize_keys(df[id_cols].copy(), id_cols)
+        keys['new_hash'] = df['row_hash'].values
+        keys = keys.merge(stored, how='left', on=id_cols, indicator=True)
+        # merge keeps the order of the left frame; rows stored before
+        # row_hash existed have a null hash and count as updated
+        new = (keys['_merge'] == 'left_only').values
+        unchanged = (keys['row_hash'] == keys['new_hash']).values
+
+    counts['inserted'] = int(new.sum())
+    counts['unchanged'] = int(unchanged.sum())
+    counts['updated'] = len(df.index) - counts['inserted'] - counts['unchanged']
+    changed = df[~unchanged]
+    if not changed.empty:
+        if method == 'native':
+            if load_threshold is not None and len(changed.index) >= load_threshold:
+                staged_upsert(session, table, table_name, changed)
+            else:
+                native_upsert(session, table, table_name, changed,
+                              chunksize=chunksize)
+        else:
+            merge_upsert(session, table, table_name, changed, id_cols)
+    logger.info(f"{counts['unchanged']} unchanged rows skipped in {table_name}")
+    for result, n in counts.items():
+        metrics.count(result, n, table=table_name)
+    return counts
+
+def merge_upsert(session, table, table_name,  df, id_cols):
     """Perform a bulk insert of the given list of mapping dictionaries.
     The bulk insert feature allows plain Python dictionaries to be used
     as the source of simple INSERT operations which can be more easily
@@ -65,62 +206,301 @@ def bulk_upsert(session, table, table_name,  df, id_cols):
     df: dataframe to be converted to a list of dictionaries
     id_col: a list of the primary keys in the table
     """
-    try:
-        account_id = df.account_id[0] # store the account id for query
-    except IndexError as e:
-        return # dataframe is empty --> occurs when no data for date batch
+    counts = {'inserted': 0, 'updated': 0}
+    if df.empty:
+        return counts # dataframe is empty --> occurs when no data for date batch
+    account_id = df['account_id'].iloc[0] # store the account id for query
     primary_keys = ",".join(id_cols) # join PKs in string for query
-    query = "SELECT " + primary_keys + " FROM " + table_name + " WHERE account_id = '" + str(account_id) + "';"
+    query = "SELECT " + primary_keys + " FROM " + table_name + " WHERE account_id = '" + str(account_id) + "'"
 
     if 'date_start' in df:
-        df['date_start'] = pd.to_datetime(df['date_start'])
+        # categorical in compact frames; merged against datetimes
+        df['date_start'] = pd.to_datetime(df['date_start'].astype(object))
+    if 'date_start' in id_cols:
+        # only read the batch's dates (and partitions) of insights tables
+        first = df['date_start'].min().strftime("%Y-%m-%d")
+        end = (df['date_start'].max() + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        query += (" AND date_start >= '" + first + "'"
+                  + " AND date_start < '" + end + "'")
+    query += ";"
 
     # store df of rows that exist in db and should be updated
-    update_df = pd.read_sql_query(query, session.bind)
-    merged_df = pd.merge(df, update_df, how='left', indicator=True)
-    update_df = merged_df[merged_df['_merge']=='both'] # both exist
-    update_df = update_df.drop(columns=['_merge'])
-    # workaround for nans
-    update_df = update_df.where(pd.notnull(update_df), None)
-
-    # store df of rows that do not exist
-    insert_df = merged_df[merged_df['_merge']=='left_only']
-    insert_df = insert_df.drop(columns=['_merge'])
-    # workaround for nans
-    insert_df = insert_df.where(pd.notnull(insert_df), None)
-
-    # after merge, the dataframes used as inputs for upserts
-    # must be converted back to string objects, else
-    # value error with timestamp...
-    if 'date_start' in update_df:
-        update_df['date_start'] = update_df['date_start'].astype(str)
-        insert_df['date_start'] = insert_df['date_start'].astype(str)
-
-    if not update_df.empty:
-        num_updated = len(update_df.index)
-        update_df = update_df.to_dict(orient="records")
-        session.bulk_update_mappings(
-            table,
-            update_df
-        )
-        logger.info(f'{num_updated} rows updated in {table_name}')
-    if not insert_df.empty:
-        num_inserted = len(insert_df.index)
-        num_inserted
-        insert_df = insert_df.to_dict(orient="records")
-        # insert any records that do not already exist in db
-        session.bulk_insert_mappings(
-            table,
-            insert_df,
-            render_nulls=True
-        )
-        logger.info(f'{num_inserted} rows inserted in {table_name}')
+    with metrics.stage('db_read', table=table_name):
+        update_df = pd.read_sql_query(query, session.bind,
+                                      parse_dates=[c for c in id_cols
+                                                   if c == 'date_start'])
+    with metrics.stage('merge', table=table_name):
+        merged_df = pd.merge(df, update_df, how='left', indicator=True)
+        update_df = merged_df[merged_df['_merge']=='both'] # both exist
+        update_df = update_df.drop(columns=['_merge'])
+        # workaround for nans
+        update_df = update_df.where(pd.notnull(update_df), None)
+
+        # store df of rows that do not exist
+        insert_df = merged_df[merged_df['_merge']=='left_only']
+        insert_df = insert_df.drop(columns=['_merge'])
+        # workaround for nans
+        insert_df = insert_df.where(pd.notnull(insert_df), None)
+
+        # after merge, the dataframes used as inputs for upserts
+        # must be converted back to string objects, else
+        # value error with timestamp...
+        if 'date_start' in update_df:
+            update_df['date_start'] = update_df['date_start'].astype(str)
+            insert_df['date_start'] = insert_df['date_start'].astype(str)
+
+    with metrics.stage('db_write', table=table_name):
+        if not update_df.empty:
+            num_updated = len(update_df.index)
+            update_df = update_df.to_dict(orient="records")
+            session.bulk_update_mappings(
+                table,
+                update_df
+            )
+            counts['updated'] = num_updated
+            logger.info(f'{num_updated} rows updated in {table_name}')
+        if not insert_df.empty:
+            num_inserted = len(insert_df.index)
+            insert_df = insert_df.to_dict(orient="records")
+            # insert any records that do not already exist in db
+            session.bulk_insert_mappings(
+                table,
+                insert_df,
+                render_nulls=True
+            )
+            counts['inserted'] = num_inserted
+            logger.info(f'{num_inserted} rows inserted in {table_name}')
+        session.commit()
+    return counts
+
+def native_upsert(session, table, table_name, df, chunksize=1000):
+    """Write df with multi-row INSERT ... ON DUPLICATE KEY UPDATE
+    statements of at most chunksize rows. Nothing is read back from
+    the table, so the cost depends only on the size of df.
+    The rows are counted as 'upserted': the affected row counts MySQL
+    reports cannot tell an inserted row from an unchanged one (both
+    count 1 with the FOUND_ROWS client flag the pymysql dialect sets,
+    and an insert and an unchanged row count 1 and 0 without it while
+    an update counts 2).
+    --------------------------------------------------------------------
+    table: a mapped class (i.e. database table)
+    table_name: the table name associated with table
+    df: dataframe to be upserted
+    chunksize: number of rows per INSERT statement
+    """
+    counts = {'upserted': 0}
+    if df.empty:
+        return counts # occurs when no data for date batch
+    # only columns that exist in the table can be rendered
+    # (e.g. campaign_name is requested but not stored in ads_insights)
+    columns = [c.name for c in table.__table__.columns if c.name in df]
+    update_columns = [c for c in columns
+                      if not table.__table__.columns[c].primary_key]
+    df = df[columns]
+    if 'date_start' in df:
+        df = df.assign(date_start=df['date_start'].astype(str))
+
+    with metrics.stage('db_write', table=table_name):
+        for i in range(0, len(df.index), chunksize):
+            # only one chunk at a time is converted to python objects
+            chunk = df.iloc[i:i + chunksize]
+            # workaround for nans
+            chunk = chunk.astype(object).where(pd.notnull(chunk), None)
+            chunk = chunk.to_dict(orient="records")
+            stmt = insert(table.__table__).values(chunk)
+            if update_columns:
+                stmt = stmt.on_duplicate_key_update(
+                    {c: stmt.inserted[c] for c in update_columns}
+                )
+            else:
+                # key-only table: keep the existing row
+                key = columns[0]
+                stmt = stmt.on_duplicate_key_update({key: stmt.inserted[key]})
+            session.execute(stmt)
+            counts['upserted'] += len(chunk)
+        session.commit()
+    logger.info(f"{counts['upserted']} rows inserted or updated in {table_name}")
+    return counts
+
+def write_staging_file(df, path):
+    """Write df as csv in the format staged_upsert loads: missing
+    values as \\N and backslashes in strings escaped.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object or str(df[col].dtype) == 'category':
+            df[col] = df[col].map(
+                lambda v: v.replace('\\', '\\\\') if isinstance(v, str) else v
+            )
+    df.to_csv(path, index=False, header=False, na_rep='\\N',
+              quoting=csv.QUOTE_MINIMAL, quotechar='"', doublequote=True)
+
+def load_staging_file(session, table_name, path, columns, update_columns):
+    """Load the csv at path into a temporary copy of table_name and
+    merge it into table_name with one INSERT ... SELECT ... ON
+    DUPLICATE KEY UPDATE.
+    returns: dictionary of rows inserted and updated
+    """
+    staging_table = 'staging_' + table_name
+    cols = ", ".join(columns)
+    connection = session.connection()
+    connection.execute(text(f"DROP TEMPORARY TABLE IF EXISTS {staging_table}"))
+    # a plain (unpartitioned, keyless) table with the target's columns
+    connection.execute(text(
+        f"CREATE TEMPORARY TABLE {staging_table} "
+        f"SELECT {cols} FROM {table_name} LIMIT 0"
+    ))
+    connection.execute(text(
+        f"LOAD DATA LOCAL INFILE :path INTO TABLE {staging_table} "
+        "CHARACTER SET utf8mb4 "
+        "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+        "ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+        f"({cols})"
+    ), path=os.path.abspath(path))
+    updates = ", ".join(f"{c} = VALUES({c})" for c in update_columns)
+    if not updates:
+        updates = f"{columns[0]} = {columns[0]}"
+    result = connection.execute(text(
+        f"INSERT INTO {table_name} ({cols}) "
+        f"SELECT {cols} FROM {staging_table} "
+        f"ON DUPLICATE KEY UPDATE {updates}"
+    ))
+    rows = connection.execute(text(f"SELECT COUNT(*) FROM {staging_table}")).scalar()
+    connection.execute(text(f"DROP TEMPORARY TABLE {staging_table}"))
     session.commit()
+    # affected rows: 1 per inserted row, 2 per updated row
+    num_updated = max(result.rowcount - rows, 0)
+    return {'inserted': rows - num_updated, 'updated': num_updated}
+
+def staged_upsert(session, table, table_name, df, staging_dir=STAGING_DIR,
+                  retries=2):
+    """Upsert a large dataframe with LOAD DATA LOCAL INFILE: df is
+    written to a csv file in staging_dir, loaded into a temporary
+    staging table and merged into the target in one set based
+    statement. The merge is idempotent, so on a database error the
+    load is rolled back and retried up to retries times. The file is
+    removed afterwards in any case.
+    --------------------------------------------------------------------
+    table: a mapped class (i.e. database table)
+    table_name: the table name associated with table
+    df: dataframe to be upserted
+    """
+    counts = {'inserted': 0, 'updated': 0}
+    if df.empty:
+        return counts # occurs when no data for date batch
+    columns = [c.name for c in table.__table__.columns if c.name in df]
+    update_columns = [c for c in columns
+                      if not table.__table__.columns[c].primary_key]
+    df = df[columns]
+    if 'date_start' in df:
+        df = df.assign(date_start=df['date_start'].astype(str))
+
+    os.makedirs(staging_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=table_name + '_', suffix='.csv',
+                                dir=staging_dir)
+    os.close(fd)
+    try:
+        with metrics.stage('db_write', table=table_name):
+            write_staging_file(df, path)
+            attempt = 0
+            while True:
+                try:
+                    counts = load_staging_file(session, table_name, path,
+                                               columns, update_columns)
+                    break
+                except DBAPIError:
+                    session.rollback()
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    logger.warning(f'staged load of {table_name} failed; '
+                                   f'retry {attempt} of {retries}')
+    finally:
+        os.remove(path)
+    logger.info(f"{counts['updated']} rows updated in {table_name}")
+    logger.info(f"{counts['inserted']} rows inserted in {table_name}")
+    return counts
+
+# (actions table, account id) -> whether the account has entries in
+# the actions table, i.e. was loaded with the narrow layout; checked
+# once per process so wide loads only delete entries when there are
+_narrow_accounts = {}
+_narrow_lock = threading.Lock()
+
+def has_narrow_entries(session, table, account_id):
+    """Whether the actions table (a mapped class) has entries of
+    account_id; the database is asked once per process
+    """
+    key = (table.__tablename__, int(account_id))
+    with _narrow_lock:
+        if key in _narrow_accounts:
+            return _narrow_accounts[key]
+    found = session.query(
+        session.query(table).filter(table.account_id == key[1]).exists()
+    ).scalar()
+    with _narrow_lock:
+        # write_actions may have marked the account meanwhile
+        return _narrow_accounts.setdefault(key, found)
+
+def write_actions(session, table, table_name, keys, actions, chunksize=1000):
+    """Replace the stored actions of the insights rows in keys with
+    actions (see melt_actions): rows whose actions dropped to zero
+    must not keep old entries, so the entries of every key are
+    deleted before the new ones are inserted.
+    table: the mapped class of the actions table
+    keys: dataframe of the primary keys of the insights rows
+    actions: dataframe of keys, action, attribution_window, value
+    --> returns the number of entries written
+    """
+    key_cols = list(keys.columns)
+    keys = keys.astype(object)
+    if 'date_start' in keys:
+        keys['date_start'] = pd.to_datetime(keys['date_start']).dt.to_pydatetime()
+    key_values = [tuple(row) for row in keys.itertuples(index=False)]
+    columns = table.__table__.columns
+    with metrics.stage('db_write', table=table_name):
+        for i in range(0, len(key_values), chunksize):
+            session.execute(table.__table__.delete().where(
+                tuple_(*[columns[c] for c in key_cols]).in_(
+                    key_values[i:i + chunksize])))
+        if not actions.empty:
+            with _narrow_lock:
+                for account_id in actions['account_id'].unique():
+                    _narrow_accounts[(table.__tablename__,
+                                      int(account_id))] = True
+            actions = actions.astype(object)
+            if 'date_start' in actions:
+                actions['date_start'] = actions['date_start'].astype(str)
+            records = actions.to_dict(orient='records')
+            for i in range(0, len(records), chunksize):
+                session.execute(table.__table__.insert(),
+                                records[i:i + chunksize])
+        session.commit()
+    logger.info(f'{len(actions.index)} action entries written to {table_name}')
+    metrics.count('inserted', len(actions.index), table=table_name)
+    return len(actions.index)
 
 #++++++++++++++++++++++++
 # DATAFRAME FUNCTIONS
 #++++++++++++++++++++++++
 
+ATTRIBUTION_WINDOWS = ['1d_view', '7d_view', '28d_view',
+                       '1d_click', '7d_click', '28d_click']
+
+# (nested column, action type, base column name) of every action
+# extracted from the insights rows; configured in columns/actions.json
+ACTIONS_CONFIG = 'database/columns/actions.json'
+
+@functools.lru_cache(maxsize=None)
+def configured_actions(path=ACTIONS_CONFIG):
+    """(field, action_type, name) of every entry of the actions
+    config, e.g. ('actions', 'omni_purchase', 'purchase'); the file is
+    read once per process
+    """
+    with open(path) as f:
+        return tuple((a['field'], a['action_type'], a['name'])
+                     for a in json.load(f))
+
 def find(lst, key, value):
     """
     lst: a list of dictionaries
@@ -157,136 +537,244 @@ def attribution_windows(df, nested_col, action_type, col):
     that contains all the data we wish to pull.
     col is the base name of column (e.g. purchases)
     """
-    windows = ['1d_view', '7d_view', '28d_view',
-               '1d_click', '7d_click', '28d_click']
-    for win in windows:
+    columns = {}
+    for win in ATTRIBUTION_WINDOWS:
         new_colname = col + '_' + win
-        df[new_colname] = pd.to_numeric(
+        columns[new_colname] = pd.to_numeric(
             df[nested_col].apply(
                 extract_col, action_type=action_type,
                 attr_window=win
             )
         )
-    return df
+    return add_columns(df, columns)
 
-def transform(df):
+def add_columns(df, columns):
+    """df with the series of columns (name -> series) attached in one
+    concat, replacing columns of the same name; inserting them one
+    at a time fragments the frame (PerformanceWarning on pandas 1.3+)
+    """
+    if not columns:
+        return df
+    new = pd.DataFrame(columns, index=df.index)
+    return pd.concat([df.drop(columns=[c for c in columns if c in df]),
+                      new], axis=1)
+
+def index_actions(lst):
+    """lst: a list of action dictionaries (or a missing value)
+    returns: dictionary of action_type -> action dictionary, keeping
+    the first occurrence of each action type like find does
+    """
+    if type(lst) != list:
+        return {}
+    index = {}
+    for dic in lst:
+        index.setdefault(dic['action_type'], dic)
+    return index
+
+def flatten_actions(df, action_columns=None,
+                    windows=ATTRIBUTION_WINDOWS, downcast=None):
+    """(pandas df, list, list) -> pandas df
+    Columnar equivalent of calling attribution_windows once per
+    entry of action_columns: each nested column is parsed a single
+    time into per-row lookups, then every (action type, window)
+    column is filled from those lookups. Output matches
+    attribution_windows column for column.
+    downcast: passed to pd.to_numeric ('integer' stores counts in
+    the smallest integer type that holds them)
+    """
+    if action_columns is None:
+        action_columns = configured_actions()
+    if df.empty:
+        # nothing to parse; keep the dtypes attribution_windows
+        # produces for empty frames
+        for nested_col, action_type, col in action_columns:
+            df = attribution_windows(df, nested_col, action_type, col)
+        return df
+    parsed = {}
+    for nested_col, _, _ in action_columns:
+        if nested_col not in parsed:
+            parsed[nested_col] = [index_actions(lst) for lst in df[nested_col]]
+    columns = {}
+    for nested_col, action_type, col in action_columns:
+        # only the values that are present are parsed; the rest are 0
+        present = {win: ([], []) for win in windows}
+        for position, index in enumerate(parsed[nested_col]):
+            action = index.get(action_type)
+            if action is None:
+                continue
+            for win in windows:
+                if win in action:
+                    present[win][0].append(position)
+                    present[win][1].append(action[win])
+        for win in windows:
+            positions, values = present[win]
+            if values:
+                values = pd.to_numeric(pd.Series(values, dtype=object))
+                column = np.zeros(len(df.index), dtype=values.dtype)
+                column[positions] = values.to_numpy()
+            else:
+                column = np.zeros(len(df.index), dtype='int64')
+            column = pd.Series(column, index=df.index)
+            if downcast is not None:
+                column = pd.to_numeric(column, downcast=downcast)
+            columns[col + '_' + win] = column
+    return add_columns(df, columns)
+
+def transform(df, compact=False):
     """ Function to extract common columns and perform
     some manipulations (Transform stage)
     <-- takes a pandas dataframe
+    compact: store the action counts in the smallest integer type
+    that holds them (see compact_dtypes)
     --> returns pandas dataframe
     """
-    # Landing Page View
-    df = attribution_windows(df, 'actions', 'landing_page_view', 'landing_page_view')
-    # Link Click
-    df = attribution_windows(df, 'actions', 'link_click', 'link_click')
-    # Posts
-    df = attribution_windows(df, 'actions', 'post', 'post')
-    # Page Engagement
-    df = attribution_windows(df, 'actions', 'page_engagement', 'page_engagement')
-    # Post Engagement
-    df = attribution_windows(df, 'actions', 'post_engagement', 'post_engagement')
-    # Add to cart
-    df = attribution_windows(df, 'actions', 'omni_add_to_cart', 'add_to_cart')
-    # Initiated Checkout
-    df = attribution_windows(df, 'actions', 'omni_initiated_checkout', 'checkout')
-    # Activate App
-    df = attribution_windows(df, 'actions', 'omni_activate_app', 'app_starts')
-    # App registrations
-    df = attribution_windows(df, 'actions', 'omni_complete_registration', 'complete_registrations')
-    # App Installs
-    df = attribution_windows(df, 'actions', 'omni_app_install', 'app_install')
-    # Purchase
-    df = attribution_windows(df, 'actions', 'omni_purchase', 'purchase')
-
-    # Renter Complete Registration
-    df = attribution_windows(df, 'actions', 'offsite_conversion.custom.264800584268286', 'renter_complete_registration')
-    # Renter Booking Sent
-    df = attribution_windows(df, 'actions', 'offsite_conversion.custom.155619705306328', 'renter_booking_sent')
-    # Owner Listed
-    df = attribution_windows(df, 'actions', 'offsite_conversion.custom.2038839149667048', 'owner_listed')
-    # Owner Complete Registration
-    df = attribution_windows(df, 'actions', 'offsite_conversion.custom.1816163992024268', 'owner_complete_registration')
-
-
-    # CONVERSION VALUES
-
-    # Purchase
-    df = attribution_windows(df, 'action_values', 'omni_purchase', 'purchase_value')
+    # one pass over actions/action_values for all columns
+    # listed in the actions config
+    df = flatten_actions(df, downcast='integer' if compact else None)
 
     # drop actions column
     df = df.drop(columns=['actions', 'action_values'])
     return df
 
+def melt_actions(df, id_cols, actions=None, windows=ATTRIBUTION_WINDOWS):
+    """Long format of the actions and action_values of df (the
+    narrow alternative to transform): one row per key, action and
+    attribution window with a non-zero value.
+    id_cols: the key columns of df repeated on every row
+    actions: (field, action_type, name) entries; the actions config
+    if None
+    --> returns pandas df of id_cols, action (the configured name),
+    attribution_window and value
+    """
+    if actions is None:
+        actions = configured_actions()
+    parsed = {}
+    for field, _, _ in actions:
+        if field not in parsed:
+            parsed[field] = [index_actions(lst) for lst in df[field]]
+    positions, names, wins, values = [], [], [], []
+    for field, action_type, name in actions:
+        for position, index in enumerate(parsed[field]):
+            action = index.get(action_type)
+            if action is None:
+                continue
+            for win in windows:
+                value = float(action.get(win, 0))
+                if value:
+                    positions.append(position)
+                    names.append(name)
+                    wins.append(win)
+                    values.append(value)
+    long_df = df[id_cols].iloc[positions].reset_index(drop=True)
+    long_df['action'] = names
+    long_df['attribution_window'] = wins
+    long_df['value'] = values
+    return long_df
+
 #+++++++++++++++++++++++
 # FACEBOOK API REQUESTS
 #+++++++++++++++++++++++
 
-def get_request(account_id, table, params, fields):
+def get_request(account_id, table, params, fields, api=None):
     """account_id: unique id for ad account in format act_<ID>
-    table: The table object found in the models module
+    table: name of a table in the registry (see tables.TABLES)
     params: dictionary of parameters for request
     fields: list of fields for request
+    api: FacebookAdsApi to use; the default api if None
     --> returns requested data from Facebook Marketing API
     """
-    my_account = AdAccount(account_id)
-    if table == 'accounts':
+    spec = TABLES[table]
+    my_account = AdAccount(account_id, api=api)
+    if spec.insights:
+        # a single async report job; see get_insights_requests
+        # for submitting many date ranges at once
+        params = dict(params)
+        time_range = params.pop('time_range')
+        manager = ReportJobManager(account_id, params=params,
+                                   fields=fields, api=api, table=table)
+        for _, request in manager.run([time_range]):
+            return request
+    if spec.edge is None:
+        # the ad account object itself
         cursor = my_account.api_get(params=params,
                                     fields=fields)
         return dict(cursor)
-    if table == 'campaigns':
-        cursor = my_account.get_campaigns(params=params,
-                                          fields=fields)
-        request = [campaign for campaign in cursor]
-        return  request
-    if table == 'adsets':
-        request = my_account.get_ad_sets(params=params,
-                                        fields=fields)
-        return request
-    if table == 'ads_insights':
-        cursor = my_account.get_insights_async(params=params,
-                                               fields=fields)
-        cursor.api_get()
-        while cursor[AdReportRun.Field.async_status] != "Job Completed":
-            time.sleep(1)
-            cursor.api_get()
-            time.sleep(1)
-        request = cursor.get_result(params={"limit": 1000})
-        return request
-    if table == 'ads_insights_age_and_gender':
-        cursor = my_account.get_insights_async(params=params,
-                                               fields=fields)
-        cursor.api_get()
-        while cursor[AdReportRun.Field.async_status] != "Job Completed":
-            time.sleep(1)
-            cursor.api_get()
-            time.sleep(1)
-        request = cursor.get_result(params={"limit": 1000})
-        return request
-    if table == 'ads_insights_region':
-        cursor = my_account.get_insights_async(params=params,
-                                               fields=fields)
-        cursor.api_get()
-        while cursor[AdReportRun.Field.async_status] != "Job Completed":
-            time.sleep(1)
-            cursor.api_get()
-            time.sleep(1)
-        request = cursor.get_result(params={"limit": 1000})
-        return request
+    # a cursor over the records of the edge, e.g. get_campaigns
+    return getattr(my_account, spec.edge)(params=params, fields=fields)
+
+def get_insights_requests(account_id, table, params, fields,
+                          time_ranges, max_in_flight=4, api=None,
+                          split=None, on_split=None, stop=None):
+    """account_id: unique id for ad account in format act_<ID>
+    table: one of the insights tables
+    params: dictionary of parameters for request (time_range is
+    taken from time_ranges)
+    fields: list of fields for request
+    time_ranges: list of {'since', 'until'} dictionaries, e.g. from
+    SlicePlanner.plan
+    max_in_flight: number of report jobs running at the same time
+    api: FacebookAdsApi to use; the default api if None
+    split, on_split: split failing ranges (see ReportJobManager)
+    stop: threading.Event ending the polling (see ReportJobManager)
+    --> generator of (time_range, request) as report jobs complete
+    """
+    if not TABLES[table].insights:
+        raise ValueError(f'{table} is not an insights table')
+    params = {k: v for k, v in params.items() if k != 'time_range'}
+    manager = ReportJobManager(account_id, params=params, fields=fields,
+                               max_in_flight=max_in_flight, api=api,
+                               table=table, split=split, on_split=on_split,
+                               stop=stop)
+    return manager.run(time_ranges)
 
 #++++++++++++++++++++++++++++++++++++++++
 # | UPSERTING REQUEST DATA TO DATABASE
 #++++++++++++++++++++++++++++++++++++++++
 
-def request_to_database(request, table, engine):
-    """Take a facebook api request, load data into a
-    pandas dataframe, perform column operations for
-    specified table and upsert into mysql database.
-    table: database table name as type: str
-    engine: database engine
+# object columns that repeat from row to row within a report
+# (names, days, currency); categoricals in compact frames
+COMPACT_CATEGORIES = ['date_start', 'account_name', 'campaign_name',
+                      'adset_name', 'ad_name', 'account_currency']
+
+def compact_dtypes(dtypes):
+    """dtypes with the COMPACT_CATEGORIES columns as categoricals"""
+    return {col: 'category' if col in COMPACT_CATEGORIES else dtype
+            for col, dtype in dtypes.items()}
+
+def downcast_integers(df):
+    """Store every int64 column of df in the smallest integer type
+    that holds its values (checked per frame, so it is always safe).
+    Floats keep float64: spend and values need the precision.
     """
-    # read json file containing datatype info
+    for col in df.columns:
+        if df[col].dtype == 'int64':
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+@functools.lru_cache(maxsize=None)
+def _read_dtypes(table):
     with open('database/columns/' + table + '.json') as f:
-        dtypes = json.load(f)
+        return json.load(f)
+
+def column_dtypes(table):
+    """dtype of each column of table from columns/<table>.json; the
+    file is read once per process
+    """
+    return dict(_read_dtypes(table))
+
+def build_frame(request, table, dtypes=None, compact=False):
+    """Load the records of a facebook api request (or a chunk of
+    them) into a pandas dataframe with the dtypes of
+    columns/<table>.json.
+    table: database table name as type: str
+    dtypes: the dtype mapping, read from the json file if None
+    compact: repeated strings as categoricals and integers downcast
+    (see compact_dtypes and downcast_integers)
+    """
+    if dtypes is None:
+        dtypes = column_dtypes(table)
+    if compact:
+        dtypes = compact_dtypes(dtypes)
     columns = list(dtypes.keys()) # create lost of colnames
 
     """[bug report] must treat accounts df creation separately for now
@@ -296,7 +784,7 @@ def request_to_database(request, table, engine):
     """
     # create temporary dataframe objects in order to
     # use pandas library
-    if table == 'accounts':
+    if isinstance(request, dict):
          df = pd.DataFrame(request,
                            columns = columns,
                            index=[0]
@@ -305,147 +793,404 @@ def request_to_database(request, table, engine):
         df = pd.DataFrame(request,
                           columns = columns
                           ).astype(dtype=dtypes)
+    if compact:
+        df = downcast_integers(df)
+    return df
+
+def iter_chunks(request, chunksize):
+    """Yield lists of at most chunksize records from request. A
+    cursor only fetches its next page when the records of the
+    current page have been taken.
+    """
+    iterator = iter(request)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def prefetch(iterable, depth=1):
+    """Generator over iterable that produces up to depth items ahead
+    in a background thread, so the next page is fetched while the
+    current one is processed. Errors of the background thread are
+    raised in the caller. When the caller stops early (an error or
+    close) the thread stops before its next item and is joined.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)) or stop.is_set():
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            # a generator cleans up in this thread, not when collected
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        # let a blocked put return at once
+        while not items.empty():
+            items.get_nowait()
+        thread.join()
+
+def spill_chunks(chunks, key, max_rows, land=None):
+    """Generator over the records of chunks regrouped into partitions
+    of at most max_rows records by a hash of key (see spill.py). A
+    request of a single chunk is passed on as it is, without writing
+    it to disk.
+    land: called with each chunk before it is spilled
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return
+    if land is not None:
+        land(first)
+    second = next(chunks, None)
+    if second is None:
+        yield first
+        return
+    with Spill(key, max_rows=max_rows) as spill:
+        with metrics.stage('spill'):
+            spill.add(first)
+        del first
+        for chunk in itertools.chain([second], chunks):
+            if land is not None:
+                land(chunk)
+            with metrics.stage('spill'):
+                spill.add(chunk)
+        logger.info(f'{len(spill)} rows spilled to {spill.directory}')
+        yield from spill.partitions()
+
+def request_to_database(request, table, engine, method='merge',
+                        chunksize=None, load_threshold=None, compact=False,
+                        detect_changes=False, land=None, actions_layout='wide'):
+    """Take a facebook api request, load data into a
+    pandas dataframe, perform column operations for
+    specified table and upsert into mysql database.
+    table: database table name as type: str
+    engine: database engine
+    method: upsert method passed to bulk_upsert ('merge' or 'native')
+    chunksize: for the insights tables, stream the request in chunks
+    of this many rows (filtered, transformed and upserted one at a
+    time) instead of building one dataframe for the whole request;
+    for out_of_core tables (see tables.TableSpec) the most rows of a
+    spilled partition loaded at once
+    load_threshold: passed to bulk_upsert
+    compact: build memory compact frames (see build_frame)
+    detect_changes: passed to bulk_upsert
+    land: called with each page of records before it is loaded, e.g.
+    a LandingZone writer (see landing.py)
+    actions_layout: passed to load_frame
+    --> returns the number of records in request
+    """
+    dtypes = column_dtypes(table)
 
-    # build session with MySQL
-    Session = sessionmaker(bind=engine)
+    # build session with MySQL from the process wide factory
+    Session = session_factory(engine)
     session = Session()
-    # dataframes inserted or updated into database
-    if table == 'accounts':
-        df.rename(columns={'name': 'account_name'},
-                  inplace=True)
-        bulk_upsert(session, table=AccountsTable,
-                    table_name='accounts',
-                    df = df, id_cols=['account_id'])
-
-    if table == 'campaigns':
-        # must rename these columns due to Field class attributes
-        # from parent Campaign (see facebook-business)
-        df.rename(columns={'id': 'campaign_id',
-                           'name': 'campaign_name'},
-                  inplace=True)
-        # nans throw errors so swap with None
-        df = df.where(pd.notnull(df), None)
-        bulk_upsert(session, table=CampaignsTable,
-                    table_name='campaigns',
-                   df=df, id_cols=['account_id', 'campaign_id'])
-
-    if table == 'adsets':
-        df.rename(columns={'id': 'adset_id',
-                           'name': 'adset_name'},
-                  inplace=True)
-        df = df.where(pd.notnull(df), None)
-        bulk_upsert(session, table=AdSetsTable,
-                    table_name='adsets',
-                    df=df, id_cols=['adset_id', 'account_id',
-                                    'campaign_id'])
-
-    if table == 'ads_insights':
-        # campaign id may refer to a deleted campaign which
-        # is not contained in the Campaigns table of the database
-        # we keep only those ids which are;
-        campaign_ids = session.query(CampaignsTable.campaign_id)
-        campaign_ids = [i for i, in campaign_ids]
-        # this also happens with deleted adsets
-        adset_ids = session.query(AdSetsTable.adset_id)
-        adset_ids = [i for i, in adset_ids]
-
-        missing_campaign = df.loc[df['campaign_id'].isin(campaign_ids)==False, :]
-        n = len(missing_campaign.index)
-        if n > 0:
-            logger.warning(f"{n} rows  will not be synced | deleted campaign")
-            df = df.loc[df['campaign_id'].isin(campaign_ids), :]
+    rows = 0
+    with metrics.labels(table=table):
+        if chunksize is None or not TABLES[table].insights:
+            if not isinstance(request, (dict, list)):
+                # a cursor fetches its pages while it is read
+                with metrics.stage('download'):
+                    request = list(request)
+            if land is not None:
+                land([request] if isinstance(request, dict) else request)
+            with metrics.stage('build_frame'):
+                df = build_frame(request, table, dtypes, compact=compact)
+            rows += len(df.index)
+            load_frame(df, table, session, method=method,
+                       load_threshold=load_threshold, compact=compact,
+                       detect_changes=detect_changes,
+                       actions_layout=actions_layout)
+        elif TABLES[table].out_of_core:
+            # pages are downloaded in the prefetch thread; every copy
+            # of a key is in the same partition, so each partition is
+            # deduplicated and loaded on its own
+            chunks = metrics.timed(iter_chunks(request, chunksize), 'download')
+            for records in spill_chunks(prefetch(chunks),
+                                        TABLES[table].id_cols,
+                                        max_rows=chunksize, land=land):
+                with metrics.stage('build_frame'):
+                    df = build_frame(records, table, dtypes, compact=compact)
+                del records
+                rows += len(df.index)
+                load_frame(df, table, session, method=method,
+                           load_threshold=load_threshold, compact=compact,
+                           detect_changes=detect_changes,
+                           actions_layout=actions_layout)
+        else:
+            # pages are downloaded in the prefetch thread
+            chunks = metrics.timed(iter_chunks(request, chunksize), 'download')
+            for chunk in prefetch(chunks):
+                if land is not None:
+                    land(chunk)
+                with metrics.stage('build_frame'):
+                    df = build_frame(chunk, table, dtypes, compact=compact)
+                rows += len(df.index)
+                load_frame(df, table, session, method=method,
+                           load_threshold=load_threshold, compact=compact,
+                           detect_changes=detect_changes,
+                           actions_layout=actions_layout)
+    session.close()
+    return rows
 
-        missing_adset = df.loc[df['adset_id'].isin(adset_ids)==False, :]
-        n = len(missing_adset.index)
-        if n > 0:
-            logger.warning(f"{n} rows will not be synced | deleted adset")
-            df = df.loc[df['adset_id'].isin(adset_ids), :]
-        df = transform(df)
-        bulk_upsert(session, table=AdsInsightsTable,
-                    table_name='ads_insights',
-                    df=df, id_cols=['ad_id', 'account_id',
-                                    'campaign_id', 'adset_id',
-                                    'date_start'])
-
-    if table == 'ads_insights_age_and_gender':
-        campaign_ids = session.query(CampaignsTable.campaign_id)
-        campaign_ids = [i for i, in campaign_ids]
-        adset_ids = session.query(AdSetsTable.adset_id)
-        adset_ids = [i for i, in adset_ids]
-        df = df.loc[df['campaign_id'].isin(campaign_ids), :]
-        df = df.loc[df['adset_id'].isin(adset_ids), :]
-        df = transform(df)
-        bulk_upsert(session, table=AdsInsightsAgeGenderTable,
-                    table_name='ads_insights_age_and_gender',
-                    df=df, id_cols=['ad_id', 'account_id',
-                                    'campaign_id', 'adset_id',
-                                    'date_start', 'age', 'gender'])
-
-    if table == 'ads_insights_region':
-        campaign_ids = session.query(CampaignsTable.campaign_id)
-        campaign_ids = [i for i, in campaign_ids]
-        adset_ids = session.query(AdSetsTable.adset_id)
-        adset_ids = [i for i, in adset_ids]
+def batch_name(key):
+    """batch label of a key of requests_to_database, e.g.
+    2019-09-01_2019-09-07 for a time range (names profiles, see
+    profiling.py)
+    """
+    if isinstance(key, dict) and 'since' in key:
+        return f"{key['since']}_{key['until']}"
+    return str(key)
+
+def requests_to_database(requests, table, engine, method='merge',
+                         chunksize=50000, load_threshold=None, compact=False,
+                         detect_changes=False, land=None,
+                         actions_layout='wide', depth=PIPELINE_DEPTH,
+                         context=None, stop=None):
+    """Pipelined request_to_database for a sequence of requests of an
+    insights table, e.g. the report jobs of get_insights_requests.
+    The pages of the requests are downloaded, framed and transformed,
+    and written in three stages running at the same time (see
+    pipeline.py), so the write of one chunk overlaps the download of
+    the next.
+    requests: iterable of (key, request) pairs, e.g. (time_range,
+    cursor)
+    land: function of a key returning the page writer of its request
+    (see request_to_database), or None
+    depth: chunks waiting between two stages
+    context, stop: passed to run_pipeline; pass the stop event of
+    get_insights_requests so a stopped pipeline ends the polling
+    other arguments: see request_to_database
+    --> generator of (key, number of records) once every record of
+    the key's request was written
+    """
+    spec = TABLES[table]
+    dtypes = column_dtypes(table)
+    Session = session_factory(engine)
+    # one session per stage thread
+    sessions = {'transform': Session(), 'write': Session()}
+
+    def download():
+        for key, request in requests:
+            writer = land(key) if land is not None else None
+            with metrics.labels(batch=batch_name(key)):
+                chunks = metrics.timed(iter_chunks(request, chunksize),
+                                       'download')
+                if spec.out_of_core:
+                    chunks = spill_chunks(chunks, spec.id_cols,
+                                          max_rows=chunksize, land=writer)
+                # the last chunk of a request completes its key
+                previous = None
+                for chunk in chunks:
+                    if writer is not None and not spec.out_of_core:
+                        writer(chunk)
+                    if previous is not None:
+                        yield key, previous, False
+                    previous = chunk
+                yield key, previous or [], True
+
+    def prepare(item):
+        key, records, last = item
+        if not records:
+            return key, None, 0, last
+        with metrics.labels(batch=batch_name(key)):
+            with metrics.stage('build_frame'):
+                df = build_frame(records, table, dtypes, compact=compact)
+            frame = prepare_frame(df, table, sessions['transform'],
+                                  compact=compact,
+                                  actions_layout=actions_layout)
+        # the transform session only reads (filter_deleted); its
+        # connection goes back to the pool until the next chunk
+        sessions['transform'].commit()
+        return key, frame, len(df.index), last
+
+    def write(item):
+        key, frame, rows, last = item
+        if frame is not None:
+            with metrics.labels(batch=batch_name(key)):
+                write_frame(frame, table, sessions['write'], method=method,
+                            load_threshold=load_threshold,
+                            detect_changes=detect_changes)
+            # ends the read of has_narrow_entries as well
+            sessions['write'].commit()
+        return key, rows, last
+
+    # the stage threads count under the caller's labels
+    labels = dict(metrics.current_labels(), table=table)
+
+    def stage_context():
+        stack = contextlib.ExitStack()
+        stack.enter_context(metrics.labels(**labels))
+        if context is not None:
+            stack.enter_context(context())
+        return stack
+
+    rows = 0
+    try:
+        for key, n, last in run_pipeline(download(), [prepare, write],
+                                         depth=depth, context=stage_context,
+                                         stop=stop):
+            # the chunks of a request arrive one after the other
+            rows += n
+            if last:
+                yield key, rows
+                rows = 0
+    finally:
+        for session in sessions.values():
+            session.close()
+
+def filter_deleted(df, session):
+    """Drop insights rows whose campaign or adset is not in the
+    database (e.g. deleted ones). Ids are looked up per account in
+    id_cache instead of reading every id in the database.
+    """
+    if df.empty:
+        return df
+    rows = len(df.index)
+    account_id = df['account_id'].iloc[0]
+    campaign_ids = id_cache.get(session, account_id, 'campaign')
+    adset_ids = id_cache.get(session, account_id, 'adset')
+
+    missing_campaign = df.loc[df['campaign_id'].isin(campaign_ids)==False, :]
+    n = len(missing_campaign.index)
+    if n > 0:
+        logger.warning(f"{n} rows  will not be synced | deleted campaign")
         df = df.loc[df['campaign_id'].isin(campaign_ids), :]
+
+    missing_adset = df.loc[df['adset_id'].isin(adset_ids)==False, :]
+    n = len(missing_adset.index)
+    if n > 0:
+        logger.warning(f"{n} rows will not be synced | deleted adset")
         df = df.loc[df['adset_id'].isin(adset_ids), :]
+    metrics.count('dropped', rows - len(df.index))
+    return df
 
-        # have experienced duplicates in primary keys in this table
-        # I will log them into a csv to keep track which were dropped
-        duplicates = df[df.duplicated(subset=['ad_id', 'account_id', 'campaign_id', 'adset_id', 'date_start', 'region'], keep='first')]
-        n = len(duplicates.index)
-        if n > 0:
-            df.drop_duplicates(subset=['ad_id', 'account_id', 'campaign_id', 'adset_id', 'date_start', 'region'], keep = 'first', inplace = True)
+def load_frame(df, table, session, method='merge', load_threshold=None,
+               compact=False, detect_changes=False, actions_layout='wide'):
+    """Perform column operations on a dataframe built by build_frame
+    for the specified table and upsert it into mysql database. The
+    operations are those of the table's entry in tables.TABLES.
+    table: database table name as type: str
+    session: database session
+    method: upsert method passed to bulk_upsert ('merge' or 'native')
+    load_threshold: passed to bulk_upsert
+    compact: passed to transform
+    detect_changes: passed to bulk_upsert
+    actions_layout: 'wide' to store the actions in the action columns
+    of the table (see transform), 'narrow' to store them in the
+    table's actions table (see melt_actions)
+    """
+    frame = prepare_frame(df, table, session, compact=compact,
+                          actions_layout=actions_layout)
+    write_frame(frame, table, session, method=method,
+                load_threshold=load_threshold, detect_changes=detect_changes)
 
-        df = transform(df)
-        bulk_upsert(session, table=AdsInsightsRegionTable,
-                    table_name='ads_insights_region',
-                    df=df, id_cols=['ad_id', 'account_id', 'campaign_id',
-                                    'adset_id', 'date_start', 'region'])
-    session.close()
+def prepare_frame(df, table, session, compact=False, actions_layout='wide'):
+    """The column operations of load_frame (renames, filters,
+    transform), without writing anything.
+    --> returns (df, actions, keys) for write_frame
+    """
+    spec = TABLES[table]
+    if spec.rename:
+        df.rename(columns=spec.rename, inplace=True)
 
+    if spec.filter_deleted:
+        with metrics.stage('filter_deleted'):
+            df = filter_deleted(df, session)
 
+    if spec.dedupe:
+        duplicates = df[df.duplicated(subset=spec.id_cols, keep='first')]
+        n = len(duplicates.index)
+        if n > 0:
+            logger.warning(f'{n} rows with duplicate primary keys '
+                           f'dropped from {table}')
+            df = df.drop_duplicates(subset=spec.id_cols, keep='first')
+            metrics.count('dropped', n)
 
-def batch_dates(start, end, intv):
-    """start and end define a date range in string format.
-    Returns a list of dictionaries that can be used as parameters
-    for a Facebook API request; breaking apart large date ranges
-    into smaller ranges.
-    """
-    from datetime import datetime
-    from datetime import timedelta
-    def date_range(start, end, intv):
-        """Take a date range and intv, return (intv) number of
-        contiguous sub date ranges.
-        e.g.: date_range('2019-09-17', '2019-10-01', 3)
-        -> ['2019-09-17', '2019-09-21', '2019-09-26', '2019-10-01']
-        """
-        start = datetime.strptime(start, "%Y-%m-%d")
-        end = datetime.strptime(end, "%Y-%m-%d")
-        diff = (end - start) / intv
-        for i in range(intv):
-            yield (start+diff*i).strftime("%Y-%m-%d")
-        yield end.strftime("%Y-%m-%d")
-    new_ranges = list(date_range(start, end, intv)) # string formatted
-    # date formatted
-    new_dates = [datetime.strptime(x, "%Y-%m-%d") for x in new_ranges]
-    # list of number of days differences between
-    date_diffs = pd.Series(new_dates).diff().dt.days.iloc[1:].tolist()
-    date_params = [] # list of dictionaries init
-    for i in range(len(new_dates)-1):
-        # on last date we want the range to include 'end' from args
-        if i == (len(new_dates)-2):
-            days = date_diffs[i]
-        # otherwise less one day to prevent overlapping
-        else:
-            days = date_diffs[i]-1
-        date_param = {
-            'since': new_ranges[i],
-            'until': datetime.strftime(
-                new_dates[i] + timedelta(days=days),
-                "%Y-%m-%d"
-            )
-        }
-        date_params.append(date_param)
-    return date_params
+    actions = keys = None
+    if spec.transform:
+        with metrics.stage('transform'):
+            if actions_layout == 'narrow' and spec.actions_model is not None:
+                actions = melt_actions(df, spec.id_cols)
+                df = df.drop(columns=['actions', 'action_values'])
+                # clear the action columns of an earlier wide load of
+                # these rows, so the view reads only the actions table
+                columns = spec.model.__table__.columns
+                for _, _, name in configured_actions():
+                    for win in ATTRIBUTION_WINDOWS:
+                        if f'{name}_{win}' in columns:
+                            df[f'{name}_{win}'] = None
+            else:
+                df = transform(df, compact=compact)
+        # the rows whose stored actions are replaced (wide loads
+        # delete the entries of an earlier narrow load, see
+        # write_frame)
+        if spec.actions_model is not None:
+            keys = df[spec.id_cols].copy()
+    return df, actions, keys
+
+def write_frame(frame, table, session, method='merge', load_threshold=None,
+                detect_changes=False):
+    """Write a frame prepared by prepare_frame (the writes of
+    load_frame)
+    """
+    spec = TABLES[table]
+    df, actions, keys = frame
+    bulk_upsert(session, table=spec.model, table_name=table,
+                df=df, id_cols=spec.id_cols,
+                method=method, load_threshold=load_threshold,
+                detect_changes=detect_changes)
 
+    if actions is not None:
+        write_actions(session, spec.actions_model,
+                      spec.actions_model.__tablename__, keys, actions)
+    elif keys is not None and not keys.empty:
+        # a wide load; only accounts that were loaded narrow before
+        # have entries to delete
+        narrow = [account_id for account_id in keys['account_id'].unique()
+                  if has_narrow_entries(session, spec.actions_model,
+                                        account_id)]
+        if narrow:
+            write_actions(session, spec.actions_model,
+                          spec.actions_model.__tablename__,
+                          keys[keys['account_id'].isin(narrow)],
+                          pd.DataFrame(columns=spec.id_cols + [
+                              'action', 'attribution_window', 'value']))
 
+    if spec.fill_ids:
+        # the insights filters also accept the ids just synced
+        id_column = ID_COLUMNS[spec.fill_ids][1]
+        for account_id, ids in df.groupby('account_id')[id_column]:
+            id_cache.fill(account_id, spec.fill_ids, ids)
@@ -0,0 +1,113 @@
+##
+import logging
+from collections import deque
+
+from database.tables import TABLES
+from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.api import FacebookAdsApi
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# BATCHED DIMENSION REQUESTS
+#++++++++++++++++++++++++++++++++++++++++
+# The accounts, campaigns and adsets requests of many accounts are
+# packed into Graph API batch requests (up to BATCH_SIZE calls per
+# http request) instead of one blocking call per table and page.
+# Further pages of an edge are requested in the following batch.
+
+# most calls the Graph API accepts in one batch
+BATCH_SIZE = 50
+# records per page of an edge
+PAGE_LIMIT = 500
+# times calls the api did not answer (null responses) are sent again
+BATCH_RETRIES = 2
+
+def add_call(batch, account_id, table, params, success, failure, api=None):
+    """Add the request of table (a dimension table of the registry)
+    for account_id to batch
+    """
+    spec = TABLES[table]
+    account = AdAccount(account_id, api=api)
+    if spec.edge is None:
+        return account.api_get(fields=spec.fields, params=params,
+                               batch=batch, success=success, failure=failure)
+    return getattr(account, spec.edge)(fields=spec.fields, params=params,
+                                       batch=batch, success=success,
+                                       failure=failure)
+
+def fetch_dimensions(units, api=None, batch_size=BATCH_SIZE,
+                     retries=BATCH_RETRIES):
+    """Request the records of units with batch requests.
+    units: list of (account id, table) for tables that are not
+    insights tables, e.g. [('act_<ID>', 'campaigns'), ...]
+    api: FacebookAdsApi to use; the default api if None
+    --> returns dictionary of (account id, table) -> list of records
+    for the units whose every page was fetched; failed units are
+    logged and left out, to be requested on their own
+    """
+    api = api or FacebookAdsApi.get_default_api()
+    records = {unit: [] for unit in units}
+    failed = set()
+    answered = set()
+    # calls still to make: (unit, params); later pages are appended
+    calls = deque()
+    for account_id, table in units:
+        params = dict(TABLES[table].params)
+        if TABLES[table].edge is not None:
+            params['limit'] = PAGE_LIMIT
+        calls.append(((account_id, table), params))
+
+    def on_success(unit, params):
+        def success(response):
+            answered.add(unit)
+            body = response.json()
+            if TABLES[unit[1]].edge is None:
+                records[unit].append(body)
+                return
+            records[unit].extend(body.get('data', []))
+            paging = body.get('paging', {})
+            if paging.get('next'):
+                calls.append((unit, dict(params,
+                                         after=paging['cursors']['after'])))
+        return success
+
+    def on_failure(unit):
+        def failure(response):
+            answered.add(unit)
+            failed.add(unit)
+            logger.warning(f'batch request of {unit[1]} for {unit[0]} '
+                           f'failed: {response.error().api_error_message()}')
+        return failure
+
+    round_trips = 0
+    while calls:
+        batch = api.new_batch()
+        sent = []
+        while calls and len(sent) < batch_size:
+            unit, params = calls.popleft()
+            if unit in failed:
+                continue
+            add_call(batch, unit[0], unit[1], params, on_success(unit, params),
+                     on_failure(unit), api=api)
+            sent.append(unit)
+        if not sent:
+            break
+        answered.clear()
+        retry = batch.execute()
+        round_trips += 1
+        attempts = 0
+        while retry is not None and attempts < retries:
+            retry = retry.execute()
+            round_trips += 1
+            attempts += 1
+        # a unit has at most one call per batch; calls the api never
+        # answered leave their units incomplete
+        for unit in set(sent) - answered:
+            failed.add(unit)
+            logger.warning(f'batch request of {unit[1]} for {unit[0]} '
+                           f'got no response')
+    logger.info(f'{len(units) - len(failed)} of {len(units)} dimension '
+                f'requests fetched in {round_trips} batch requests')
+    return {unit: rows for unit, rows in records.items() if unit not in failed}
@@ -0,0 +1,83 @@
+##
+import logging
+import threading
+
+from database.models import (
+    CampaignsTable,
+    AdSetsTable,
+)
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# REFERENTIAL ID CACHE
+#++++++++++++++++++++++++++++++++++++++++
+
+# kind -> (mapped class, id column)
+ID_COLUMNS = {
+    'campaign': (CampaignsTable, 'campaign_id'),
+    'adset': (AdSetsTable, 'adset_id'),
+}
+
+class IdCache:
+    """Campaign and adset ids per account, used to drop insights rows
+    that refer to deleted campaigns or adsets. Entries are read from
+    the database (for that account only) on a miss; ids synced later
+    are added to them.
+    """
+    def __init__(self):
+        self.ids = {} # (account_id, kind) -> frozenset of ids
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def fill(self, account_id, kind, ids):
+        """Add ids of kind for account_id, e.g. the ids that were just
+        synced. Ids stored before stay valid (a listing may leave out
+        campaigns or adsets that are still in the table), so an
+        account that is not cached is left to be read from the
+        database, which then includes ids.
+        """
+        key = (int(account_id), kind)
+        with self._lock:
+            if key in self.ids:
+                self.ids[key] = self.ids[key] | frozenset(int(i) for i in ids)
+
+    def invalidate(self, account_id=None, kind=None):
+        """Forget the ids of account_id (all accounts if None) and kind
+        (all kinds if None).
+        """
+        with self._lock:
+            for key in list(self.ids):
+                if account_id is not None and key[0] != int(account_id):
+                    continue
+                if kind is not None and key[1] != kind:
+                    continue
+                del self.ids[key]
+
+    def get(self, session, account_id, kind):
+        """Ids of kind ('campaign' or 'adset') for account_id"""
+        key = (int(account_id), kind)
+        with self._lock:
+            ids = self.ids.get(key)
+            if ids is not None:
+                self.hits += 1
+                return ids
+            self.misses += 1
+        table, column = ID_COLUMNS[kind]
+        query = session.query(getattr(table, column)).filter(
+            table.account_id == key[0]
+        )
+        ids = frozenset(i for i, in query)
+        with self._lock:
+            self.ids[key] = ids
+        return ids
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.ids)}
+
+# shared by every load in the process
+id_cache = IdCache()
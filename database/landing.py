@@ -0,0 +1,121 @@
+##
+import glob
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime
+
+import pandas as pd
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# RAW LANDING ZONE
+#++++++++++++++++++++++++++++++++++++++++
+# Every page of records downloaded from the api is written as it
+# came, before any column operation, to
+#   <directory>/<table>/<account>/<since>_<until>/page-00000.parquet
+# (insights tables) or
+#   <directory>/<table>/<account>/<fetch date>/page-00000.parquet
+# (the other tables). Replaying the files loads the database again
+# without any api call, e.g. after a change to transform.
+# Needs pyarrow.
+
+LANDING_DIR = 'database/staging/landing'
+# suffix of columns holding json encoded values (nested lists of
+# actions, or values of mixed types)
+JSON_SUFFIX = '__json'
+
+def encode(records):
+    """Dataframe of records that can be written to parquet: columns
+    whose values are not all strings or numbers are json encoded
+    """
+    records = [r.export_all_data() if hasattr(r, 'export_all_data')
+               else dict(r) for r in records]
+    df = pd.DataFrame(records)
+    for col in list(df.columns):
+        if df[col].dtype != object:
+            continue
+        values = df[col].dropna()
+        if values.map(lambda v: isinstance(v, str)).all():
+            continue
+        df[col + JSON_SUFFIX] = df[col].map(
+            lambda v: None if v is None or v != v else json.dumps(v))
+        df = df.drop(columns=[col])
+    return df
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def decode(df):
+    """Records of a frame written by encode, as the api returned
+    them (fields without a value are left out)
+    """
+    for col in list(df.columns):
+        if col.endswith(JSON_SUFFIX):
+            df[col[:-len(JSON_SUFFIX)]] = df[col].map(
+                lambda v: None if v is None else json.loads(v))
+            df = df.drop(columns=[col])
+    return [{k: v for k, v in record.items() if not _missing(v)}
+            for record in df.to_dict(orient='records')]
+
+class LandingZone:
+    """Raw api pages on disk (see RAW LANDING ZONE above).
+    directory: root of the landing zone
+    """
+    def __init__(self, directory=LANDING_DIR):
+        self.directory = directory
+
+    def path(self, account, table, time_range=None):
+        """Directory of the pages of one request"""
+        if time_range is None:
+            unit = datetime.now().strftime("%Y-%m-%d")
+        else:
+            unit = f"{time_range['since']}_{time_range['until']}"
+        return os.path.join(self.directory, table, account, unit)
+
+    def writer(self, account, table, time_range=None):
+        """Function writing each page of records of one request.
+        Pages landed earlier for the same request are replaced.
+        """
+        path = self.path(account, table, time_range)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        pages = [0]
+
+        def write(records):
+            if not records:
+                return
+            page = os.path.join(path, f'page-{pages[0]:05d}.parquet')
+            # readers never see a partly written page
+            encode(records).to_parquet(page + '.tmp', compression='snappy',
+                                       index=False)
+            os.replace(page + '.tmp', page)
+            pages[0] += 1
+        return write
+
+    def accounts(self):
+        """Accounts with landed pages"""
+        return sorted(set(os.path.basename(p) for p in
+                          glob.glob(os.path.join(self.directory, '*', '*'))))
+
+    def units(self, account, table, insights=True):
+        """Directories of the landed requests of account and table
+        in the order they were landed; only the latest for tables
+        that are not insights tables (a full snapshot each)
+        """
+        paths = [p for p in glob.glob(os.path.join(self.directory, table,
+                                                   account, '*'))
+                 if glob.glob(os.path.join(p, '*.parquet'))]
+        paths.sort(key=os.path.getmtime)
+        if not insights:
+            return paths[-1:]
+        return paths
+
+    def pages(self, path):
+        """Records of each page in path"""
+        for page in sorted(glob.glob(os.path.join(path, '*.parquet'))):
+            yield decode(pd.read_parquet(page))
@@ -0,0 +1,122 @@
+##
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    start_http_server,
+    write_to_textfile,
+)
+##
+
+#++++++++++++++++++++++++++++++++++++++++
+# PIPELINE METRICS
+#++++++++++++++++++++++++++++++++++++++++
+# Time per stage and row counts, labelled by account and table.
+# Stages: report_job (async job wait), report_submit and report_poll
+# (the api calls starting and polling a job), download, build_frame,
+# filter_deleted, transform, db_read (read back for merge), merge
+# (compare a batch with the rows read back), db_write and spill
+# (out-of-core tables written to disk).
+
+registry = CollectorRegistry()
+
+# stages range from milliseconds (transform of a small chunk) to
+# the better part of an hour (a large report job)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900,
+                 1800, 3600, float('inf'))
+
+STAGE_SECONDS = Histogram('facebook_sync_stage_seconds',
+                          'Seconds spent in each stage of the sync',
+                          ['stage', 'account', 'table'],
+                          buckets=STAGE_BUCKETS, registry=registry)
+ROWS = Counter('facebook_sync_rows',
+               'Rows inserted, updated or dropped',
+               ['result', 'account', 'table'], registry=registry)
+
+_local = threading.local()
+
+def current_labels():
+    """account and table labels set with labels() in this thread"""
+    current = getattr(_local, 'labels', {})
+    return {'account': current.get('account', ''),
+            'table': current.get('table', '')}
+
+def thread_labels():
+    """Every label set with labels() in this thread, including ones
+    that are not metric labels (e.g. batch, used by profiling.py)
+    """
+    return dict(getattr(_local, 'labels', {}))
+
+@contextmanager
+def labels(**kwargs):
+    """Label every stage and row count of this thread within the
+    block, e.g. labels(account='act_<ID>').
+    """
+    previous = getattr(_local, 'labels', {})
+    _local.labels = dict(previous, **{k: str(v) for k, v in kwargs.items()
+                                      if v is not None})
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+def _labels(kwargs):
+    merged = current_labels()
+    merged.update({k: str(v) for k, v in kwargs.items() if v is not None})
+    return merged
+
+def observe(name, seconds, **kwargs):
+    """Record seconds spent in stage name"""
+    STAGE_SECONDS.labels(stage=name, **_labels(kwargs)).observe(seconds)
+
+@contextmanager
+def stage(name, **kwargs):
+    """Time the block as stage name. account and table default to
+    the labels of the current thread.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **kwargs)
+
+def timed(iterable, name, **kwargs):
+    """Generator over iterable that records the time taken to
+    produce each item as stage name, e.g. the download of each page
+    of a cursor. Labels are taken when timed is called, so the items
+    may be produced in another thread.
+    """
+    kwargs = _labels(kwargs)
+
+    def generate():
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            observe(name, time.perf_counter() - start, **kwargs)
+            yield item
+    return generate()
+
+def count(result, n, **kwargs):
+    """Add n rows with result ('inserted', 'updated', 'upserted',
+    'unchanged' or 'dropped')
+    """
+    if n:
+        ROWS.labels(result=result, **_labels(kwargs)).inc(n)
+
+def serve(port):
+    """Expose the metrics on http://localhost:<port>/metrics"""
+    start_http_server(port, registry=registry)
+
+def write(path):
+    """Write the metrics to path in the text format (e.g. for the
+    node exporter textfile collector)
+    """
+    write_to_textfile(path, registry)
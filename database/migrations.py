@@ -0,0 +1,226 @@
+##
+import argparse
+import logging
+from datetime import date
+
+from database.cli import configure_logging
+from database.database_functions import ATTRIBUTION_WINDOWS, configured_actions
+from database.models import (
+    Base,
+    PARTITIONED_TABLES,
+    PARTITION_MONTHS_AHEAD,
+    PARTITION_MONTHS_BACK,
+    add_months,
+    month_partitions,
+    mySQL_connect,
+    partition_clause,
+)
+from database.tables import TABLES
+from sqlalchemy import Integer, inspect, text
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# INSIGHTS TABLE MIGRATIONS
+#++++++++++++++++++++++++++++++++++++++++
+# Brings insights tables created before they were partitioned in
+# line with the model (see PARTITIONING in models.py) and keeps
+# monthly partitions ahead of the data.
+# usage: python -m database.migrations [--rotate-only] [--retain-months N]
+
+def partitions(connection, table_name):
+    """(name, upper bound) of the partitions of table_name in order;
+    the bound is a 'YYYY-MM-DD' string or 'MAXVALUE'. [] if the table
+    is not partitioned.
+    """
+    rows = connection.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+        "FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name "
+        "AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ), table_name=table_name).fetchall()
+    return [(name, description.strip("'")[:10]) for name, description in rows]
+
+def drop_foreign_keys(engine, table_name):
+    """Drop the foreign keys of table_name (not allowed once it is
+    partitioned)
+    """
+    for fk in inspect(engine).get_foreign_keys(table_name):
+        logger.info(f"dropping foreign key {fk['name']} of {table_name}")
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {table_name} DROP FOREIGN KEY {fk['name']}"))
+
+def add_indexes(engine, table_name):
+    """Create the indexes of the model missing from table_name"""
+    existing = set(i['name'] for i in inspect(engine).get_indexes(table_name))
+    for index in Base.metadata.tables[table_name].indexes:
+        if index.name not in existing:
+            logger.info(f'creating index {index.name} on {table_name}')
+            index.create(bind=engine)
+
+def partition_existing(engine, table_name):
+    """Partition table_name by month of date_start, with a partition
+    for every month of its data. Rebuilds the table.
+    """
+    with engine.connect() as connection:
+        if partitions(connection, table_name):
+            return
+        first = connection.execute(text(
+            f"SELECT MIN(date_start) FROM {table_name}")).scalar()
+    today = date.today()
+    start = add_months(today, -PARTITION_MONTHS_BACK)
+    if first is not None:
+        start = min(start, add_months(first, 0))
+    logger.info(f'partitioning {table_name} (rebuilds the table)')
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"ALTER TABLE {table_name} "
+            + partition_clause(start, add_months(today, PARTITION_MONTHS_AHEAD))
+        ))
+
+def migrate(engine):
+    """Drop the foreign keys of the insights tables, add their
+    secondary indexes and partition them. Tables that are already
+    migrated are left as they are.
+    """
+    if engine.dialect.name != 'mysql':
+        logger.info('partitioning is only supported on MySQL')
+        return
+    existing = inspect(engine).get_table_names()
+    tables = [t for t in PARTITIONED_TABLES if t in existing]
+    # the breakdown tables reference ads_insights, so all foreign
+    # keys go before any table is partitioned
+    for table_name in tables:
+        drop_foreign_keys(engine, table_name)
+    for table_name in tables:
+        add_indexes(engine, table_name)
+        partition_existing(engine, table_name)
+
+def rotate_partitions(engine, months_ahead=PARTITION_MONTHS_AHEAD,
+                      retain_months=None):
+    """Split the months up to months_ahead out of p_future, so new
+    rows land in their own month, and with retain_months drop the
+    partitions (i.e. the data) of months older than that.
+    --> returns dictionary of table name -> partitions added, dropped
+    """
+    if engine.dialect.name != 'mysql':
+        return {}
+    today = date.today()
+    rotated = {}
+    for table_name in PARTITIONED_TABLES:
+        with engine.connect() as connection:
+            existing = partitions(connection, table_name)
+        if not existing:
+            logger.warning(f'{table_name} is not partitioned; '
+                           f'run python -m database.migrations')
+            continue
+        added, dropped = [], []
+        bounds = [bound for _, bound in existing if bound != 'MAXVALUE']
+        first = date.fromisoformat(bounds[-1]) if bounds else today
+        new = month_partitions(first, add_months(today, months_ahead))
+        if new:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {table_name} REORGANIZE PARTITION p_future "
+                    f"INTO ({', '.join(new)}, "
+                    f"PARTITION p_future VALUES LESS THAN (MAXVALUE))"
+                ))
+            added = [definition.split()[1] for definition in new]
+        if retain_months is not None:
+            cutoff = add_months(today, -retain_months).isoformat()
+            dropped = [name for name, bound in existing
+                       if bound != 'MAXVALUE' and bound <= cutoff]
+            # a table keeps at least one partition below p_future
+            dropped = dropped[:len(bounds) + len(added) - 1]
+            if dropped:
+                with engine.begin() as connection:
+                    connection.execute(text(
+                        f"ALTER TABLE {table_name} "
+                        f"DROP PARTITION {', '.join(dropped)}"))
+        if added or dropped:
+            logger.info(f'{table_name}: added partitions {added}, '
+                        f'dropped {dropped}')
+        rotated[table_name] = {'added': added, 'dropped': dropped}
+    return rotated
+
+#++++++++++++++++++++++++++++++++++++++++
+# ACTIONS VIEWS
+#++++++++++++++++++++++++++++++++++++++++
+# With the narrow actions layout the action columns of the insights
+# tables stay empty; the views <table>_wide pivot the actions tables
+# back into those columns, so queries written against the wide
+# columns only need the view name.
+
+def action_view_sql(spec):
+    """CREATE VIEW statement of the wide view of spec's table: the
+    table joined to its actions table and grouped by the table's
+    columns, so filters on them use the table's indexes
+    """
+    table = spec.model.__table__
+    keys = spec.id_cols
+    wide = {f'{name}_{window}': (name, window)
+            for _, _, name in configured_actions()
+            for window in ATTRIBUTION_WINDOWS}
+    group, columns = [], []
+    for column in table.columns:
+        if column.name == 'row_hash':
+            continue
+        group.append(f'b.{column.name}')
+        if column.name not in wide:
+            columns.append(f'b.{column.name}')
+            continue
+        name, window = wide[column.name]
+        # rows loaded with the wide layout have no actions entries
+        # and keep their own columns (a narrow load clears them)
+        value = (f"COALESCE(SUM(CASE WHEN a.action = '{name}' "
+                 f"AND a.attribution_window = '{window}' "
+                 f"THEN a.value END), b.{column.name}, 0)")
+        if isinstance(column.type, Integer):
+            value = f'CAST({value} AS SIGNED)'
+        columns.append(f'{value} AS {column.name}')
+    on = ' AND '.join(f'b.{k} = a.{k}' for k in keys)
+    return (f"CREATE VIEW {table.name}_wide AS "
+            f"SELECT {', '.join(columns)} FROM {table.name} b "
+            f"LEFT JOIN {spec.actions_model.__tablename__} a ON {on} "
+            f"GROUP BY {', '.join(group)}")
+
+def create_action_views(engine):
+    """(Re)create the wide views of the tables with an actions table,
+    e.g. after a change to the actions config
+    """
+    existing = inspect(engine).get_table_names()
+    for spec in TABLES.values():
+        if spec.actions_model is None or spec.name not in existing:
+            continue
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP VIEW IF EXISTS {spec.name}_wide"))
+            connection.execute(text(action_view_sql(spec)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Partition and index the '
+                                     'insights tables')
+    parser.add_argument('--credentials',
+                        default='database/settings/db_secrets.json')
+    parser.add_argument('--db', default='acquire')
+    parser.add_argument('--rotate-only', action='store_true',
+                        help='only add (and drop) monthly partitions')
+    parser.add_argument('--months-ahead', type=int,
+                        default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument('--retain-months', type=int, default=None,
+                        help='drop the partitions of months older than this '
+                        '(deletes their rows)')
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    engine = mySQL_connect(args.credentials, port='3306', db=args.db)
+    if not args.rotate_only:
+        migrate(engine)
+    rotate_partitions(engine, months_ahead=args.months_ahead,
+                      retain_months=args.retain_months)
+    create_action_views(engine)
+
+if __name__ == '__main__':
+    main()
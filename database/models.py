@@ -1,31 +1,80 @@
 ##
-import pymysql
 import json
+import threading
+import time
+from datetime import date
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
     String,
-    Sequence,
     Float,
     PrimaryKeyConstraint,
     ForeignKeyConstraint,
     ForeignKey,
+    Index,
     DateTime,
     BigInteger,
     Unicode,
+    Boolean,
+    inspect,
+    text,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, backref
-from sqlalchemy.sql import *
+from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
 ##
 #+++++++++++++++++++++++++++++++++++++++
 # AWS MYSQL-ENGINE
 #+++++++++++++++++++++++++++++++++++++++
 
-def mySQL_connect(credentials_path, port, db):
+# applied with SET SESSION to every new connection; long loads
+# should not be cut off by lock waits or slow network reads/writes
+LOAD_SESSION_SETTINGS = {
+    'innodb_lock_wait_timeout': 120,
+    'net_read_timeout': 600,
+    'net_write_timeout': 600,
+}
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = {'checkouts': 0, 'wait_total': 0.0,
+                               'wait_max': 0.0}
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkout_stats['checkouts'] += 1
+                self.checkout_stats['wait_total'] += wait
+                self.checkout_stats['wait_max'] = max(
+                    self.checkout_stats['wait_max'], wait)
+
+def mySQL_connect(credentials_path, port, db, pool_size=5, max_overflow=10,
+                  pool_timeout=30, pool_recycle=3600, pool_pre_ping=True,
+                  session_settings=LOAD_SESSION_SETTINGS, local_infile=True):
+    """Create the engine for the database. Connections are pooled:
+    at most pool_size + max_overflow are open at once, each is
+    checked with a ping before use and replaced after pool_recycle
+    seconds so idle connections are never used after the server
+    dropped them. Any of the pool keyword arguments can also be set
+    in a "pool" object of the credentials file.
+    session_settings: session variables set on every new connection
+    local_infile: allow LOAD DATA LOCAL INFILE (used for large batches)
+    """
     with open(credentials_path) as authentication_file:
         authentication_result = json.load(authentication_file)
+    pool = dict(pool_size=pool_size, max_overflow=max_overflow,
+                pool_timeout=pool_timeout, pool_recycle=pool_recycle,
+                pool_pre_ping=pool_pre_ping)
+    pool.update(authentication_result.get('pool', {}))
     engine = create_engine(
         "mysql+pymysql://{user}:{passwd}@{host}:{port}/{database}".format(
             user=authentication_result['user'],
@@ -33,10 +82,68 @@ def mySQL_connect(credentials_path, port, db):
             host=authentication_result['hostname'],
             port=port,
             database=db
-        )
+        ),
+        poolclass=TimedQueuePool,
+        connect_args={'local_infile': local_infile},
+        **pool
     )
+    if session_settings:
+        statement = "SET SESSION " + ", ".join(
+            f"{name} = {value}" for name, value in session_settings.items()
+        )
+        @event.listens_for(engine, 'connect')
+        def set_session(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(statement)
+            cursor.close()
     return(engine)
 
+# one session factory per engine for the life of the process
+_session_factories = {}
+_session_factories_lock = threading.Lock()
+
+def session_factory(engine):
+    """Return the sessionmaker bound to engine, creating it once"""
+    with _session_factories_lock:
+        if engine not in _session_factories:
+            _session_factories[engine] = sessionmaker(bind=engine)
+        return _session_factories[engine]
+
+def pool_stats(engine):
+    """Checkout counts and waits (seconds) of the engine's pool"""
+    stats = dict(getattr(engine.pool, 'checkout_stats', {}))
+    stats['status'] = engine.pool.status()
+    return stats
+
+def create_tables(engine):
+    """Create any table of the model missing from the database and
+    add any (nullable) column missing from an existing table.
+    """
+    Base.metadata.create_all(bind=engine, checkfirst=True)
+    add_missing_columns(engine)
+
+def add_missing_columns(engine):
+    """ALTER TABLE ... ADD COLUMN for every column of the model that
+    an existing table lacks, e.g. row_hash on tables created before
+    it was added. Only nullable columns without keys are added.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing or column.primary_key \
+                    or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} "
+                    f"ADD COLUMN {column.name} {column_type}"
+                ))
+
 ##
 #++++++++++++++++++++++++++++++++++++++
 # DATABASE MODEL
@@ -102,10 +209,8 @@ class AdsInsightsTable(Base):
     __table_args__ = (
         PrimaryKeyConstraint('ad_id', 'account_id', 'campaign_id',
                              'adset_id', 'date_start'),
-        ForeignKeyConstraint(
-            ['account_id', 'campaign_id', 'adset_id'],
-            ['adsets.account_id', 'adsets.campaign_id', 'adsets.adset_id'],
-            onupdate="CASCADE", ondelete="CASCADE")
+        # lookups of an account's dates at load time and in reports
+        Index('ix_ads_insights_account_date', 'account_id', 'date_start'),
     )
     ad_id = Column(BigInteger)
     account_id = Column(BigInteger)
@@ -190,6 +295,8 @@ class AdsInsightsTable(Base):
     owner_listed_1d_click = Column(Integer)
     owner_listed_7d_click = Column(Integer)
     owner_listed_28d_click = Column(Integer)
+    # hash of the metric columns, to skip rows that did not change
+    row_hash = Column(String(16))
 
 
 class AdsInsightsAgeGenderTable(Base):
@@ -198,11 +305,8 @@ class AdsInsightsAgeGenderTable(Base):
         PrimaryKeyConstraint('ad_id', 'account_id',
                              'campaign_id', 'adset_id',
                              'date_start', 'age', 'gender'),
-        ForeignKeyConstraint(
-            ['account_id', 'campaign_id', 'adset_id', 'ad_id'],
-            ['ads_insights.account_id', 'ads_insights.campaign_id',
-             'ads_insights.adset_id', 'ads_insights.ad_id'],
-            onupdate="CASCADE", ondelete="CASCADE")
+        Index('ix_ads_insights_age_and_gender_account_date',
+              'account_id', 'date_start'),
     )
     ad_id = Column(BigInteger)
     account_id = Column(BigInteger)
@@ -287,6 +391,8 @@ class AdsInsightsAgeGenderTable(Base):
     owner_listed_1d_click = Column(Integer)
     owner_listed_7d_click = Column(Integer)
     owner_listed_28d_click = Column(Integer)
+    # hash of the metric columns, to skip rows that did not change
+    row_hash = Column(String(16))
 
 class AdsInsightsRegionTable(Base):
     __tablename__ = "ads_insights_region"
@@ -294,11 +400,8 @@ class AdsInsightsRegionTable(Base):
         PrimaryKeyConstraint('ad_id', 'account_id',
                              'campaign_id', 'adset_id',
                              'date_start', 'region'),
-        ForeignKeyConstraint(
-            ['account_id', 'campaign_id', 'adset_id', 'ad_id'],
-            ['ads_insights.account_id', 'ads_insights.campaign_id',
-             'ads_insights.adset_id', 'ads_insights.ad_id'],
-            onupdate="CASCADE", ondelete="CASCADE")
+        Index('ix_ads_insights_region_account_date',
+              'account_id', 'date_start'),
     )
     ad_id = Column(BigInteger)
     account_id = Column(BigInteger)
@@ -382,8 +485,171 @@ class AdsInsightsRegionTable(Base):
     owner_listed_1d_click = Column(Integer)
     owner_listed_7d_click = Column(Integer)
     owner_listed_28d_click = Column(Integer)
+    # hash of the metric columns, to skip rows that did not change
+    row_hash = Column(String(16))
+
+# Narrow actions tables: one row per insights row, action type and
+# attribution window with a non-zero value. The action types are
+# listed in database/columns/actions.json; views named <table>_wide
+# (see migrations.create_action_views) give the wide columns.
+class AdsInsightsActionsTable(Base):
+    __tablename__ = "ads_insights_actions"
+    __table_args__ = (
+        PrimaryKeyConstraint('ad_id', 'account_id', 'campaign_id',
+                             'adset_id', 'date_start',
+                             'action', 'attribution_window'),
+        Index('ix_ads_insights_actions_account_date',
+              'account_id', 'date_start'),
+    )
+    ad_id = Column(BigInteger)
+    account_id = Column(BigInteger)
+    campaign_id = Column(BigInteger)
+    adset_id = Column(BigInteger)
+    date_start = Column(DateTime)
+    action = Column(String(64))
+    attribution_window = Column(String(10))
+    value = Column(Float(53))
+
+class AdsInsightsAgeGenderActionsTable(Base):
+    __tablename__ = "ads_insights_age_and_gender_actions"
+    __table_args__ = (
+        PrimaryKeyConstraint('ad_id', 'account_id',
+                             'campaign_id', 'adset_id',
+                             'date_start', 'age', 'gender',
+                             'action', 'attribution_window'),
+        Index('ix_ads_insights_age_and_gender_actions_account_date',
+              'account_id', 'date_start'),
+    )
+    ad_id = Column(BigInteger)
+    account_id = Column(BigInteger)
+    campaign_id = Column(BigInteger)
+    adset_id = Column(BigInteger)
+    date_start = Column(DateTime)
+    age = Column(String(7))
+    gender = Column(String(10))
+    action = Column(String(64))
+    attribution_window = Column(String(10))
+    value = Column(Float(53))
+
+class AdsInsightsRegionActionsTable(Base):
+    __tablename__ = "ads_insights_region_actions"
+    __table_args__ = (
+        PrimaryKeyConstraint('ad_id', 'account_id',
+                             'campaign_id', 'adset_id',
+                             'date_start', 'region',
+                             'action', 'attribution_window'),
+        Index('ix_ads_insights_region_actions_account_date',
+              'account_id', 'date_start'),
+    )
+    ad_id = Column(BigInteger)
+    account_id = Column(BigInteger)
+    campaign_id = Column(BigInteger)
+    adset_id = Column(BigInteger)
+    date_start = Column(DateTime)
+    region = Column(Unicode(45, collation='utf8_general_ci'))
+    action = Column(String(64))
+    attribution_window = Column(String(10))
+    value = Column(Float(53))
+
+##
+#++++++++++++++++++++++++++++++++++++++
+# PARTITIONING
+#++++++++++++++++++++++++++++++++++++++
+##
+# The insights tables are partitioned by month of date_start, so
+# queries for an account's dates only read those months. MySQL needs
+# date_start in every unique key (it is in the primary keys) and does
+# not allow foreign keys on partitioned tables; rows of deleted
+# campaigns and adsets are kept out by filter_deleted instead.
+# Existing tables are converted with database/migrations.py.
+
+PARTITIONED_TABLES = ['ads_insights', 'ads_insights_age_and_gender',
+                      'ads_insights_region', 'ads_insights_actions',
+                      'ads_insights_age_and_gender_actions',
+                      'ads_insights_region_actions']
+# months with their own partition when a table is created; older
+# rows go to p_past, later ones to p_future until rotate_partitions
+# adds their months
+PARTITION_MONTHS_BACK = 24
+PARTITION_MONTHS_AHEAD = 3
+
+def add_months(day, months):
+    """First day of the month months after the month of day"""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+def month_partitions(first, last):
+    """PARTITION definitions of the months from first to last,
+    e.g. PARTITION p201909 VALUES LESS THAN ('2019-10-01')
+    """
+    definitions = []
+    month = add_months(first, 0)
+    while month <= last:
+        bound = add_months(month, 1)
+        definitions.append(f"PARTITION p{month:%Y%m} "
+                           f"VALUES LESS THAN ('{bound:%Y-%m-%d}')")
+        month = bound
+    return definitions
+
+def partition_clause(first, last):
+    """PARTITION BY clause with monthly partitions from first to last"""
+    definitions = (
+        [f"PARTITION p_past VALUES LESS THAN ('{add_months(first, 0):%Y-%m-%d}')"]
+        + month_partitions(first, last)
+        + ["PARTITION p_future VALUES LESS THAN (MAXVALUE)"]
+    )
+    return ("PARTITION BY RANGE COLUMNS(date_start) ("
+            + ", ".join(definitions) + ")")
+
+def partition_table(target, connection, **kw):
+    """Partition a newly created insights table (MySQL only)"""
+    if connection.dialect.name != 'mysql':
+        return
+    today = date.today()
+    connection.execute(text(
+        f"ALTER TABLE {target.name} "
+        + partition_clause(add_months(today, -PARTITION_MONTHS_BACK),
+                           add_months(today, PARTITION_MONTHS_AHEAD))
+    ))
+
+for name in PARTITIONED_TABLES:
+    event.listen(Base.metadata.tables[name], 'after_create', partition_table)
 
-credentials_path = 'database/settings/db_secrets.json' # add database/ back
-engine = mySQL_connect(credentials_path, port='3306', db='acquire')
-Base.metadata.create_all(bind=engine, checkfirst=True)
 ##
+
+class SyncStateTable(Base):
+    """One row per (account, table, day) of insights data fetched;
+    a day is settled once it was fetched after its attribution
+    windows closed and no longer needs to be re-pulled.
+    """
+    __tablename__ = "sync_state"
+    __table_args__ = (
+        PrimaryKeyConstraint('account_id', 'table_name', 'day'),
+    )
+    account_id = Column(String(45))
+    table_name = Column(String(45))
+    day = Column(DateTime)
+    fetched_at = Column(DateTime)
+    settled = Column(Boolean)
+
+##
+
+class SliceSizeTable(Base):
+    """Number of days per insights report job chosen for an
+    (account, table) by the adaptive planner (see planner.py), with
+    the rows per day it was based on and the size cap left by failed
+    jobs.
+    """
+    __tablename__ = "slice_sizes"
+    __table_args__ = (
+        PrimaryKeyConstraint('account_id', 'table_name'),
+    )
+    account_id = Column(String(45))
+    table_name = Column(String(45))
+    days = Column(Integer)
+    rows_per_day = Column(Float)
+    # longest slice since a job failed (null: no cap) and the jobs of
+    # that size that succeeded since
+    cap_days = Column(Integer)
+    cap_successes = Column(Integer)
+    updated_at = Column(DateTime)
@@ -0,0 +1,128 @@
+##
+import logging
+import queue
+import threading
+from contextlib import nullcontext
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# PIPELINED STAGES
+#++++++++++++++++++++++++++++++++++++++++
+# The source (e.g. the pages of completed report jobs) and every
+# stage (e.g. build and transform a frame, write it) run in their own
+# thread, connected by queues of at most depth items. While one chunk
+# is written the next is transformed and the one after downloaded,
+# so a table takes about as long as its slowest stage instead of the
+# sum of all of them. A full queue blocks the stage before it
+# (backpressure). The first error of any thread stops all of them
+# and is raised in the caller. A source that waits on the api itself
+# (e.g. polling report jobs) should watch the stop event, so that
+# stopping does not wait for its next item.
+
+# items waiting between two stages
+PIPELINE_DEPTH = 2
+
+_done = object()
+
+class _Stopped(Exception):
+    """The pipeline was stopped by an error or the caller"""
+
+def run_pipeline(source, stages, depth=PIPELINE_DEPTH, context=None,
+                 stop=None):
+    """Generator over the results of passing every item of source
+    through stages in order, one thread per stage. Items keep their
+    order.
+    source: iterable, read in its own thread
+    stages: functions taking the item of the previous stage
+    depth: size of the queue after the source and after each stage
+    context: function returning a context manager entered by every
+    thread, e.g. to set thread local labels; none if None
+    stop: threading.Event set once the pipeline stops (on an error,
+    at the end or when the caller closes the generator); a new one
+    if None
+    """
+    context = context or nullcontext
+    stop = stop or threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+
+    def fail(error):
+        if not errors:
+            errors.append(error)
+        stop.set()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _Stopped()
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise _Stopped()
+
+    def produce():
+        iterator = iter(source)
+        try:
+            with context():
+                for item in iterator:
+                    if stop.is_set():
+                        return
+                    put(queues[0], item)
+                put(queues[0], _done)
+        except _Stopped:
+            pass
+        except Exception as e:
+            fail(e)
+        finally:
+            # a generator cleans up in this thread, not when collected
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def work(stage, inbox, outbox):
+        try:
+            with context():
+                while True:
+                    item = get(inbox)
+                    if item is _done:
+                        put(outbox, _done)
+                        return
+                    put(outbox, stage(item))
+        except _Stopped:
+            pass
+        except Exception as e:
+            fail(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    workers = [threading.Thread(target=work, daemon=True,
+                                args=(stage, queues[i], queues[i + 1]))
+               for i, stage in enumerate(stages)]
+    for thread in [producer] + workers:
+        thread.start()
+    try:
+        while True:
+            try:
+                item = get(queues[-1])
+            except _Stopped:
+                break
+            if item is _done:
+                break
+            yield item
+    finally:
+        stop.set()
+        # no thread is left downloading or writing once the caller
+        # goes on
+        for thread in [producer] + workers:
+            thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,171 @@
+##
+import logging
+import math
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+from database.models import (
+    SliceSizeTable,
+    session_factory,
+)
+from sqlalchemy.dialects.mysql import insert
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# ADAPTIVE DATE RANGE PLANNER
+#++++++++++++++++++++++++++++++++++++++++
+
+# rows a single report job should return
+TARGET_ROWS = 100000
+# slice size for an (account, table) without history; about the
+# 12 equal slices a 60 day window used to be cut into
+DEFAULT_DAYS = 5
+MAX_DAYS = 60
+# a size cap left by a failed job is raised by a quarter (at least a
+# day) after this many jobs of the capped size succeeded
+RELAX_AFTER = 3
+
+def range_days(time_range):
+    """Number of days in a {'since', 'until'} time range"""
+    since = datetime.strptime(time_range['since'], "%Y-%m-%d")
+    until = datetime.strptime(time_range['until'], "%Y-%m-%d")
+    return (until - since).days + 1
+
+def slice_range(start, end, days):
+    """Contiguous, non overlapping time ranges of days days from
+    start to end (the last one may be shorter).
+    e.g.: slice_range('2019-09-01', '2019-09-10', 4)
+    -> 09-01 - 09-04, 09-05 - 09-08, 09-09 - 09-10
+    """
+    since = datetime.strptime(start, "%Y-%m-%d")
+    end = datetime.strptime(end, "%Y-%m-%d")
+    time_ranges = []
+    while since <= end:
+        until = min(since + timedelta(days=days - 1), end)
+        time_ranges.append({'since': since.strftime("%Y-%m-%d"),
+                            'until': until.strftime("%Y-%m-%d")})
+        since = until + timedelta(days=1)
+    return time_ranges
+
+def split_range(time_range):
+    """Split time_range in two halves; [] for a single day"""
+    days = range_days(time_range)
+    if days < 2:
+        return []
+    return slice_range(time_range['since'], time_range['until'],
+                       math.ceil(days / 2))
+
+class SlicePlanner:
+    """Chooses the number of days per report job for each account and
+    table from the rows earlier jobs returned: about target_rows per
+    job, so quiet accounts need a few long ranges and large ones get
+    short ranges. Ranges that fail are split in half and the smaller
+    size is kept as a cap on the row based size, raised slowly again
+    as jobs of that size succeed. Sizes are kept in the slice_sizes
+    table.
+    engine: database engine
+    target_rows: rows a single job should return
+    default_days: slice size without history
+    max_days: longest slice
+    """
+    def __init__(self, engine, target_rows=TARGET_ROWS,
+                 default_days=DEFAULT_DAYS, max_days=MAX_DAYS):
+        self.engine = engine
+        self.target_rows = target_rows
+        self.default_days = default_days
+        self.max_days = max_days
+        self._lock = threading.Lock()
+
+    def load(self, account_id, table):
+        """Stored (days, rows_per_day, cap_days, cap_successes) for
+        account_id and table, or Nones
+        """
+        session = session_factory(self.engine)()
+        row = session.query(SliceSizeTable.days,
+                            SliceSizeTable.rows_per_day,
+                            SliceSizeTable.cap_days,
+                            SliceSizeTable.cap_successes).filter(
+            SliceSizeTable.account_id == account_id,
+            SliceSizeTable.table_name == table,
+        ).first()
+        session.close()
+        if row is None:
+            return None, None, None, None
+        return tuple(row)
+
+    def save(self, account_id, table, days, rows_per_day, cap_days=None,
+             cap_successes=None):
+        stmt = insert(SliceSizeTable.__table__).values(
+            account_id=account_id, table_name=table, days=days,
+            rows_per_day=rows_per_day, cap_days=cap_days,
+            cap_successes=cap_successes, updated_at=datetime.now())
+        stmt = stmt.on_duplicate_key_update(
+            days=stmt.inserted.days,
+            rows_per_day=stmt.inserted.rows_per_day,
+            cap_days=stmt.inserted.cap_days,
+            cap_successes=stmt.inserted.cap_successes,
+            updated_at=stmt.inserted.updated_at,
+        )
+        with self.engine.begin() as connection:
+            connection.execute(stmt)
+
+    def slice_days(self, account_id, table):
+        """Days per job for account_id and table"""
+        days = self.load(account_id, table)[0]
+        return days or self.default_days
+
+    def plan(self, account_id, table, start, end):
+        """Time ranges covering start to end for account_id and table"""
+        days = min(self.slice_days(account_id, table), self.max_days)
+        time_ranges = slice_range(start, end, days)
+        logger.info(f'{table} for {account_id}: {len(time_ranges)} '
+                    f'ranges of {days} days')
+        return time_ranges
+
+    def record(self, account_id, table, time_range, rows):
+        """Learn from a job for time_range that returned rows rows"""
+        with self._lock:
+            _, previous, cap, successes = self.load(account_id, table)
+            rows_per_day = rows / range_days(time_range)
+            if previous is not None:
+                # smooth out day to day swings
+                rows_per_day = (previous + rows_per_day) / 2
+            if rows_per_day > 0:
+                days = int(self.target_rows // rows_per_day)
+            else:
+                days = self.max_days
+            if cap is not None and range_days(time_range) >= cap:
+                successes = (successes or 0) + 1
+                if successes >= RELAX_AFTER:
+                    cap, successes = cap + max(1, cap // 4), 0
+                    if cap >= self.max_days:
+                        cap = successes = None
+            if cap is not None:
+                # the row count does not show what made a job fail
+                days = min(days, cap)
+            days = max(1, min(days, self.max_days))
+            self.save(account_id, table, days, rows_per_day, cap, successes)
+
+    def record_failure(self, account_id, table, time_range):
+        """Remember a smaller size after time_range failed"""
+        with self._lock:
+            previous, rows_per_day, cap, _ = self.load(account_id, table)
+            cap = min(max(1, range_days(time_range) // 2),
+                      cap or self.max_days)
+            days = min(previous or cap, cap)
+            self.save(account_id, table, days, rows_per_day, cap, 0)
+        logger.info(f'{table} for {account_id}: slices reduced to {days} days')
+
+    def splitter(self, account_id, table):
+        """split function for ReportJobManager that halves failing
+        ranges and remembers the smaller size
+        """
+        def split(time_range):
+            children = split_range(time_range)
+            if children:
+                self.record_failure(account_id, table, time_range)
+            return children
+        return split
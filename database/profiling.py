@@ -0,0 +1,288 @@
+##
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from database import metrics
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# PROFILING
+#++++++++++++++++++++++++++++++++++++++++
+# Opt-in (python -m database sync --profile ...). While a Profiler
+# runs, metrics.stage and metrics.timed are replaced by versions that
+# also profile the stage (report_submit, report_poll, download,
+# build_frame, filter_deleted, transform, db_read, merge, db_write,
+# ...) for its account, table and batch (the date range of an
+# insights request). Nothing is replaced, and so nothing is slower,
+# when profiling is off.
+# tracemalloc counts the memory of the whole process, and stages of
+# several threads run at once, so memory is not measured per stage:
+# a stage's peak is the highest memory of the process while it ran.
+# Written to <directory> when the run ends:
+#   cpu/<account>__<table>__<batch>.prof   cProfile stats (pstats,
+#                                          snakeviz, gprof2dot)
+#   stacks.folded                          sampled stacks for
+#                                          flamegraph.pl / speedscope
+#   alloc/peak.snapshot                    tracemalloc snapshot near
+#                                          the process's highest memory
+#   summary.txt                            time and memory per stage,
+#                                          top functions and lines
+
+PROFILE_DIR = 'database/logs/profiles'
+# functions and allocation lines in summary.txt
+TOP_N = 25
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# frames kept per allocation traceback
+ALLOCATION_FRAMES = 8
+# the peak snapshot is replaced once memory grew by this factor
+SNAPSHOT_GROWTH = 1.1
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def _file_name(key):
+    return '__'.join(part.replace(os.sep, '_') for part in key)
+
+class Profiler:
+    """CPU profiles, stack samples and allocations of every stage
+    (see PROFILING above).
+    directory: where the profiles are written
+    top: number of functions and lines in the summary
+    interval: seconds between stack samples
+    allocations: trace allocations with tracemalloc
+    """
+    def __init__(self, directory, top=TOP_N, interval=SAMPLE_INTERVAL,
+                 allocations=True):
+        self.directory = directory
+        self.top = top
+        self.interval = interval
+        self.allocations = allocations
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # thread id -> (account, table, batch, stage) being profiled
+        self._active = {}
+        # thread id -> highest process memory since its stage started
+        self._memory = {}
+        # (account, table, batch) -> pstats.Stats
+        self._stats = {}
+        # (account, table, batch, stage) -> [calls, seconds, process
+        # peak bytes]
+        self._stages = collections.defaultdict(lambda: [0, 0.0, 0])
+        # (bytes, snapshot, stages running) at the highest memory
+        self._peak = (0, None, ())
+        self._samples = collections.Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._original = None
+
+    def start(self):
+        """Profile every stage until stop"""
+        self._original = (metrics.stage, metrics.timed)
+        metrics.stage, metrics.timed = self.stage, self.timed
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(ALLOCATION_FRAMES)
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        logger.info(f'profiling to {self.directory}')
+
+    def stop(self):
+        """Restore metrics, stop tracing and write the profiles
+        --> returns the path of the summary
+        """
+        metrics.stage, metrics.timed = self._original
+        self._stop.set()
+        self._sampler.join()
+        if self.allocations:
+            tracemalloc.stop()
+        return self.write()
+
+    #++++++++++++++++++++++++
+    # HOOKS
+    #++++++++++++++++++++++++
+
+    @contextmanager
+    def stage(self, name, **kwargs):
+        """metrics.stage while profiling"""
+        stage = self._original[0]
+        with stage(name, **kwargs), self.profile(name, **kwargs):
+            yield
+
+    def timed(self, iterable, name, **kwargs):
+        """metrics.timed while profiling; the items are profiled in
+        the thread producing them, under the labels of the caller
+        """
+        labels = dict(metrics.thread_labels(), **kwargs)
+
+        def generate():
+            iterator = iter(iterable)
+            while True:
+                with self.profile(name, **labels):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        timed = self._original[1]
+        return timed(generate(), name, **kwargs)
+
+    @contextmanager
+    def profile(self, name, **kwargs):
+        """Profile the block as stage name. Stages within a stage of
+        the same thread are part of the outer one.
+        """
+        if getattr(self._local, 'active', False):
+            yield
+            return
+        labels = dict(metrics.thread_labels(), **kwargs)
+        batch = (labels.get('account') or '-', labels.get('table') or '-',
+                 labels.get('batch') or '-')
+        ident = threading.get_ident()
+        self._local.active = True
+        if self.allocations:
+            self._memory[ident] = tracemalloc.get_traced_memory()[0]
+        self._active[ident] = batch + (name,)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler runs in this thread (python 3.12+
+            # allows one per process); the stage is only sampled
+            profile = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            del self._active[ident]
+            self._local.active = False
+            peak = 0
+            if self.allocations:
+                peak = max(self._memory.pop(ident),
+                           tracemalloc.get_traced_memory()[0])
+            self._record(batch, name, seconds, peak, profile)
+
+    def _record(self, batch, name, seconds, peak, profile):
+        with self._lock:
+            record = self._stages[batch + (name,)]
+            record[0] += 1
+            record[1] += seconds
+            record[2] = max(record[2], peak)
+            if profile is not None:
+                if batch in self._stats:
+                    self._stats[batch].add(profile)
+                else:
+                    self._stats[batch] = pstats.Stats(profile)
+
+    def _sample(self):
+        """Record the stacks of the threads in a stage, and the memory
+        of the process, every interval
+        """
+        while not self._stop.wait(self.interval):
+            active = list(self._active.items())
+            if self.allocations:
+                self._sample_memory(active)
+            frames = sys._current_frames()
+            for ident, key in active:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self._samples[key + tuple(reversed(stack))] += 1
+
+    def _sample_memory(self, active):
+        memory = tracemalloc.get_traced_memory()[0]
+        for ident, _ in active:
+            if memory > self._memory.get(ident, memory):
+                self._memory[ident] = memory
+        if memory > self._peak[0] * SNAPSHOT_GROWTH:
+            # leave out the profiler's own allocations
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, module.__file__)
+                 for module in (tracemalloc, cProfile, pstats)]
+                + [tracemalloc.Filter(False, __file__)])
+            self._peak = (memory, snapshot, tuple(key for _, key in active))
+
+    #++++++++++++++++++++++++
+    # OUTPUT
+    #++++++++++++++++++++++++
+
+    def write(self):
+        """Write the profiles and the summary to the directory
+        --> returns the path of the summary
+        """
+        for sub in ['cpu', 'alloc']:
+            os.makedirs(os.path.join(self.directory, sub), exist_ok=True)
+        for batch, stats in self._stats.items():
+            stats.dump_stats(os.path.join(self.directory, 'cpu',
+                                          _file_name(batch) + '.prof'))
+        snapshot = self._peak[1]
+        if snapshot is not None:
+            snapshot.dump(os.path.join(self.directory, 'alloc',
+                                       'peak.snapshot'))
+        with open(os.path.join(self.directory, 'stacks.folded'), 'w') as f:
+            for stack, count in self._samples.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+        path = os.path.join(self.directory, 'summary.txt')
+        with open(path, 'w') as f:
+            f.write(self.summary())
+        logger.info(f'profile summary written to {path}')
+        return path
+
+    def summary(self):
+        """Seconds and process peak memory per stage, the top
+        functions by own time and by samples, and the top allocating
+        lines at the highest memory
+        """
+        out = io.StringIO()
+        out.write('STAGES (account, table, batch, stage: calls, '
+                  'seconds, process peak MB)\n')
+        for key, (calls, seconds, peak) in sorted(self._stages.items()):
+            out.write(f"{' '.join(key)}: {calls}, {seconds:.3f}, "
+                      f"{peak / 2**20:.1f}\n")
+
+        out.write(f'\nTOP {self.top} FUNCTIONS BY OWN TIME (all stages)\n')
+        if self._stats:
+            stats = pstats.Stats(stream=out)
+            stats.add(*self._stats.values())
+            stats.sort_stats('tottime').print_stats(self.top)
+
+        out.write(f'\nTOP {self.top} FUNCTIONS BY SAMPLES '
+                  f'(every {self.interval * 1000:.0f} ms, on top / on stack)\n')
+        on_stack, on_top = collections.Counter(), collections.Counter()
+        for stack, count in self._samples.items():
+            frames = stack[4:]
+            for frame in set(frames):
+                on_stack[frame] += count
+            on_top[frames[-1]] += count
+        for frame, count in on_top.most_common(self.top):
+            out.write(f'{count:8d} {on_stack[frame]:8d}  {frame}\n')
+
+        memory, snapshot, active = self._peak
+        out.write(f'\nTOP {self.top} LINES BY MEMORY (snapshot at '
+                  f'{memory / 2**20:.1f} MB, near the highest process '
+                  f'memory)\n')
+        for key in active:
+            out.write(f"  during {' '.join(key)}\n")
+        if snapshot is not None:
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                frame = stat.traceback[0]
+                out.write(f'{stat.size / 2**20:10.1f} MB  '
+                          f'{frame.filename}:{frame.lineno}\n')
+        return out.getvalue()
@@ -0,0 +1,234 @@
+##
+import logging
+import time
+
+from database import metrics
+from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.adobjects.adreportrun import AdReportRun
+from facebook_business.exceptions import FacebookRequestError
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# ASYNC REPORT JOB MANAGER
+#++++++++++++++++++++++++++++++++++++++++
+
+JOB_COMPLETED = 'Job Completed'
+JOB_FAILED = ['Job Failed', 'Job Skipped']
+# poll results
+RUNNING = 'running'
+COMPLETED = 'completed'
+SPLIT = 'split'
+# error codes of requests that asked for too much data or timed out
+# (1: "Please reduce the amount of data you're asking for", 2: service
+# temporarily unavailable)
+TOO_MUCH_DATA_CODES = [1, 2]
+
+def too_much_data(error):
+    """True if error is one that a smaller date range may avoid"""
+    if not isinstance(error, FacebookRequestError):
+        return False
+    if error.api_error_code() in TOO_MUCH_DATA_CODES:
+        return True
+    message = (error.api_error_message() or '').lower()
+    return 'reduce the amount of data' in message or 'timeout' in message
+
+class ReportJobError(Exception):
+    """Raised when a report job keeps failing after all resubmits"""
+    pass
+
+class ReportJob:
+    """One async insights report for a single time range"""
+    def __init__(self, time_range):
+        self.time_range = time_range
+        self.report_run = None
+        self.attempts = 0
+        self.submitted_at = None
+        self.first_submitted_at = None
+        self.next_poll = None
+        self.children = None # smaller time ranges replacing this job
+
+    def __repr__(self):
+        return f"ReportJob({self.time_range['since']} - {self.time_range['until']})"
+
+    @property
+    def batch(self):
+        """batch label of the job's stages (as batch_name in
+        database_functions)
+        """
+        return f"{self.time_range['since']}_{self.time_range['until']}"
+
+class ReportJobManager:
+    """Submit async insights reports for many time ranges at once and
+    hand back results as jobs finish.
+    account_id: unique id for ad account in format act_<ID>
+    params: dictionary of parameters for request (without time_range)
+    fields: list of fields for request
+    max_in_flight: number of jobs allowed to run at the same time
+    poll_interval: shortest wait between two polls of a job (seconds)
+    max_poll_interval: longest wait between two polls of a job (seconds)
+    timeout: seconds after which a running job is resubmitted
+    max_attempts: submits per time range before ReportJobError
+    result_params: parameters passed to get_result
+    api: FacebookAdsApi to use; the default api if None
+    table: table the reports are for (used to label metrics)
+    split: function(time_range) -> list of smaller time ranges, or an
+           empty list when the range cannot be split; jobs that fail,
+           time out or ask for too much data are split instead of
+           resubmitted (only ranges that cannot be split are resubmitted)
+    on_split: called with (time_range, smaller time ranges) on a split
+    stop: threading.Event; run returns, leaving the jobs unread, once
+          it is set (e.g. by the pipeline consuming the results)
+    sleep, clock: swappable for testing
+    """
+    def __init__(self, account_id, params, fields, max_in_flight=4,
+                 poll_interval=1, max_poll_interval=30, timeout=1800,
+                 max_attempts=3, result_params=None, api=None,
+                 table=None, split=None, on_split=None, stop=None,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.account_id = account_id
+        self.params = params
+        self.fields = fields
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.result_params = result_params or {'limit': 1000}
+        self.api = api
+        self.table = table
+        self.split = split
+        self.on_split = on_split
+        self.stop = stop
+        self.sleep = sleep
+        self.clock = clock
+
+    def submit(self, job):
+        """Start (or restart) the async report for job"""
+        if job.attempts >= self.max_attempts:
+            raise ReportJobError(
+                f'{job} failed {job.attempts} times for {self.account_id}'
+            )
+        params = dict(self.params, time_range=job.time_range)
+        with metrics.labels(batch=job.batch), metrics.stage('report_submit'):
+            job.report_run = AdAccount(self.account_id, api=self.api).get_insights_async(
+                params=params, fields=self.fields
+            )
+        job.attempts += 1
+        job.submitted_at = self.clock()
+        if job.first_submitted_at is None:
+            job.first_submitted_at = job.submitted_at
+        job.next_poll = job.submitted_at + self.poll_interval
+        logger.info(f'submitted {job} (attempt {job.attempts})')
+
+    def backoff(self, job):
+        """Seconds until job should be polled again. Estimates the time
+        left from the elapsed time and the reported completion
+        percentage, bounded by poll_interval and max_poll_interval.
+        """
+        percent = job.report_run.get(AdReportRun.Field.async_percent_completion) or 0
+        elapsed = self.clock() - job.submitted_at
+        if percent <= 0:
+            remaining = elapsed
+        else:
+            remaining = elapsed * (100 - percent) / percent
+        return min(max(remaining / 2, self.poll_interval),
+                   self.max_poll_interval)
+
+    def try_split(self, job):
+        """Replace job by smaller time ranges if split allows it.
+        returns: True if job was split
+        """
+        if self.split is None:
+            return False
+        children = self.split(job.time_range)
+        if not children:
+            return False
+        job.children = children
+        logger.info(f'{job} split into {len(children)} ranges')
+        if self.on_split is not None:
+            self.on_split(job.time_range, children)
+        return True
+
+    def start(self, job):
+        """Submit job, splitting it when the request asks for too much
+        data.
+        returns: RUNNING or SPLIT
+        """
+        try:
+            self.submit(job)
+        except FacebookRequestError as e:
+            if too_much_data(e) and self.try_split(job):
+                return SPLIT
+            raise
+        return RUNNING
+
+    def poll(self, job):
+        """Refresh the status of job.
+        returns: COMPLETED, RUNNING or SPLIT (see job.children)
+        """
+        with metrics.labels(batch=job.batch), metrics.stage('report_poll'):
+            job.report_run.api_get()
+        status = job.report_run[AdReportRun.Field.async_status]
+        if status == JOB_COMPLETED:
+            return COMPLETED
+        if status in JOB_FAILED:
+            logger.warning(f'{job} returned status "{status}"')
+        elif self.clock() - job.submitted_at > self.timeout:
+            logger.warning(f'{job} timed out after {self.timeout}s')
+        else:
+            job.next_poll = self.clock() + self.backoff(job)
+            return RUNNING
+        if self.try_split(job):
+            return SPLIT
+        logger.warning(f'resubmitting {job}')
+        return self.start(job)
+
+    def stopped(self):
+        return self.stop is not None and self.stop.is_set()
+
+    def run(self, time_ranges):
+        """Generator over (time_range, result cursor) pairs in the order
+        the jobs complete. At most max_in_flight jobs run at once. When
+        a job is split, its smaller time ranges are yielded instead.
+        """
+        pending = [ReportJob(time_range) for time_range in time_ranges]
+        pending.reverse() # submit in chronological order
+        running = []
+        while pending or running:
+            if self.stopped():
+                return
+            while pending and len(running) < self.max_in_flight:
+                job = pending.pop()
+                if self.start(job) == SPLIT:
+                    pending.extend(ReportJob(r) for r in reversed(job.children))
+                else:
+                    running.append(job)
+            if not running:
+                continue
+            wait = min(job.next_poll for job in running) - self.clock()
+            if wait > 0:
+                if self.stop is not None:
+                    self.stop.wait(wait)
+                else:
+                    self.sleep(wait)
+            for job in list(running):
+                if self.stopped():
+                    return
+                if job.next_poll > self.clock():
+                    continue
+                status = self.poll(job)
+                if status == SPLIT:
+                    running.remove(job)
+                    pending.extend(ReportJob(r) for r in reversed(job.children))
+                elif status == COMPLETED:
+                    running.remove(job)
+                    logger.info(f'{job} completed')
+                    metrics.observe('report_job',
+                                    self.clock() - job.first_submitted_at,
+                                    account=self.account_id,
+                                    table=self.table)
+                    yield job.time_range, job.report_run.get_result(
+                        params=self.result_params
+                    )
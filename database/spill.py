@@ -0,0 +1,136 @@
+##
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# OUT-OF-CORE PARTITIONS
+#++++++++++++++++++++++++++++++++++++++++
+# Requests too large to hold in memory (the region breakdown of the
+# biggest accounts) are spilled to disk as they are downloaded: each
+# record is appended to one of the partition files chosen by a hash
+# of its primary key, so every copy of a key is in the same
+# partition. Partitions are then read back one at a time and can be
+# deduplicated and loaded on their own. A partition with more than
+# max_rows records is split again with another hash before it is
+# read, so no more than max_rows records are in memory at once.
+
+SPILL_DIR = 'database/staging/spill'
+# partition files of a request
+SPILL_PARTITIONS = 16
+# a partition is split at most this many times (i.e. when one key
+# has more than max_rows copies it is read as it is)
+MAX_SPLITS = 3
+
+class Spill:
+    """Records of one request, hash partitioned on disk by key.
+    key: names of the fields identifying a record (the primary keys)
+    max_rows: most records of a partition read at once
+    directory: parent of the request's spill directory
+    partitions: number of partition files
+    usage:
+        with Spill(key, max_rows) as spill:
+            for chunk in chunks:
+                spill.add(chunk)
+            for records in spill.partitions():
+                ...
+    """
+    def __init__(self, key, max_rows, directory=SPILL_DIR,
+                 partitions=SPILL_PARTITIONS, level=0):
+        self.key = list(key)
+        self.max_rows = max_rows
+        self.partitions_count = partitions
+        self.level = level
+        if level == 0:
+            os.makedirs(directory, exist_ok=True)
+            # requests of several threads spill at the same time
+            self.directory = tempfile.mkdtemp(dir=directory)
+        else:
+            self.directory = directory
+            os.makedirs(directory, exist_ok=True)
+        self.counts = [0] * partitions
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.level == 0:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _path(self, partition):
+        return os.path.join(self.directory, f'part-{partition:03d}.jsonl')
+
+    def partition(self, record):
+        """Partition of record; salted with the level so a split
+        spreads the keys of its partition (crc32 would not: changing
+        the salt only xors its value with a constant)
+        """
+        key = '|'.join(str(record.get(k)) for k in self.key)
+        digest = hashlib.blake2b(key.encode(), digest_size=8,
+                                 salt=bytes([self.level])).digest()
+        return int.from_bytes(digest, 'little') % self.partitions_count
+
+    def add(self, records):
+        """Append records (dictionaries or api objects) to their
+        partition files
+        """
+        for record in records:
+            if hasattr(record, 'export_all_data'):
+                record = record.export_all_data()
+            partition = self.partition(record)
+            f = self._files.get(partition)
+            if f is None:
+                f = self._files[partition] = open(self._path(partition), 'a')
+            f.write(json.dumps(record))
+            f.write('\n')
+            self.counts[partition] += 1
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def read(self, partition):
+        """Generator over the records of partition"""
+        with open(self._path(partition)) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def partitions(self):
+        """Yield the records of each partition as a list of at most
+        max_rows records (unless one key has more copies); the files
+        are deleted once read
+        """
+        self.close()
+        for partition, count in enumerate(self.counts):
+            if not count:
+                continue
+            path = self._path(partition)
+            if count <= self.max_rows or self.level >= MAX_SPLITS:
+                records = list(self.read(partition))
+                os.remove(path)
+                yield records
+                continue
+            # about half of max_rows per partition after the split
+            split = Spill(self.key, self.max_rows,
+                          directory=path[:-len('.jsonl')],
+                          partitions=2 * math.ceil(count / self.max_rows),
+                          level=self.level + 1)
+            logger.debug(f'splitting {count} spilled records into '
+                         f'{split.partitions_count} partitions')
+            split.add(self.read(partition))
+            os.remove(path)
+            yield from split.partitions()
+            shutil.rmtree(split.directory, ignore_errors=True)
+
+    def __len__(self):
+        return sum(self.counts)
@@ -0,0 +1,98 @@
+##
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+from database.models import (
+    SyncStateTable,
+    session_factory,
+)
+from sqlalchemy.dialects.mysql import insert
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# INCREMENTAL SYNC STATE
+#++++++++++++++++++++++++++++++++++++++++
+
+# longest attribution window requested (28d_view / 28d_click); after
+# this many days the insights of a day no longer change
+SETTLE_DAYS = 28
+# extra days before a day counts as settled: facebook keeps
+# attributing conversions for a while after a window closes
+REPORTING_DELAY_DAYS = 2
+# number of days (ending yesterday) kept in sync
+LOOKBACK_DAYS = 60
+
+def day_range(since, until):
+    """Every day from since to until (inclusive) as datetimes"""
+    since = datetime.strptime(since, "%Y-%m-%d")
+    until = datetime.strptime(until, "%Y-%m-%d")
+    return [since + timedelta(days=i)
+            for i in range((until - since).days + 1)]
+
+def settled_days(engine, account_id, table, since, until):
+    """Set of settled days recorded for account_id and table
+    between since and until.
+    """
+    Session = session_factory(engine)
+    session = Session()
+    query = session.query(SyncStateTable.day).filter(
+        SyncStateTable.account_id == account_id,
+        SyncStateTable.table_name == table,
+        SyncStateTable.day >= datetime.strptime(since, "%Y-%m-%d"),
+        SyncStateTable.day <= datetime.strptime(until, "%Y-%m-%d"),
+        SyncStateTable.settled == True,
+    )
+    days = set(day for day, in query)
+    session.close()
+    return days
+
+def sync_window(engine, account_id, table, end=None,
+                lookback=LOOKBACK_DAYS, full_refresh=False):
+    """Date range that still needs to be fetched for account_id and
+    table: from the first day in the lookback window that is not
+    settled up to end (yesterday by default).
+    full_refresh: ignore the state and return the whole window
+    --> returns (since, until) strings, or None when every day is settled
+    """
+    if end is None:
+        end = datetime.strftime(datetime.now() - timedelta(days=1),
+                                "%Y-%m-%d")
+    start = datetime.strftime(datetime.strptime(end, "%Y-%m-%d") - \
+                              timedelta(days=lookback - 1), "%Y-%m-%d")
+    if full_refresh:
+        return start, end
+    settled = settled_days(engine, account_id, table, start, end)
+    for day in day_range(start, end):
+        if day not in settled:
+            logger.info(f'{table} for {account_id}: '
+                        f'{len(settled)} settled days skipped')
+            return datetime.strftime(day, "%Y-%m-%d"), end
+    return None
+
+def mark_fetched(engine, account_id, table, since, until, fetched_at=None):
+    """Record that every day from since to until was fetched for
+    account_id and table. A day is marked settled once its longest
+    attribution window had closed (the whole of day + SETTLE_DAYS had
+    passed) REPORTING_DELAY_DAYS before it was fetched.
+    """
+    if fetched_at is None:
+        fetched_at = datetime.now()
+    # the window of clicks on day D is open until the end of D + 28
+    cutoff = (fetched_at - timedelta(days=SETTLE_DAYS
+                                     + REPORTING_DELAY_DAYS)).date()
+    rows = [{'account_id': account_id,
+             'table_name': table,
+             'day': day,
+             'fetched_at': fetched_at,
+             'settled': day.date() < cutoff}
+            for day in day_range(since, until)]
+    stmt = insert(SyncStateTable.__table__).values(rows)
+    stmt = stmt.on_duplicate_key_update(
+        fetched_at=stmt.inserted.fetched_at,
+        settled=stmt.inserted.settled,
+    )
+    with engine.begin() as connection:
+        connection.execute(stmt)
@@ -0,0 +1,146 @@
+##
+import random
+from datetime import datetime
+from datetime import timedelta
+
+from database.database_functions import (
+    ATTRIBUTION_WINDOWS,
+    configured_actions,
+)
+##
+
+#++++++++++++++++++++++++++++++++++++++++
+# SYNTHETIC GRAPH API PAYLOADS
+#++++++++++++++++++++++++++++++++++++++++
+# Records shaped like the Marketing API returns them (ids and metrics
+# as strings, actions as lists of dictionaries) with the fields of
+# columns/<table>.json, for benchmarking without api calls.
+
+AGES = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+GENDERS = ['female', 'male', 'unknown']
+# action types that transform does not extract still show up in the
+# actions lists and have to be skipped
+OTHER_ACTION_TYPES = ['video_view', 'comment', 'like', 'photo_view',
+                      'onsite_conversion.post_save', 'omni_view_content']
+
+def breakdown_values(table, cardinality):
+    """List of breakdown dictionaries for table with at most
+    cardinality entries ([{}] for tables without a breakdown).
+    """
+    if table == 'ads_insights_age_and_gender':
+        values = [{'age': age, 'gender': gender}
+                  for age in AGES for gender in GENDERS]
+        return values[:cardinality]
+    if table == 'ads_insights_region':
+        return [{'region': f'Region {i}'} for i in range(cardinality)]
+    return [{}]
+
+def action_list(rng, action_types, density, values=False):
+    """List of action dictionaries; each of action_types is present
+    with probability density, plus a few action types that are not
+    extracted.
+    """
+    actions = []
+    for action_type in action_types + OTHER_ACTION_TYPES:
+        if rng.random() >= density:
+            continue
+        action = {'action_type': action_type}
+        for window in ATTRIBUTION_WINDOWS + ['value']:
+            if rng.random() < 0.8:
+                if values:
+                    action[window] = str(round(rng.random() * 200, 2))
+                else:
+                    action[window] = str(rng.randint(0, 40))
+        actions.append(action)
+    return actions
+
+class Account:
+    """Ids and names of a synthetic ad account"""
+    def __init__(self, account_id=1000000001, campaigns=5,
+                 adsets_per_campaign=3, ads_per_adset=4, seed=0):
+        self.account_id = account_id
+        self.name = f'account {account_id}'
+        self.campaigns = [account_id * 100 + c for c in range(campaigns)]
+        self.adsets = [(campaign_id, campaign_id * 100 + a)
+                       for campaign_id in self.campaigns
+                       for a in range(adsets_per_campaign)]
+        self.ads = [(campaign_id, adset_id, adset_id * 100 + d)
+                    for campaign_id, adset_id in self.adsets
+                    for d in range(ads_per_adset)]
+        self.rng = random.Random(seed)
+
+def generate_account(account):
+    """accounts.json record"""
+    return {'id': f'act_{account.account_id}',
+            'account_id': str(account.account_id),
+            'name': account.name,
+            'account_status': 1,
+            'currency': 'USD',
+            'amount_spent': str(account.rng.randint(0, 10 ** 7))}
+
+def generate_campaigns(account):
+    """campaigns.json records"""
+    return [{'id': str(campaign_id),
+             'name': f'campaign {campaign_id}',
+             'account_id': str(account.account_id),
+             'effective_status': 'ACTIVE',
+             'updated_time': '2019-09-01T00:00:00-0400',
+             'daily_budget': str(account.rng.randint(1000, 100000))}
+            for campaign_id in account.campaigns]
+
+def generate_adsets(account):
+    """adsets.json records"""
+    return [{'id': str(adset_id),
+             'name': f'adset {adset_id}',
+             'account_id': str(account.account_id),
+             'campaign_id': str(campaign_id),
+             'created_time': '2019-08-01T00:00:00-0400',
+             'daily_budget': str(account.rng.randint(1000, 100000)),
+             'status': 'ACTIVE',
+             'optimization_goal': 'OFFSITE_CONVERSIONS',
+             'updated_time': '2019-09-01T00:00:00-0400'}
+            for campaign_id, adset_id in account.adsets]
+
+def generate_insights(account, table='ads_insights', days=7,
+                      start='2019-09-01', cardinality=10, density=0.3):
+    """Generator of insights records for every ad, day and breakdown
+    value of account.
+    table: one of the insights tables (decides the breakdown)
+    days: number of days starting at start
+    cardinality: number of breakdown values (age/gender, region)
+    density: probability that each extracted action type is present
+    in a row's actions list
+    """
+    rng = account.rng
+    action_types = sorted(set(a for nested, a, _ in configured_actions()
+                              if nested == 'actions'))
+    value_types = sorted(set(a for nested, a, _ in configured_actions()
+                             if nested == 'action_values'))
+    breakdowns = breakdown_values(table, cardinality)
+    start = datetime.strptime(start, "%Y-%m-%d")
+    for day in range(days):
+        date_start = (start + timedelta(days=day)).strftime("%Y-%m-%d")
+        for campaign_id, adset_id, ad_id in account.ads:
+            for breakdown in breakdowns:
+                impressions = rng.randint(0, 50000)
+                record = {
+                    'ad_id': str(ad_id),
+                    'account_id': str(account.account_id),
+                    'campaign_id': str(campaign_id),
+                    'adset_id': str(adset_id),
+                    'date_start': date_start,
+                    'account_name': account.name,
+                    'campaign_name': f'campaign {campaign_id}',
+                    'adset_name': f'adset {adset_id}',
+                    'ad_name': f'ad {ad_id}',
+                    'spend': str(round(rng.random() * 500, 2)),
+                    'account_currency': 'USD',
+                    'frequency': str(round(1 + rng.random(), 6)),
+                    'reach': str(impressions // 2),
+                    'impressions': str(impressions),
+                    'actions': action_list(rng, action_types, density),
+                    'action_values': action_list(rng, value_types,
+                                                 density, values=True),
+                }
+                record.update(breakdown)
+                yield record
@@ -0,0 +1,280 @@
+##
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from database.models import (
+    AccountsTable,
+    CampaignsTable,
+    AdSetsTable,
+    AdsInsightsTable,
+    AdsInsightsAgeGenderTable,
+    AdsInsightsRegionTable,
+    AdsInsightsActionsTable,
+    AdsInsightsAgeGenderActionsTable,
+    AdsInsightsRegionActionsTable,
+)
+from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.adobjects.adsinsights import AdsInsights
+from facebook_business.adobjects.campaign import Campaign
+from facebook_business.adobjects.adset import AdSet
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# TABLE REGISTRY
+#++++++++++++++++++++++++++++++++++++++++
+
+class TableSpec:
+    """How one table is requested from the Marketing API and loaded.
+    name: database table name
+    model: the mapped class (i.e. database table)
+    params: dictionary of parameters for the request
+    fields: list of fields for the request
+    edge: AdAccount method returning the records (e.g. 'get_campaigns');
+          None to read the ad account object itself
+    insights: True for async insights reports (see ReportJobManager)
+    depends_on: tables that must be synced first
+    rename: api field -> column renames
+    fill_ids: id_cache kind filled with the synced ids ('campaign', 'adset')
+    filter_deleted: drop rows of deleted campaigns and adsets
+    dedupe: drop rows with duplicate primary keys
+    transform: extract the action columns (see transform)
+    retries: times a failed table sync is retried after a jittered
+             backoff (insights tables retry only the ranges left)
+             before the error is raised
+    skip_accounts: accounts this table is not synced for
+    out_of_core: spill the rows of a request to disk and load them
+                 partition by partition (see spill.py), so requests
+                 of any size load within chunksize rows of memory
+    actions_model: mapped class of the narrow actions table, loaded
+                   instead of the wide action columns when the actions
+                   layout is 'narrow' (see load_frame)
+    """
+    def __init__(self, name, model, params, fields, edge=None,
+                 insights=False, depends_on=(), rename=None,
+                 fill_ids=None, filter_deleted=False, dedupe=False,
+                 transform=False, retries=2, skip_accounts=(),
+                 out_of_core=False, actions_model=None):
+        self.name = name
+        self.model = model
+        self.params = params
+        self.fields = fields
+        self.edge = edge
+        self.insights = insights
+        self.depends_on = list(depends_on)
+        self.rename = rename or {}
+        self.fill_ids = fill_ids
+        self.filter_deleted = filter_deleted
+        self.dedupe = dedupe
+        self.transform = transform
+        self.retries = retries
+        self.skip_accounts = list(skip_accounts)
+        self.out_of_core = out_of_core
+        self.actions_model = actions_model
+
+    @property
+    def id_cols(self):
+        """primary keys of the table"""
+        return [c.name for c in self.model.__table__.primary_key]
+
+    def __repr__(self):
+        return f'TableSpec({self.name})'
+
+ATTRIBUTION_WINDOW_PARAMS = ['1d_view', '7d_view', '28d_view',
+                             '1d_click', '7d_click', '28d_click']
+
+INSIGHTS_FIELDS = [AdsInsights.Field.ad_id,
+                   AdsInsights.Field.account_id,
+                   AdsInsights.Field.campaign_id,
+                   AdsInsights.Field.adset_id,
+                   AdsInsights.Field.date_start,
+                   AdsInsights.Field.account_name,
+                   AdsInsights.Field.campaign_name,
+                   AdsInsights.Field.adset_name,
+                   AdsInsights.Field.ad_name,
+                   AdsInsights.Field.spend,
+                   AdsInsights.Field.account_currency,
+                   AdsInsights.Field.frequency,
+                   AdsInsights.Field.reach,
+                   AdsInsights.Field.impressions,
+                   AdsInsights.Field.actions,
+                   AdsInsights.Field.action_values,
+                   ]
+
+def insights_params(**kwargs):
+    """Parameters of a daily ad level insights report"""
+    params = {
+        'time_increment': 1,
+        'level': 'ad',
+        'action_attribution_windows': ATTRIBUTION_WINDOW_PARAMS,
+    }
+    params.update(kwargs)
+    return params
+
+TABLES = {}
+
+def register(spec):
+    """Add spec to the registry"""
+    for name in spec.depends_on:
+        if name not in TABLES:
+            raise ValueError(f'{spec.name} depends on unknown table {name}')
+    TABLES[spec.name] = spec
+    return spec
+
+# ACCOUNT
+register(TableSpec(
+    'accounts', AccountsTable,
+    params={'level': 'account'},
+    fields=[AdAccount.Field.account_id,
+            AdAccount.Field.name,
+            AdAccount.Field.account_status,
+            AdAccount.Field.currency,
+            AdAccount.Field.amount_spent,
+            ],
+    rename={'name': 'account_name'},
+))
+# CAMPAIGN
+register(TableSpec(
+    'campaigns', CampaignsTable,
+    params={'level': 'campaign',
+            'filtering': [{'field': 'campaign.effective_status',
+                           'operator': 'IN',
+                           'value': ['ACTIVE', 'PAUSED',
+                                     'ARCHIVED', 'DELETED',
+                                     'IN_PROCESS', 'WITH_ISSUES']}]},
+    fields=[Campaign.Field.id,
+            Campaign.Field.name,
+            Campaign.Field.account_id,
+            Campaign.Field.effective_status,
+            Campaign.Field.updated_time,
+            Campaign.Field.daily_budget,
+            ],
+    edge='get_campaigns',
+    depends_on=['accounts'],
+    # must rename these columns due to Field class attributes
+    # from parent Campaign (see facebook-business)
+    rename={'id': 'campaign_id', 'name': 'campaign_name'},
+    fill_ids='campaign',
+))
+# AD SETS
+register(TableSpec(
+    'adsets', AdSetsTable,
+    params={'level': 'adset',
+            'filtering': [{'field': 'adset.effective_status',
+                           'operator': 'IN',
+                           'value': ['ACTIVE', 'PAUSED',
+                                     'ARCHIVED', 'DELETED',
+                                     'IN_PROCESS', 'WITH_ISSUES',
+                                     'PENDING_REVIEW', 'DISAPPROVED',
+                                     'PREAPPROVED', 'PENDING_BILLING_INFO',
+                                     'CAMPAIGN_PAUSED', 'ADSET_PAUSED']}]},
+    fields=[AdSet.Field.id,
+            AdSet.Field.name,
+            AdSet.Field.account_id,
+            AdSet.Field.campaign_id,
+            AdSet.Field.created_time,
+            AdSet.Field.daily_budget,
+            AdSet.Field.status,
+            AdSet.Field.optimization_goal,
+            AdSet.Field.updated_time
+            ],
+    edge='get_ad_sets',
+    depends_on=['campaigns'],
+    rename={'id': 'adset_id', 'name': 'adset_name'},
+    fill_ids='adset',
+))
+# ADS
+register(TableSpec(
+    'ads_insights', AdsInsightsTable,
+    params=insights_params(),
+    fields=INSIGHTS_FIELDS,
+    insights=True,
+    # campaign id may refer to a deleted campaign which is not
+    # contained in the Campaigns table of the database; this also
+    # happens with deleted adsets
+    depends_on=['campaigns', 'adsets'],
+    filter_deleted=True,
+    transform=True,
+    actions_model=AdsInsightsActionsTable,
+))
+# ADS - AGE AND GENDER
+register(TableSpec(
+    'ads_insights_age_and_gender', AdsInsightsAgeGenderTable,
+    params=insights_params(breakdowns=['age', 'gender']),
+    fields=INSIGHTS_FIELDS,
+    insights=True,
+    depends_on=['campaigns', 'adsets'],
+    filter_deleted=True,
+    transform=True,
+    actions_model=AdsInsightsAgeGenderActionsTable,
+))
+# ADS - REGION
+# This table is often the biggest batch of api requests and so has a
+# greater frequency of errors. Most often - too many calls from a
+# single ad account.
+register(TableSpec(
+    'ads_insights_region', AdsInsightsRegionTable,
+    params=insights_params(breakdowns=['region']),
+    fields=INSIGHTS_FIELDS,
+    insights=True,
+    depends_on=['campaigns', 'adsets'],
+    filter_deleted=True,
+    # have experienced duplicates in primary keys in this table
+    dedupe=True,
+    transform=True,
+    actions_model=AdsInsightsRegionActionsTable,
+    # the largest accounts have more region rows than fit in memory;
+    # duplicates are dropped within each spilled partition
+    out_of_core=True,
+))
+
+INSIGHTS_TABLES = [name for name, spec in TABLES.items() if spec.insights]
+
+#++++++++++++++++++++++++++++++++++++++++
+# DEPENDENCY AWARE EXECUTION
+#++++++++++++++++++++++++++++++++++++++++
+
+def run_tables(sync_table, tables=None, max_workers=3):
+    """Call sync_table(name) for every table once all the tables it
+    depends on were synced; tables that do not depend on each other
+    run at the same time in up to max_workers threads. Tables whose
+    dependencies failed are skipped. The first error raised by
+    sync_table is raised again once the running tables finished.
+    tables: names of the tables to sync (all registered if None)
+    --> returns dictionary of table name -> True (synced),
+        False (failed) or None (skipped)
+    """
+    if tables is None:
+        tables = list(TABLES)
+    results = {}
+    waiting = list(tables)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for name in list(waiting):
+                deps = [d for d in TABLES[name].depends_on if d in tables]
+                if any(d in results and not results[d] for d in deps):
+                    logger.warning(f'skipping {name}: a dependency failed')
+                    results[name] = None
+                    waiting.remove(name)
+                elif all(results.get(d) for d in deps):
+                    running[executor.submit(sync_table, name)] = name
+                    waiting.remove(name)
+            if not running:
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    results[name] = True
+                except Exception as e:
+                    logger.warning(f'{name} failed: {e!r}')
+                    results[name] = False
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,227 @@
+##
+import json
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from facebook_business.exceptions import FacebookRequestError
+##
+
+logger = logging.getLogger(__name__)
+
+#++++++++++++++++++++++++++++++++++++++++
+# RATE LIMIT AWARE THROTTLING
+#++++++++++++++++++++++++++++++++++++++++
+
+# error codes the Marketing API uses when a rate limit is hit
+THROTTLE_ERROR_CODES = [4, 17, 32, 613, 80000, 80001, 80002, 80003,
+                        80004, 80005, 80006, 80008, 80009, 80014]
+
+APP = None # budget key for app level usage
+
+def _load(value):
+    """Usage headers are json strings; ignore anything unreadable"""
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return {}
+
+def account_key(value):
+    """Return the act_<ID> found in an account id, request path
+    or url, or None.
+    """
+    match = re.search(r'act_\d+', str(value))
+    if match:
+        return match.group(0)
+    return None
+
+def jittered_backoff(attempt, base=30, cap=900):
+    """Seconds to wait before retry number attempt (from 1): doubles
+    per attempt up to cap, with +-50% jitter so retries of parallel
+    workers do not line up.
+    """
+    pause = min(base * 2 ** (attempt - 1), cap)
+    return pause * random.uniform(0.5, 1.5)
+
+class Budget:
+    """Latest usage reported for one ad account (or the app)"""
+    def __init__(self):
+        self.usage = 0 # percentage of the limit used
+        self.window = None # seconds until the usage resets, if reported
+        self.observed_at = None
+        self.blocked_until = 0
+        self.strikes = 0 # consecutive throttle errors
+
+class Throttler:
+    """Keeps a usage budget per ad account from the API usage headers
+    and throttle errors, and pauses only as long as they require.
+    threshold: usage percentage below which requests are not delayed
+    window: seconds over which usage is assumed to recover when the
+            API does not report a reset time
+    max_pause: longest single pause (seconds)
+    error_backoff: first pause after a throttle error that does not
+                   report when access is regained; doubles per strike
+    clock, sleep: swappable so the throttler can run against a
+                  simulated API
+    """
+    def __init__(self, threshold=75, window=300, max_pause=1800,
+                 error_backoff=60, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.threshold = threshold
+        self.window = window
+        self.max_pause = max_pause
+        self.error_backoff = error_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.budgets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def budget(self, account_id):
+        with self._lock:
+            return self.budgets.setdefault(account_id, Budget())
+
+    @contextmanager
+    def scope(self, account_id):
+        """Attribute calls whose path has no act_<ID> (report runs,
+        paging urls) to account_id within this block.
+        """
+        previous = getattr(self._local, 'account', None)
+        self._local.account = account_key(account_id) or account_id
+        try:
+            yield
+        finally:
+            self._local.account = previous
+
+    def _account(self, account_id):
+        if account_id is not None:
+            return account_key(account_id) or account_id
+        return getattr(self._local, 'account', None)
+
+    def _record(self, account_id, usage, window=None, regain=None,
+                ok=True):
+        budget = self.budget(account_id)
+        now = self.clock()
+        with self._lock:
+            budget.usage = usage
+            budget.window = window or None
+            budget.observed_at = now
+            if ok:
+                budget.strikes = 0
+            if regain:
+                budget.blocked_until = max(budget.blocked_until,
+                                           now + regain)
+
+    def observe(self, account_id, headers, ok=True):
+        """Update budgets from the headers of an API response.
+        account_id: account the request was made for (may be None)
+        headers: mapping of response headers
+        ok: False when the headers came with an error response
+        """
+        account_id = self._account(account_id)
+        headers = {k.lower(): v for k, v in dict(headers).items()}
+        app = _load(headers.get('x-app-usage'))
+        insights = _load(headers.get('x-fb-ads-insights-throttle'))
+        if app or insights:
+            self._record(APP, max(app.get('call_count', 0),
+                                  app.get('total_time', 0),
+                                  app.get('total_cputime', 0),
+                                  insights.get('app_id_util_pct', 0)),
+                         ok=ok)
+        if account_id is None:
+            return
+        usage = insights.get('acc_id_util_pct', 0)
+        window = None
+        account = _load(headers.get('x-ad-account-usage'))
+        if account:
+            usage = max(usage, account.get('acc_id_util_pct', 0))
+            window = account.get('reset_time_duration')
+        regain = None
+        buc = _load(headers.get('x-business-use-case-usage'))
+        for entries in buc.values():
+            for entry in entries:
+                usage = max(usage, entry.get('call_count', 0),
+                            entry.get('total_time', 0),
+                            entry.get('total_cputime', 0))
+                minutes = entry.get('estimated_time_to_regain_access', 0)
+                if minutes:
+                    regain = max(regain or 0, minutes * 60)
+        if insights or account or buc:
+            self._record(account_id, usage, window=window, regain=regain,
+                         ok=ok)
+
+    def observe_error(self, account_id, error):
+        """Block the account after a throttle error. Uses the regain
+        time from the error headers when present, otherwise an
+        exponential backoff.
+        returns: True if error was a throttle error
+        """
+        if error.api_error_code() not in THROTTLE_ERROR_CODES:
+            return False
+        account_id = self._account(account_id)
+        headers = error.http_headers() or {}
+        self.observe(account_id, headers, ok=False)
+        budget = self.budget(account_id)
+        with self._lock:
+            pause = min(self.error_backoff * 2 ** budget.strikes,
+                        self.max_pause)
+            budget.strikes += 1
+            budget.blocked_until = max(budget.blocked_until,
+                                       self.clock() + pause)
+        logger.warning(f'throttled on {account_id or "app"} '
+                       f'(code {error.api_error_code()})')
+        return True
+
+    def pause_for(self, account_id):
+        """Seconds to wait before the next call for account_id"""
+        account_id = self._account(account_id)
+        now = self.clock()
+        pause = 0
+        for key in set([APP, account_id]):
+            budget = self.budget(key)
+            with self._lock:
+                pause = max(pause, budget.blocked_until - now)
+                if budget.observed_at is None or budget.usage < self.threshold:
+                    continue
+                window = budget.window or self.window
+                over = (budget.usage - self.threshold) / (100 - self.threshold)
+                until = budget.observed_at + window * min(over, 1)
+                pause = max(pause, until - now)
+        return min(pause, self.max_pause)
+
+    def wait(self, account_id=None):
+        """Sleep until the budgets of account_id and the app allow
+        another call.
+        """
+        pause = self.pause_for(account_id)
+        if pause > 0:
+            logger.info(f'pausing {pause:.0f}s for '
+                        f'{self._account(account_id) or "app"} usage')
+            self.sleep(pause)
+        return pause
+
+    def instrument(self, api):
+        """Route every call made through api (a FacebookAdsApi) via
+        the throttler: wait before the call, read the usage headers
+        of the response and record throttle errors.
+        """
+        call = api.call
+
+        def throttled_call(method, path, *args, **kwargs):
+            account_id = account_key(path) or account_key(kwargs.get('url_override'))
+            self.wait(account_id)
+            try:
+                response = call(method, path, *args, **kwargs)
+            except FacebookRequestError as e:
+                self.observe_error(account_id, e)
+                raise
+            self.observe(account_id, response.headers())
+            return response
+
+        api.call = throttled_call
+        return api
@@ -1,375 +1,444 @@
 ##
-from __future__ import print_function
-import json
 import logging
-import logging.config
-import numpy as np
-import os
-import pandas as pd
-import sys
+import threading
 import time
-import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+from database import metrics
 from database.database_functions import (
     facebookconnect,
-    bulk_upsert,
-    find,
-    extract_col,
-    transform,
+    facebook_session,
     get_request,
+    get_insights_requests,
     request_to_database,
-    batch_dates,
+    requests_to_database,
 )
-from datetime import datetime
-from datetime import timedelta
-from facebook_business.adobjects.adaccount import AdAccount
-from facebook_business.adobjects.adsinsights import AdsInsights
-from facebook_business.adobjects.adreportrun import AdReportRun
-from facebook_business.adobjects.campaign import Campaign
-from facebook_business.adobjects.adset import AdSet
 from facebook_business.api import FacebookAdsApi
 from facebook_business.exceptions import FacebookRequestError
+from database.dimensions import fetch_dimensions
+from database.planner import SlicePlanner
 from database.models import (
     mySQL_connect,
+    create_tables,
+    pool_stats,
 )
-from sqlalchemy.orm import sessionmaker
-#++++++++++++++++++++
-# LOGGER
-#++++++++++++++++++++
-
-with open('database/config.yaml', 'r') as f:
-    config = yaml.safe_load(f.read())
-    logging.config.dictConfig(config)
+from database.id_cache import id_cache
+from database.migrations import create_action_views, rotate_partitions
+from database.report_jobs import ReportJobError
+from database.sync_state import (
+    mark_fetched,
+    sync_window,
+)
+from database.tables import TABLES, run_tables
+from database.throttle import Throttler, jittered_backoff
+##
 
 logger = logging.getLogger(__name__)
 
+# Runs are started from the command line (see cli.py):
+#   python -m database sync act_<ID> [act_<ID> ...]
+
 #+++++++++++++++++++++++++++++++++++++
-# | FACEBOOK AUTHENTICATION |
+# FACEBOOK AUTHENTICATION
 #+++++++++++++++++++++++++++++++++++++
 
 secrets = 'database/settings/fb_client_secrets.json'
-try:
-    facebookconnect(secrets_path=secrets)
-    logger.info('Facebook authentication was a success')
-except Exception as e:
-    logger.exception('Failed to connect to Facebook')
+
+def authenticate(throttler):
+    """Initialise the default api and let throttler pace its calls"""
+    try:
+        facebookconnect(secrets_path=secrets)
+        logger.info('Facebook authentication was a success')
+    except Exception:
+        logger.exception('Failed to connect to Facebook')
+    api = FacebookAdsApi.get_default_api()
+    if api is None:
+        raise SystemExit(f'Facebook authentication failed; check {secrets}')
+    throttler.instrument(api)
 
 #+++++++++++++++++++++++++++++++++++++
 # ENGINE CONNECTION
 #+++++++++++++++++++++++++++++++++++++
 
 credentials = 'database/settings/db_secrets.json'
-try:
-    engine = mySQL_connect(credentials, port='3306', db='acquire')
+# connections for the short reads and writes of sync_state, the
+# planner and the id cache, besides those of the table syncs
+POOL_HEADROOM = 5
+
+def pool_size(workers, table_workers=3):
+    """Pool size for workers accounts synced at once with
+    table_workers tables each: every table holds two connections
+    while it loads (the transform and write stages of
+    requests_to_database), plus POOL_HEADROOM
+    """
+    return 2 * workers * table_workers + POOL_HEADROOM
+
+def connect(pool_size=5, migrate=True):
+    """Engine of the database with the model's tables; one pooled
+    engine is shared by all workers, each worker checks out its own
+    connection
+    migrate: create and alter the tables, partitions and views; False
+             for read only commands
+    """
+    engine = mySQL_connect(credentials, port='3306', db='acquire',
+                           pool_size=pool_size)
+    if not migrate:
+        return engine
+    create_tables(engine)
+    # monthly partitions of the insights tables ahead of the data
+    rotate_partitions(engine)
+    # <table>_wide views over the narrow actions tables
+    create_action_views(engine)
     logger.info('MySQL connection was a success')
-except Exception as e:
-    logger.exception('Failed to connect to MySQL')
+    return engine
 
 #++++++++++++++++++++++++++++++++++++++++++
 # | PARAMETERS FOR FACEBOOK API REQUESTS |
 #++++++++++++++++++++++++++++++++++++++++++
+# the params and fields of every table are in the table registry
+# (see database/tables.py)
+
+# INSIGHTS TABLES ARE WRITTEN WITH INSERT ... ON DUPLICATE KEY UPDATE
+upsert_method = 'native'
+# INSIGHTS REPORTS ARE STREAMED IN CHUNKS OF THIS MANY ROWS
+chunksize = 50000
+# CHUNKS OF AT LEAST THIS MANY ROWS ARE LOADED WITH LOAD DATA LOCAL INFILE
+load_threshold = 20000
+# INSIGHTS FRAMES USE CATEGORICALS AND DOWNCAST INTEGERS
+compact = True
+# ONLY INSIGHTS ROWS WHOSE CONTENT HASH CHANGED ARE WRITTEN
+detect_changes = True
+# ACCOUNTS, CAMPAIGNS AND ADSETS OF ALL CLIENTS ARE FETCHED IN BATCH REQUESTS
+batch_dimensions = True
+# ACTIONS ARE STORED AS WIDE COLUMNS ('wide') OR IN THE ACTIONS TABLES ('narrow')
+actions_layout = 'wide'
+# CHUNKS WAITING BETWEEN THE DOWNLOAD, TRANSFORM AND WRITE STAGES OF A TABLE
+pipeline_depth = 2
 
-# ACCOUNT
-account_params = {'level': 'account'}
-account_fields = [AdAccount.Field.account_id,
-                  AdAccount.Field.name,
-                  AdAccount.Field.account_status,
-                  AdAccount.Field.currency,
-                  AdAccount.Field.amount_spent,
-                  ]
-# CAMPAIGN
-campaign_params = {'level': 'campaign',
-                   'filtering': [{'field': 'campaign.effective_status',
-                                 'operator': 'IN',
-                                 'value': ['ACTIVE', 'PAUSED',
-                                           'ARCHIVED', 'DELETED',
-                                           'IN_PROCESS', 'WITH_ISSUES']}]}
-campaign_fields = [Campaign.Field.id,
-                   Campaign.Field.name,
-                   Campaign.Field.account_id,
-                   Campaign.Field.effective_status,
-                   Campaign.Field.updated_time,
-                   Campaign.Field.daily_budget,
-                   ]
-# AD SETS
-adset_params = {'level': 'adset',
-                'filtering': [{'field': 'adset.effective_status',
-                               'operator': 'IN',
-                               'value': ['ACTIVE', 'PAUSED',
-                                         'ARCHIVED', 'DELETED',
-                                         'IN_PROCESS', 'WITH_ISSUES',
-                                         'PENDING_REVIEW', 'DISAPPROVED',
-                                         'PREAPPROVED', 'PENDING_BILLING_INFO',
-                                         'CAMPAIGN_PAUSED', 'ADSET_PAUSED']}]}
-adset_fields = [AdSet.Field.id,
-          AdSet.Field.name,
-          AdSet.Field.account_id,
-          AdSet.Field.campaign_id,
-          AdSet.Field.created_time,
-          AdSet.Field.daily_budget,
-          AdSet.Field.status,
-          AdSet.Field.optimization_goal,
-          AdSet.Field.updated_time
-          ]
-
-# ADS
-ads_params = {
-    'time_increment': 1,
-    'action_attribution_windows': ['1d_view', '7d_view',
-                                   '28d_view', '1d_click',
-                                   '7d_click', '28d_click'],
-    'level': 'ad',
-        }
-ads_fields = [AdsInsights.Field.ad_id,
-              AdsInsights.Field.account_id,
-              AdsInsights.Field.campaign_id,
-              AdsInsights.Field.adset_id,
-              AdsInsights.Field.date_start,
-              AdsInsights.Field.account_name,
-              AdsInsights.Field.campaign_name,
-              AdsInsights.Field.adset_name,
-              AdsInsights.Field.ad_name,
-              AdsInsights.Field.spend,
-              AdsInsights.Field.account_currency,
-              AdsInsights.Field.frequency,
-              AdsInsights.Field.reach,
-              AdsInsights.Field.impressions,
-              AdsInsights.Field.actions,
-              AdsInsights.Field.action_values,
-              ]
-# ADS - AGE AND GENDER
-agegender_params = {
-    'time_increment': 1,
-    'level': 'ad',
-    'action_attribution_windows': ['1d_view', '7d_view',
-                                   '28d_view', '1d_click',
-                                   '7d_click', '28d_click'],
-    'breakdowns': ['age', 'gender'],
-}
-
-agegender_fields = [AdsInsights.Field.ad_id,
-                    AdsInsights.Field.account_id,
-                    AdsInsights.Field.campaign_id,
-                    AdsInsights.Field.adset_id,
-                    AdsInsights.Field.date_start,
-                    AdsInsights.Field.account_name,
-                    AdsInsights.Field.campaign_name,
-                    AdsInsights.Field.adset_name,
-                    AdsInsights.Field.ad_name,
-                    AdsInsights.Field.spend,
-                    AdsInsights.Field.account_currency,
-                    AdsInsights.Field.frequency,
-                    AdsInsights.Field.reach,
-                    AdsInsights.Field.impressions,
-                    AdsInsights.Field.actions,
-                    AdsInsights.Field.action_values,
-                    ]
-
-# ADS - REGION
-region_params = {
-    'time_increment': 1,
-    'level': 'ad',
-    'action_attribution_windows': ['1d_view', '7d_view',
-                                   '28d_view', '1d_click',
-                                   '7d_click', '28d_click'],
-    'breakdowns': ['region'],
-}
-
-region_fields = [AdsInsights.Field.ad_id,
-                 AdsInsights.Field.account_id,
-                 AdsInsights.Field.campaign_id,
-                 AdsInsights.Field.adset_id,
-                 AdsInsights.Field.date_start,
-                 AdsInsights.Field.account_name,
-                 AdsInsights.Field.campaign_name,
-                 AdsInsights.Field.adset_name,
-                 AdsInsights.Field.ad_name,
-                 AdsInsights.Field.spend,
-                 AdsInsights.Field.account_currency,
-                 AdsInsights.Field.frequency,
-                 AdsInsights.Field.reach,
-                 AdsInsights.Field.impressions,
-                 AdsInsights.Field.actions,
-                 AdsInsights.Field.action_values,
-                 ]
 ##
 #+++++++++++++++++++++++++++++++++++++
 # REQUESTS AND PUSHES
 #+++++++++++++++++++++++++++++++++++++
 ##
 
-def sleeper(seconds):
-    """Puts the script to sleep for defined seconds
+class SyncRun:
+    """One run of the sync over a list of accounts.
+    engine: database engine
+    checkpoint: Checkpoint recording the completed units; None to
+                record nothing (e.g. to only plan)
+    throttler: Throttler pacing the api calls of every thread
+    landing: LandingZone the downloaded pages are written to
+             (with land) or replayed from
+    land: write every downloaded page to landing
+    table_workers: number of tables of an account synced at the
+                   same time
+    tables: names of the tables to sync (all registered if None)
+    full_refresh: re-pull the whole lookback window, including
+                  settled days
+    window: (start, end) dates of the insights tables to pull instead
+            of the days that are not settled (a backfill)
     """
-    for i in range(seconds, 0, -1):
-        sys.stdout.write(str(i)+' ')
-        sys.stdout.flush()
-        time.sleep(1)
-
-# store a list of accounts that were synced and not synced properly
-synced = []
-not_synced = []
-
-clients = [arg for arg in sys.argv]
-clients = clients[1:]
-
-#================================/////////////
-#  BEGIN ITERATING OVER ACCOUNTS
-#===============================/////////////
-for account in clients: # account refers to an account name
-    attempts = 3 # number of attempts while encountering request errors
-    while attempts > 0:
+    def __init__(self, engine, checkpoint=None, throttler=None,
+                 landing=None, land=False, table_workers=3, tables=None,
+                 full_refresh=False, window=None):
+        self.engine = engine
+        self.checkpoint = checkpoint
+        self.throttler = throttler or Throttler()
+        self.landing = landing
+        self.land = land
+        self.table_workers = table_workers
+        self.tables = tables
+        self.full_refresh = full_refresh
+        self.window = window
+        # date ranges are sized per account and table from the rows
+        # earlier report jobs returned; failing ranges are split
+        self.planner = SlicePlanner(engine)
+        # records of the dimension tables, (account, table) -> records
+        self.dimensions = {}
+        # each thread (account workers and the table threads of an
+        # account) gets its own api session; database connections
+        # come from the shared engine's pool
+        self._worker = threading.local()
+
+    def plan_time_ranges(self, account, table):
+        """Date ranges (see SlicePlanner.plan) covering the days of
+        table that still have to be synced for account, leaving out
+        days this run already loaded (see Checkpoint); the whole
+        lookback window with full_refresh, the window of a backfill.
+        """
+        if self.window is not None:
+            window = self.window
+        else:
+            window = sync_window(self.engine, account, table,
+                                 full_refresh=self.full_refresh)
+        if window is None:
+            logging.info(f'{table} is up to date for {account}')
+            return []
+        start, end = window
+        if self.checkpoint is None:
+            spans = [(start, end)]
+        else:
+            spans = self.checkpoint.pending_spans(account, table, start, end)
+        return [time_range for since, until in spans
+                for time_range in self.planner.plan(account, table,
+                                                    since, until)]
+
+    def thread_api(self):
+        """The api session of the current thread, created on first use"""
+        if not hasattr(self._worker, 'api'):
+            self._worker.api = self.throttler.instrument(
+                facebook_session(secrets))
+        return self._worker.api
+
+    def writer(self, account, table, time_range=None):
+        """land argument of request_to_database"""
+        if not self.land:
+            return None
+        return self.landing.writer(account, table, time_range)
+
+    def is_done(self, account, table):
+        """Whether the run already synced table of account (never
+        without a checkpoint)
+        """
+        return (self.checkpoint is not None
+                and self.checkpoint.is_done(account, table))
+
+    def fetch_dimensions(self, clients):
+        """Fetch the dimension tables of every client with a handful
+        of batch requests (see dimensions.py)
+        """
+        units = [(account, table) for account in clients
+                 for table, spec in TABLES.items()
+                 if not spec.insights and account not in spec.skip_accounts
+                 and (self.tables is None or table in self.tables)
+                 and not self.is_done(account, table)]
         try:
-            logger.info(f'Beginning to sync {account}')
-            #==================
-            # ACCOUNTS TABLE
-            #==================
-            account_request = get_request(account_id=account,
-                                          table='accounts',
-                                          params=account_params,
-                                          fields=account_fields
-                                          )
-            request_to_database(request=account_request,
-                                table='accounts',
-                                engine=engine
-                                )
-            logging.info("Accounts Table successfully synced to database")
-            #===================
-            # CAMPAIGNS TABLE
-            #===================
-            campaign_request = get_request(account_id=account,
-                                           table='campaigns',
-                                           params=campaign_params,
-                                           fields=campaign_fields
-                                           )
-            request_to_database(request=campaign_request,
-                                table='campaigns',
-                                engine=engine
-                                )
-            logging.info("Campaigns Table successfully synced to database")
-            #================
-            # AD SETS TABLE
-            #================
-            adsets_request = get_request(account_id=account,
-                                         table='adsets',
-                                         params=adset_params,
-                                         fields=adset_fields
-                                         )
-
-            request_to_database(request=adsets_request,
-                                table='adsets',
-                                engine=engine
-                                )
-            logging.info("Ad Sets Table successfully synced to database")
-            sleeper(60) # WAIT 1 MINUTE
-            #=====================
-            # ADS INSIGHTS TABLE
-            #=====================
-            # define an interval for batching with smaller date ranges:
-            intv = 12
-            end = datetime.strftime(datetime.now() - \
-                                    timedelta(days=1), "%Y-%m-%d")
-            start = datetime.strftime(datetime.now() - \
-                                      timedelta(days=60), "%Y-%m-%d")
-            # store the list of dictionaries defining date params
-            time_ranges = batch_dates(start, end, intv)
-
-            for i in range(intv):
-                time_range = time_ranges[i]
-                ads_params['time_range'] = time_range
-                logging.info(f"batching from date range: {time_range['since']} - {time_range['until']}")
-                ads_request = get_request(account_id=account,
-                                          table='ads_insights',
-                                          params=ads_params,
-                                          fields=ads_fields
-                                          )
-                request_to_database(request=ads_request,
-                                    table='ads_insights',
-                                    engine=engine
-                                    )
-                logging.info(f"batch success; {i+1} out of {intv}")
-                sleeper(30)
-            logging.info("Ads Insights Table successfully synced to database")
-            #======================
-            # AGE AND GENDER TABLE
-            #======================
-            for i in range(intv):
-                time_range = time_ranges[i]
-                agegender_params['time_range'] = time_range
-                logging.info(f"batching from date range: {time_range['since']} - {time_range['until']}")
-                agegender_request = get_request(account_id=account,
-                                                table='ads_insights_age_and_gender',
-                                                params=agegender_params,
-                                                fields=agegender_fields
-                                                )
-                request_to_database(request=agegender_request,
-                                    table='ads_insights_age_and_gender',
-                                    engine=engine
-                                    )
-                logging.info(f"batch success; {i+1} out of {intv}")
-                # WAIT 1 MINUTE
-                sleeper(60)
-            logging.info("Ads-Age and Gender Table successfully synced to database")
-
-            # WAIT 10 MINUTES BETWEEN THESE TWO LARGE TABLES
-            sleeper(600)
-            #==================
-            # REGION TABLE
-            #==================
-            # This table is often the biggest batch of api requests and so
-            # has a greater frequency of errors. Most often - too many calls
-            # from a single ad account.
-            for i in range(intv):
-                # do not sync regions table for muse (too large)
-                if (account == 'muse') or (account == 'sheertex'):
+            self.dimensions = fetch_dimensions(units)
+        except Exception:
+            logger.exception('Batch requests failed; dimension tables are '
+                             'requested per account')
+
+    def sync_table(self, account, table, api):
+        """Sync one table of account as described by its registry entry.
+        Every unit (the table, or one date range of an insights table) is
+        recorded in the checkpoint once loaded and skipped when the run
+        is resumed. On request errors only the units left are retried, up
+        to spec.retries times after a jittered backoff.
+        account: ad account id in format act_<ID>
+        table: name of a table in the registry
+        api: FacebookAdsApi used for the requests
+        """
+        spec = TABLES[table]
+        checkpoint = self.checkpoint
+        if account in spec.skip_accounts:
+            logging.info(f'{table} is not synced for {account}')
+            return
+        if self.is_done(account, table):
+            logging.info(f'{table} already synced for {account} in run {checkpoint.run_id}')
+            return
+        remaining = None
+        if spec.insights:
+            # only days that are not settled yet are requested
+            remaining = self.plan_time_ranges(account, table)
+
+        # ranges are split in the download thread of the pipeline and
+        # removed once loaded in this one
+        lock = threading.Lock()
+
+        def replace(time_range, smaller):
+            # a failing range was split; its parts are synced instead
+            with lock:
+                i = remaining.index(time_range)
+                remaining[i:i + 1] = smaller
+
+        def stage_context():
+            # pipeline threads do not inherit this thread's scope
+            return self.throttler.scope(account)
+
+        attempt = 0
+        while True:
+            try:
+                if not spec.insights:
+                    # fetched up front in batch requests; requested on its
+                    # own if that failed and on retries
+                    request = self.dimensions.pop((account, table), None)
+                    if request is None:
+                        request = get_request(account_id=account,
+                                              table=table,
+                                              params=spec.params,
+                                              fields=spec.fields,
+                                              api=api
+                                              )
+                    rows = request_to_database(request=request,
+                                               table=table,
+                                               engine=self.engine,
+                                               land=self.writer(account, table)
+                                               )
+                    if checkpoint is not None:
+                        checkpoint.mark_done(account, table, rows=rows)
                     break
-                tries = 2 # gives this table 1 retry after a half hour wait
-                while tries > 0:
-                    try:
-                        time_range = time_ranges[i]
-                        region_params['time_range'] = time_range
-                        logging.info(f"batching from date range: {time_range['since']} - {time_range['until']}")
-                        region_request = get_request(account_id=account,
-                                                 table='ads_insights_region',
-                                                 params=region_params,
-                                                 fields=region_fields
-                                                 )
-                        request_to_database(request=region_request,
-                                            table='ads_insights_region',
-                                            engine=engine
-                                            )
-                        logging.info(f"batch success; {i+1} out of {intv}")
-                        # WAIT 3 MINUTE
-                        sleeper(120)
-                    except FacebookRequestError as e:
-                        logger.exception('Encountered an error - waiting 30 minutes...')
-                        tries -= 1
-                        sleeper(1800) # wait 30 minutes
-                        continue
+                if not remaining:
                     break
-            logging.info("Ads-Region Table successfully synced to database")
-            #===================
-            # END OF REQUESTS 
-            #===================
-            logger.info(f'CODE_200: Completed syncing {account} to database!')
-            synced.append(account)
-        # Catching request errors from any other table and retrying the entire account
-        # 2 more times...
-        except FacebookRequestError as e:
-            logger.exception(f'Encountered an error - retrys remaining: {attempts - 1}')
-            attempts -= 1
-            if attempts == 0:
-                logger.warning(f'not able to finish syncing {account}')
-                not_synced.append(account) # storing accounts that were not successfull
-            continue
-        break
-# return all accounts not syned properly
-synced_string = ",".join(synced)
-not_synced_string = ",".join(not_synced)
-synced_message = "The following accounts were synced: "
-not_synced_message = "The following accounts were not properly synced: "
-if len(not_synced) > 0: # if at least 1 account not synced properly - display
-    logging.warning(f'{not_synced_message} {not_synced_string}')
-logging.info(f'{synced_message} {synced_string}')
+                # all date ranges are submitted as async report jobs up front;
+                # their pages are downloaded, transformed and written in
+                # overlapping stages as the jobs complete; the polling
+                # ends when the pipeline stops
+                stop = threading.Event()
+                requests = get_insights_requests(
+                    account_id=account, table=table,
+                    params=spec.params, fields=spec.fields,
+                    time_ranges=list(remaining), api=api,
+                    split=self.planner.splitter(account, table),
+                    on_split=replace, stop=stop)
+                for time_range, rows in requests_to_database(
+                        requests, table=table, engine=self.engine,
+                        method=upsert_method,
+                        chunksize=chunksize,
+                        load_threshold=load_threshold,
+                        compact=compact,
+                        detect_changes=detect_changes,
+                        actions_layout=actions_layout,
+                        land=(lambda time_range: self.writer(account, table,
+                                                             time_range)),
+                        depth=pipeline_depth,
+                        context=stage_context, stop=stop):
+                    logging.info(f"loaded date range: {time_range['since']} - {time_range['until']}")
+                    mark_fetched(self.engine, account, table,
+                                 time_range['since'], time_range['until'])
+                    self.planner.record(account, table, time_range, rows)
+                    if checkpoint is not None:
+                        checkpoint.mark_done(account, table, time_range,
+                                             rows=rows)
+                    with lock:
+                        remaining.remove(time_range)
+                    logging.info(f"batch success; {len(remaining)} ranges left")
+            except (FacebookRequestError, ReportJobError):
+                attempt += 1
+                if attempt > spec.retries:
+                    raise
+                pause = jittered_backoff(attempt)
+                logger.exception(f'Encountered an error in {table} - retry {attempt} of '
+                                 f'{spec.retries} in {pause:.0f}s')
+                time.sleep(pause)
+                # and as long as the usage headers or throttle error require
+                self.throttler.wait(account)
+        logging.info(f"{table} successfully synced to database")
 
+    def sync_account(self, account):
+        """Sync all tables of one account, retrying the entire account
+        up to 2 more times on request errors; tables and date ranges
+        that were loaded are not synced again. Tables run as soon as the
+        tables they depend on are synced, so the insights tables run at
+        the same time; all of them draw on the account's rate budget.
+        account: ad account id in format act_<ID>
+        --> returns True if the account was synced
+        """
+        def sync_one(table):
+            # calls for report runs and paging urls count against this
+            # account; table threads do not inherit the caller's scope
+            with self.throttler.scope(account), metrics.labels(account=account):
+                self.sync_table(account, table, self.thread_api())
+
+        attempts = 3 # number of attempts while encountering request errors
+        while attempts > 0:
+            try:
+                logger.info(f'Beginning to sync {account}')
+                run_tables(sync_one, tables=self.tables,
+                           max_workers=self.table_workers)
+                logger.info(f'CODE_200: Completed syncing {account} to database!')
+                return True
+            # Catching request errors from any table and retrying the entire
+            # account 2 more times...
+            except (FacebookRequestError, ReportJobError):
+                logger.exception(f'Encountered an error - retrys remaining: {attempts - 1}')
+                attempts -= 1
+        logger.warning(f'not able to finish syncing {account}')
+        return False
+
+    def replay_account(self, account):
+        """Load the pages landed for account (see --land) again without
+        any api call: the latest landed copy of each dimension table,
+        then every landed date range of the insights tables in the order
+        they were landed, so later copies of a day win.
+        account: ad account id in format act_<ID>
+        --> returns True if the account was replayed
+        """
+        logger.info(f'Replaying {account} from {self.landing.directory}')
+        for table, spec in TABLES.items():
+            if account in spec.skip_accounts:
+                continue
+            if self.tables is not None and table not in self.tables:
+                continue
+            rows = 0
+            with metrics.labels(account=account):
+                for path in self.landing.units(account, table,
+                                               insights=spec.insights):
+                    for records in self.landing.pages(path):
+                        if not spec.insights:
+                            rows += request_to_database(records, table,
+                                                        self.engine)
+                            continue
+                        rows += request_to_database(records, table, self.engine,
+                                                    method=upsert_method,
+                                                    chunksize=chunksize,
+                                                    load_threshold=load_threshold,
+                                                    compact=compact,
+                                                    detect_changes=detect_changes,
+                                                    actions_layout=actions_layout)
+            logger.info(f'{rows} landed rows of {table} replayed for {account}')
+        return True
+
+    def run(self, clients, workers=1, replay=False):
+        """Sync (or with replay, replay) every account of clients in up
+        to workers threads and log the outcome.
+        --> returns the accounts that were not synced
+        """
+        sync = self.replay_account if replay else self.sync_account
+
+        def sync_worker(account):
+            """Sync account, in a worker thread or in this one"""
+            try:
+                return sync(account)
+            except Exception:
+                # do not let one account stop the other accounts
+                logger.exception(f'Unexpected error while syncing {account}')
+                return False
+
+        if batch_dimensions and not replay:
+            self.fetch_dimensions(clients)
+
+        # store a list of accounts that were synced and not synced properly
+        synced = []
+        not_synced = []
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(sync_worker, clients))
+        else:
+            results = [sync_worker(account)
+                       for account in clients] # account refers to an account name
+        for account, success in zip(clients, results):
+            if success:
+                synced.append(account)
+            else:
+                not_synced.append(account) # storing accounts that were not successfull
+        # return all accounts not syned properly
+        synced_string = ",".join(synced)
+        not_synced_string = ",".join(not_synced)
+        synced_message = "The following accounts were synced: "
+        not_synced_message = "The following accounts were not properly synced: "
+        if len(not_synced) > 0: # if at least 1 account not synced properly - display
+            logging.warning(f'{not_synced_message} {not_synced_string}')
+        logging.info(f'{synced_message} {synced_string}')
+        if self.checkpoint is not None:
+            if len(not_synced) == 0:
+                self.checkpoint.finish()
+            else:
+                logging.warning(f'resume with --run-id {self.checkpoint.run_id} (or --resume)')
+        logging.info(f'campaign/adset id cache: {id_cache.stats()}')
+        logging.info(f'connection pool: {pool_stats(self.engine)}')
+        return not_synced
 
+if __name__ == '__main__':
+    import sys
+    from database.cli import main
+    main(['sync'] + sys.argv[1:])
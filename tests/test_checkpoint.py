@@ -0,0 +1,76 @@
+from database.checkpoint import Checkpoint
+
+
+def time_range(since, until):
+    return {'since': since, 'until': until}
+
+
+def test_pending_spans_without_history_is_the_whole_range(tmp_path):
+    checkpoint = Checkpoint('run', directory=str(tmp_path))
+    assert checkpoint.pending_spans('act_1', 'ads_insights',
+                                    '2019-09-01', '2019-09-10') == [
+        ('2019-09-01', '2019-09-10')]
+
+
+def test_pending_spans_leave_out_the_days_done(tmp_path):
+    checkpoint = Checkpoint('run', directory=str(tmp_path))
+    checkpoint.mark_done('act_1', 'ads_insights',
+                         time_range('2019-09-04', '2019-09-06'), rows=10)
+    checkpoint.mark_done('act_1', 'ads_insights',
+                         time_range('2019-09-10', '2019-09-10'), rows=10)
+    assert checkpoint.pending_spans('act_1', 'ads_insights',
+                                    '2019-09-01', '2019-09-10') == [
+        ('2019-09-01', '2019-09-03'), ('2019-09-07', '2019-09-09')]
+    # days are tracked per account and table
+    assert checkpoint.pending_spans('act_2', 'ads_insights',
+                                    '2019-09-01', '2019-09-02') == [
+        ('2019-09-01', '2019-09-02')]
+    assert checkpoint.pending_spans('act_1', 'ads_insights_region',
+                                    '2019-09-04', '2019-09-04') == [
+        ('2019-09-04', '2019-09-04')]
+
+
+def test_pending_spans_empty_when_everything_is_done(tmp_path):
+    checkpoint = Checkpoint('run', directory=str(tmp_path))
+    checkpoint.mark_done('act_1', 'ads_insights',
+                         time_range('2019-09-01', '2019-09-30'))
+    assert checkpoint.pending_spans('act_1', 'ads_insights',
+                                    '2019-09-05', '2019-09-20') == []
+
+
+def test_resumed_run_skips_the_recorded_units(tmp_path):
+    checkpoint = Checkpoint('run', directory=str(tmp_path))
+    checkpoint.mark_done('act_1', 'campaigns', rows=3)
+    checkpoint.mark_done('act_1', 'ads_insights',
+                         time_range('2019-09-01', '2019-09-02'))
+
+    resumed = Checkpoint('run', directory=str(tmp_path))
+    assert resumed.is_done('act_1', 'campaigns')
+    assert not resumed.is_done('act_1', 'adsets')
+    # resumed ranges may be cut differently from the recorded ones
+    assert resumed.pending_spans('act_1', 'ads_insights',
+                                 '2019-09-01', '2019-09-03') == [
+        ('2019-09-03', '2019-09-03')]
+    assert not resumed.finished
+
+
+def test_line_cut_off_by_a_crash_is_ignored(tmp_path):
+    checkpoint = Checkpoint('run', directory=str(tmp_path))
+    checkpoint.mark_done('act_1', 'campaigns')
+    with open(checkpoint.path, 'a') as f:
+        f.write('{"account": "act_1", "tab')
+
+    resumed = Checkpoint('run', directory=str(tmp_path))
+    assert resumed.is_done('act_1', 'campaigns')
+    resumed.mark_done('act_1', 'adsets')
+    assert Checkpoint('run', directory=str(tmp_path)).is_done('act_1', 'adsets')
+
+
+def test_latest_unfinished_skips_finished_runs(tmp_path):
+    directory = str(tmp_path)
+    Checkpoint('20190901-000000', directory=directory).mark_done(
+        'act_1', 'campaigns')
+    finished = Checkpoint('20190902-000000', directory=directory)
+    finished.mark_done('act_1', 'campaigns')
+    finished.finish()
+    assert Checkpoint.latest_unfinished(directory) == '20190901-000000'
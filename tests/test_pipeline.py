@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from database.pipeline import run_pipeline
+
+
+def wait_for_threads(count, timeout=5):
+    """True once no more than count threads are alive"""
+    deadline = time.monotonic() + timeout
+    while threading.active_count() > count:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_items_pass_every_stage_in_order():
+    results = run_pipeline(range(20), [lambda x: x * 2, lambda x: x + 1],
+                           depth=2)
+    assert list(results) == [x * 2 + 1 for x in range(20)]
+
+
+def test_stage_error_is_raised_in_the_caller():
+    def fail(x):
+        if x == 3:
+            raise ValueError('bad item')
+        return x
+
+    threads = threading.active_count()
+    seen = []
+    with pytest.raises(ValueError, match='bad item'):
+        for item in run_pipeline(range(100), [fail]):
+            seen.append(item)
+    assert seen == [0, 1, 2]
+    # the caller does not go on while a thread is left
+    assert threading.active_count() == threads
+
+
+def test_source_error_is_raised_in_the_caller():
+    def source():
+        yield 1
+        raise RuntimeError('api down')
+
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError, match='api down'):
+        list(run_pipeline(source(), [lambda x: x]))
+    assert threading.active_count() == threads
+
+
+def test_first_error_wins():
+    def fail_first(x):
+        raise ValueError('first')
+
+    def fail_second(x):
+        raise KeyError('second')
+
+    with pytest.raises(ValueError):
+        list(run_pipeline(range(5), [fail_first, fail_second]))
+
+
+def test_closing_early_stops_and_joins_every_thread():
+    produced = []
+    closed = threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                # slow enough that an unjoined thread is still here
+                time.sleep(0.3)
+                produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    threads = threading.active_count()
+    results = run_pipeline(source(), [lambda x: x], depth=1)
+    assert next(results) == 0
+    results.close()
+    assert threading.active_count() == threads
+    # the source was closed in its own thread, with backpressure
+    # keeping it a few items ahead
+    assert closed.is_set()
+    assert len(produced) < 10
+
+
+def test_stop_event_ends_a_waiting_source():
+    stop = threading.Event()
+
+    def polling_source():
+        # like ReportJobManager.run: waits on the api between items
+        yield 'first'
+        stop.wait(60)
+
+    threads = threading.active_count()
+    results = run_pipeline(polling_source(), [lambda x: x], stop=stop)
+    start = time.monotonic()
+    assert next(results) == 'first'
+    results.close()
+    assert stop.is_set()
+    assert time.monotonic() - start < 5
+    assert wait_for_threads(threads)
@@ -0,0 +1,129 @@
+import pytest
+
+from database.planner import (
+    RELAX_AFTER,
+    SlicePlanner,
+    range_days,
+    slice_range,
+    split_range,
+)
+
+
+class MemoryPlanner(SlicePlanner):
+    """SlicePlanner keeping the slice_sizes rows in a dictionary"""
+    def __init__(self, **kwargs):
+        super().__init__(engine=None, **kwargs)
+        self.rows = {}
+
+    def load(self, account_id, table):
+        return self.rows.get((account_id, table), (None, None, None, None))
+
+    def save(self, account_id, table, days, rows_per_day, cap_days=None,
+             cap_successes=None):
+        self.rows[(account_id, table)] = (days, rows_per_day, cap_days,
+                                          cap_successes)
+
+
+def days_range(since, days):
+    return slice_range(since, '2030-12-31', days)[0]
+
+
+def test_slice_range_covers_the_window_without_overlap():
+    assert slice_range('2019-09-01', '2019-09-10', 4) == [
+        {'since': '2019-09-01', 'until': '2019-09-04'},
+        {'since': '2019-09-05', 'until': '2019-09-08'},
+        {'since': '2019-09-09', 'until': '2019-09-10'},
+    ]
+
+
+def test_split_range_halves_and_stops_at_one_day():
+    assert split_range({'since': '2019-09-01', 'until': '2019-09-05'}) == [
+        {'since': '2019-09-01', 'until': '2019-09-03'},
+        {'since': '2019-09-04', 'until': '2019-09-05'},
+    ]
+    assert split_range({'since': '2019-09-01', 'until': '2019-09-01'}) == []
+
+
+def test_plan_uses_the_default_size_without_history():
+    planner = MemoryPlanner(default_days=5)
+    time_ranges = planner.plan('act_1', 'ads_insights',
+                               '2019-09-01', '2019-09-30')
+    assert [range_days(r) for r in time_ranges] == [5] * 6
+
+
+def test_record_sizes_slices_by_target_rows():
+    planner = MemoryPlanner(target_rows=1000, max_days=60)
+    planner.record('act_1', 'ads_insights', days_range('2019-09-01', 10), 1000)
+    # 100 rows per day
+    assert planner.slice_days('act_1', 'ads_insights') == 10
+    planner.record('act_1', 'ads_insights', days_range('2019-09-11', 10), 0)
+    # smoothed to 50 rows per day
+    assert planner.slice_days('act_1', 'ads_insights') == 20
+    planner.record('act_2', 'ads_insights', days_range('2019-09-01', 1), 0)
+    assert planner.slice_days('act_2', 'ads_insights') == 60
+
+
+def test_failure_caps_the_row_based_size():
+    planner = MemoryPlanner(target_rows=1000, max_days=60)
+    planner.record('act_1', 'ads_insights', days_range('2019-09-01', 10), 100)
+    assert planner.slice_days('act_1', 'ads_insights') == 60
+
+    planner.record_failure('act_1', 'ads_insights',
+                           days_range('2019-09-01', 20))
+    assert planner.slice_days('act_1', 'ads_insights') == 10
+    # few rows do not lift the cap: the failure was not about rows
+    planner.record('act_1', 'ads_insights', days_range('2019-09-01', 5), 5)
+    assert planner.slice_days('act_1', 'ads_insights') == 10
+
+
+def test_cap_is_raised_slowly_after_successes_at_its_size():
+    planner = MemoryPlanner(target_rows=1000, max_days=60)
+    planner.record_failure('act_1', 'ads_insights',
+                           days_range('2019-09-01', 16))
+    assert planner.slice_days('act_1', 'ads_insights') == 8
+
+    sizes = []
+    for _ in range(2 * RELAX_AFTER):
+        days = planner.slice_days('act_1', 'ads_insights')
+        planner.record('act_1', 'ads_insights',
+                       days_range('2019-09-01', days), days)
+        sizes.append(planner.slice_days('act_1', 'ads_insights'))
+    assert sizes == [8] * (RELAX_AFTER - 1) + [10] * RELAX_AFTER + [12]
+
+    # shorter jobs do not count towards raising the cap
+    before = planner.load('act_1', 'ads_insights')
+    planner.record('act_1', 'ads_insights', days_range('2019-09-01', 2), 2)
+    assert planner.load('act_1', 'ads_insights')[2:] == before[2:]
+
+
+def test_cap_is_dropped_once_it_reaches_max_days():
+    planner = MemoryPlanner(target_rows=1000, max_days=10)
+    planner.record_failure('act_1', 'ads_insights',
+                           days_range('2019-09-01', 18))
+    for _ in range(RELAX_AFTER):
+        planner.record('act_1', 'ads_insights',
+                       days_range('2019-09-01', 9), 9)
+    days, _, cap, successes = planner.load('act_1', 'ads_insights')
+    assert (days, cap, successes) == (10, None, None)
+
+
+def test_repeated_failures_only_lower_the_cap():
+    planner = MemoryPlanner()
+    planner.record_failure('act_1', 'ads_insights',
+                           days_range('2019-09-01', 8))
+    # a late failure of a longer range planned before the first one
+    planner.record_failure('act_1', 'ads_insights',
+                           days_range('2019-09-01', 30))
+    assert planner.load('act_1', 'ads_insights')[2] == 4
+
+
+@pytest.mark.parametrize('days, failed', [(6, True), (1, False)])
+def test_splitter_records_a_failure_only_when_it_splits(days, failed):
+    planner = MemoryPlanner()
+    split = planner.splitter('act_1', 'ads_insights')
+    children = split(days_range('2019-09-01', days))
+    assert bool(children) == failed
+    assert (('act_1', 'ads_insights') in planner.rows) == failed
+    if failed:
+        assert [range_days(r) for r in children] == [3, 3]
+        assert planner.slice_days('act_1', 'ads_insights') == 3